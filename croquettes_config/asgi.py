@@ -16,12 +16,14 @@ from django.core.asgi import get_asgi_application
 
 # Import websocket routes from the shop app
 from shop import routing as shop_routing
+from shop.outbox import OutboxLoopMiddleware
 
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
+    # Channel layer en mémoire (dev) : l'outbox envoie depuis la boucle du serveur
+    "websocket": OutboxLoopMiddleware(AuthMiddlewareStack(
         URLRouter(
             shop_routing.websocket_urlpatterns
         )
-    ),
+    )),
 })
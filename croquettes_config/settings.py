@@ -35,6 +35,7 @@ MIDDLEWARE = [
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'shop.middleware.CartMiddleware',  # Cookie du panier (voir CART_STORAGE)
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
@@ -80,6 +81,50 @@ if DEBUG and os.environ.get('USE_INMEMORY_CHANNELS', 'True') == 'True':
         }
     }
 
+# Cache partagé par tous les processus (Redis) : compteurs de non-lus
+# (shop/counters.py) et version du catalogue (shop/catalog.py) sont invalidés
+# par le processus qui écrit, les autres doivent voir la même valeur
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ.get('REDIS_URL', 'redis://localhost:6379'),
+        'KEY_PREFIX': 'croquettes',
+    },
+}
+
+# Fallback pour développement local (un seul processus) : cache en mémoire si DEBUG=True
+if DEBUG and os.environ.get('USE_LOCMEM_CACHE', 'True') == 'True':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Outbox des événements Channels (voir shop/outbox.py) : envoi après commit par un thread dédié
+CHANNELS_OUTBOX = {
+    'MAX_QUEUE_SIZE': int(os.environ.get('CHANNELS_OUTBOX_MAX_QUEUE_SIZE', 10000)),
+    'BATCH_SIZE': 100,
+    'MAX_RETRIES': 3,
+    'RETRY_DELAY': 0.2,
+    'DELAY_THRESHOLD': 1.0,
+}
+
+# Chat : messages d'un même socket regroupés pendant cette fenêtre (secondes, 0 = aucun regroupement)
+CHAT_COALESCE_WINDOW = float(os.environ.get('CHAT_COALESCE_WINDOW', 0.05))
+
+# Notifications : même destinataire et même lien, non lue, regroupées pendant cette fenêtre (secondes, 0 = jamais)
+NOTIFICATION_COALESCE_WINDOW = float(os.environ.get('NOTIFICATION_COALESCE_WINDOW', 300))
+
+# Rétention des notifications lues (voir shop/retention.py, commande archive_notifications)
+NOTIFICATION_RETENTION = {
+    'DAYS': int(os.environ.get('NOTIFICATION_RETENTION_DAYS', 90)),
+    'BATCH_SIZE': 1000,
+    'ARCHIVE_DIR': os.environ.get('NOTIFICATION_ARCHIVE_DIR', BASE_DIR / 'archives' / 'notifications'),
+}
+
+# Renouvellement des abonnements (commande renew_subscriptions) : abonnements traités par transaction
+SUBSCRIPTION_RENEWAL_CHUNK_SIZE = int(os.environ.get('SUBSCRIPTION_RENEWAL_CHUNK_SIZE', 500))
+
 # Database
 # En développement local, utiliser SQLite si DEBUG=True et pas de DATABASE_URL fournie.
 if DEBUG and not os.environ.get('DATABASE_URL'):
@@ -142,6 +187,22 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 # Media files (uploaded images)
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
+# Servir MEDIA_ROOT par Django même avec DEBUG=False (voir shop/media.py)
+SERVE_MEDIA = os.environ.get('SERVE_MEDIA', 'False') == 'True'
+MEDIA_CACHE = {
+    'MAX_AGE': 3600,                 # anciens fichiers, revalidés par ETag
+    'IMMUTABLE_MAX_AGE': 31536000,   # images nommées par empreinte et déclinaisons
+}
+
+# Déclinaisons redimensionnées des images produit (voir shop/images.py)
+IMAGE_DERIVATIVES = {
+    'WIDTHS': (320, 640, 960),
+    'FORMATS': ('webp', 'jpeg'),
+    'QUALITY': 80,
+    'DIR': 'products/derivatives',
+    # Génération après un envoi dans un thread d'arrière-plan (regenerate_images pour tout le catalogue)
+    'BACKGROUND': True,
+}
 
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
@@ -150,6 +211,13 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 SESSION_ENGINE = 'django.contrib.sessions.backends.db'
 SESSION_COOKIE_AGE = 86400
 
+# Stockage du panier : cookie signé par défaut, pour que la navigation des
+# visiteurs anonymes ne crée ni ne modifie de ligne django_session.
+# Autres choix : 'shop.cart.SessionCartStorage', 'shop.cart.CacheCartStorage'
+CART_STORAGE = os.environ.get('CART_STORAGE', 'shop.cart.SignedCookieCartStorage')
+CART_COOKIE_NAME = 'cart'
+CART_COOKIE_AGE = 60 * 60 * 24 * 30
+
 # Security settings for production
 if not DEBUG:
     SECURE_SSL_REDIRECT = True
@@ -1,7 +1,9 @@
-from django.contrib import admin
-from .models import Product, DeliveryLocation, Order, OrderItem, Subscription, RewardPoint
+from django.contrib import admin, messages
+from .models import Product, DeliveryLocation, Order, OrderItem, Subscription, RewardPoint, RewardTransaction
 from .models import UserProfile
 from .models import Notification, OrderStatusHistory, Conversation, Message
+from .orders import OutOfStockError
+from .rewards import record_transactions
 
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
@@ -61,16 +63,14 @@ class OrderAdmin(admin.ModelAdmin):
     claim_orders.short_description = "S'assigner les commandes sélectionnées"
 
     def _bulk_change_status(self, request, queryset, new_status):
-        for order in queryset:
-            old_status = order.status
-            order.status = new_status
-            order.save()
-            # Créer l'historique avec l'utilisateur qui effectue l'action
-            OrderStatusHistory.objects.create(order=order, old_status=old_status, new_status=new_status, changed_by=request.user)
-            # Notifier le client
-            if order.user:
-                Notification.objects.create(recipient=order.user, verb=f"Le statut de votre commande #{order.id} est maintenant: {new_status}", url=f"/commande/{order.id}/")
-        self.message_user(request, f"Statut changé vers '{new_status}' pour {queryset.count()} commande(s).")
+        # Un UPDATE + historique et notifications insérés en masse (voir OrderQuerySet.transition_status)
+        try:
+            changed = queryset.transition_status(new_status, changed_by=request.user)
+        except OutOfStockError as e:
+            # Commande annulée rétablie sans stock suffisant : rien n'a été modifié
+            self.message_user(request, f"Aucun changement : {e}.", level=messages.ERROR)
+            return
+        self.message_user(request, f"Statut changé vers '{new_status}' pour {changed} commande(s).")
 
     def mark_confirmed(self, request, queryset):
         self._bulk_change_status(request, queryset, 'confirmed')
@@ -97,7 +97,27 @@ class SubscriptionAdmin(admin.ModelAdmin):
 class RewardPointAdmin(admin.ModelAdmin):
     list_display = ['user', 'points', 'total_earned', 'updated_at']
     search_fields = ['user__username']
-    readonly_fields = ['total_earned', 'updated_at']
+    # Solde tenu par le journal : les corrections passent par un mouvement "Ajustement"
+    readonly_fields = ['points', 'total_earned', 'updated_at']
+
+
+@admin.register(RewardTransaction)
+class RewardTransactionAdmin(admin.ModelAdmin):
+    list_display = ['user', 'kind', 'points', 'order', 'created_at']
+    list_filter = ['kind', 'created_at']
+    search_fields = ['user__username']
+    raw_id_fields = ['user', 'order']
+
+    def has_change_permission(self, request, obj=None):
+        # Journal en ajout seul
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def save_model(self, request, obj, form, change):
+        # Mouvement + mise à jour du solde (voir shop/rewards.py)
+        record_transactions([obj])
 
 
 # Enregistrer les nouveaux modèles pour gérer historique, notifications et chat
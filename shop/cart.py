@@ -1,71 +1,235 @@
+import secrets
 from decimal import Decimal
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
 from .models import Product
 
+
+# --- Stockage du panier ---
+# Le contenu ({id produit: quantité}) est chargé une fois par requête et
+# partagé par tous les `Cart` de cette requête. Les stockages à base de
+# cookie posent leur cookie dans la réponse via shop.middleware.CartMiddleware.
+
+class BaseCartStorage:
+    def __init__(self, request):
+        self.request = request
+        self.data = self.load()
+        self.modified = False
+
+    def load(self):
+        raise NotImplementedError
+
+    def save(self):
+        """Le panier a changé (appelé par `Cart.save`)"""
+        self.modified = True
+
+    def update_response(self, response):
+        """Écrire dans la réponse ce qui doit l'être (cookie...)"""
+
+
+class SessionCartStorage(BaseCartStorage):
+    """Panier dans `request.session` (une écriture de session par modification)"""
+
+    def load(self):
+        return self.request.session.get('cart') or {}
+
+    def save(self):
+        super().save()
+        if self.data:
+            self.request.session['cart'] = self.data
+        else:
+            # Panier vide : ne pas créer de session pour rien
+            self.request.session.pop('cart', None)
+        self.request.session.modified = True
+
+
+class SignedCookieCartStorage(BaseCartStorage):
+    """Panier dans un cookie signé : aucune écriture côté serveur"""
+    salt = 'shop.cart'
+
+    def load(self):
+        value = self.request.COOKIES.get(settings.CART_COOKIE_NAME)
+        if not value:
+            return {}
+        try:
+            data = signing.loads(value, salt=self.salt, max_age=settings.CART_COOKIE_AGE)
+        except signing.BadSignature:
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def update_response(self, response):
+        if not self.modified:
+            return
+        if self.data:
+            response.set_cookie(
+                settings.CART_COOKIE_NAME,
+                signing.dumps(self.data, salt=self.salt, compress=True),
+                max_age=settings.CART_COOKIE_AGE,
+                secure=settings.SESSION_COOKIE_SECURE,
+                httponly=True,
+                samesite='Lax',
+            )
+        else:
+            response.delete_cookie(settings.CART_COOKIE_NAME, samesite='Lax')
+
+
+class CacheCartStorage(BaseCartStorage):
+    """Panier dans le cache, retrouvé grâce à un identifiant en cookie signé"""
+    salt = 'shop.cart.id'
+
+    def load(self):
+        self.cart_id = self.request.get_signed_cookie(settings.CART_COOKIE_NAME, default=None, salt=self.salt)
+        if not self.cart_id:
+            return {}
+        return cache.get(self._key()) or {}
+
+    def _key(self):
+        return f"shop:cart:{self.cart_id}"
+
+    def save(self):
+        super().save()
+        if not self.data:
+            if self.cart_id:
+                cache.delete(self._key())
+            return
+        if not self.cart_id:
+            self.cart_id = secrets.token_urlsafe(16)
+            self._new_cart_id = True
+        cache.set(self._key(), self.data, settings.CART_COOKIE_AGE)
+
+    def update_response(self, response):
+        if not self.modified:
+            return
+        if self.data and getattr(self, '_new_cart_id', False):
+            response.set_signed_cookie(
+                settings.CART_COOKIE_NAME, self.cart_id, salt=self.salt,
+                max_age=settings.CART_COOKIE_AGE,
+                secure=settings.SESSION_COOKIE_SECURE,
+                httponly=True,
+                samesite='Lax',
+            )
+        elif not self.data:
+            response.delete_cookie(settings.CART_COOKIE_NAME, samesite='Lax')
+
+
+def get_cart_storage(request):
+    """Stockage du panier de cette requête (classe choisie par `settings.CART_STORAGE`)"""
+    storage = getattr(request, '_cart_storage', None)
+    if storage is None:
+        storage = request._cart_storage = import_string(settings.CART_STORAGE)(request)
+    return storage
+
+
+def _request_product_cache(request):
+    """Produits déjà chargés pendant cette requête, partagés par tous les `Cart`"""
+    products = getattr(request, '_cart_products', None)
+    if products is None:
+        products = request._cart_products = {}
+    return products
+
+
 class Cart:
-    """Gestion du panier en session (fonctionne pour invités et connectés)"""
-    
+    """Gestion du panier (fonctionne pour invités et connectés)
+
+    Le stockage ne contient que {id produit: quantité} ; il est choisi par
+    `settings.CART_STORAGE` (session, cache ou cookie signé). Les produits
+    sont chargés en une requête au plus par requête HTTP (cache partagé via
+    `request`) ; prix et totaux sont calculés une fois puis réutilisés.
+    """
+
     def __init__(self, request):
-        self.session = request.session
-        cart = self.session.get('cart')
-        if not cart:
-            cart = self.session['cart'] = {}
-        self.cart = cart
-    
+        self.storage = get_cart_storage(request)
+        self.cart = self.storage.data
+        self._upgrade_legacy_format()
+        self._products = _request_product_cache(request)
+        self._items = None
+        self._count = sum(self.cart.values())
+
+    def _upgrade_legacy_format(self):
+        """Anciennes sessions : {id: {'quantity': n, 'price': '...'}} -> {id: n}"""
+        legacy = [pid for pid, value in self.cart.items() if isinstance(value, dict)]
+        for product_id in legacy:
+            self.cart[product_id] = int(self.cart[product_id].get('quantity', 0))
+        if legacy:
+            self.save()
+
     def add(self, product, quantity=1):
         """Ajouter un produit au panier"""
         product_id = str(product.id)
-        if product_id not in self.cart:
-            self.cart[product_id] = {
-                'quantity': 0,
-                'price': str(product.price)
-            }
-        self.cart[product_id]['quantity'] += quantity
+        self.cart[product_id] = self.cart.get(product_id, 0) + quantity
+        self._products[product.id] = product
         self.save()
-    
+
     def remove(self, product):
         """Retirer un produit du panier"""
         product_id = str(product.id)
         if product_id in self.cart:
             del self.cart[product_id]
             self.save()
-    
+
     def update(self, product, quantity):
         """Mettre à jour la quantité d'un produit"""
         product_id = str(product.id)
         if product_id in self.cart:
             if quantity > 0:
-                self.cart[product_id]['quantity'] = quantity
+                self.cart[product_id] = quantity
+                self._products[product.id] = product
             else:
                 self.remove(product)
             self.save()
-    
+
     def save(self):
-        """Sauvegarder le panier en session"""
-        self.session.modified = True
-    
+        """Sauvegarder le panier"""
+        self.storage.save()
+        self._items = None
+        self._count = sum(self.cart.values())
+
     def clear(self):
         """Vider le panier"""
-        del self.session['cart']
+        self.cart.clear()
         self.save()
-    
+
+    def _resolve_products(self):
+        """Charger en une requête les produits du panier pas encore en cache"""
+        missing = [int(pid) for pid in self.cart if int(pid) not in self._products]
+        if missing:
+            for product in Product.objects.filter(id__in=missing):
+                self._products[product.id] = product
+            # Produits supprimés depuis l'ajout : ne pas les redemander
+            for product_id in missing:
+                self._products.setdefault(product_id, None)
+
+    def _get_items(self):
+        if self._items is None:
+            self._resolve_products()
+            items = []
+            for product_id, quantity in self.cart.items():
+                product = self._products.get(int(product_id))
+                if product is None:
+                    continue
+                items.append({
+                    'product': product,
+                    'quantity': quantity,
+                    'price': product.price,
+                    'total_price': product.price * quantity,
+                })
+            self._items = items
+            self._total = sum((item['total_price'] for item in items), Decimal('0'))
+        return self._items
+
     def __iter__(self):
         """Itérer sur les articles du panier"""
-        product_ids = self.cart.keys()
-        products = Product.objects.filter(id__in=product_ids)
-        cart = self.cart.copy()
-        
-        for product in products:
-            cart[str(product.id)]['product'] = product
-        
-        for item in cart.values():
-            item['price'] = Decimal(item['price'])
-            item['total_price'] = item['price'] * item['quantity']
-            yield item
-    
+        return iter(self._get_items())
+
     def __len__(self):
         """Nombre total d'articles dans le panier"""
-        return sum(item['quantity'] for item in self.cart.values())
-    
+        return self._count
+
     def get_total_price(self):
         """Prix total du panier"""
-        return sum(Decimal(item['price']) * item['quantity'] for item in self.cart.values())
\ No newline at end of file
+        self._get_items()
+        return self._total
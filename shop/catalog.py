@@ -0,0 +1,60 @@
+"""Catalogue de la page d'accueil, mis en cache par version.
+
+Chaque page du catalogue est rendue une fois puis servie depuis le cache.
+La clé contient un numéro de version du catalogue, incrémenté à chaque
+modification d'un produit (ou de son stock) : les anciennes pages ne sont
+plus jamais lues et expirent d'elles-mêmes.
+"""
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.template.loader import render_to_string
+
+from .models import Product
+from .pagination import decode_cursor, encode_cursor, keyset_paginate
+
+VERSION_KEY = 'shop:catalog:version'
+PAGE_SIZE = 24
+PAGE_TIMEOUT = 60 * 60
+ORDERING = ('-created_at', '-id')
+
+
+def get_catalog_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # Valeur initiale basée sur l'heure : pas de collision avec une version
+        # antérieure si la clé a été évincée du cache
+        cache.add(VERSION_KEY, int(time.time() * 1000), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def bump_catalog_version():
+    """Invalider toutes les pages en cache du catalogue"""
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        get_catalog_version()
+
+
+def bump_catalog_version_on_commit():
+    transaction.on_commit(bump_catalog_version)
+
+
+def get_catalog_page(cursor=None):
+    """Page du catalogue : {'html': grille rendue, 'next_cursor': curseur ou None}"""
+    # Clé construite depuis le curseur décodé et réencodé : un curseur invalide
+    # ou une variante d'écriture ne crée pas d'entrée de cache supplémentaire
+    values = decode_cursor(cursor, Product, ORDERING)
+    cursor = encode_cursor(values) if values is not None else None
+    key = f"shop:catalog:{get_catalog_version()}:{cursor or 'first'}"
+    page = cache.get(key)
+    if page is None:
+        products = keyset_paginate(Product.objects.filter(is_active=True), cursor, PAGE_SIZE, ORDERING)
+        page = {
+            'html': render_to_string('shop/product_grid.html', {'products': products}),
+            'next_cursor': products.next_cursor,
+        }
+        cache.set(key, page, PAGE_TIMEOUT)
+    return page
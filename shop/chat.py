@@ -0,0 +1,128 @@
+"""Résumés des conversations : dernier message et non-lus par participant."""
+from django.db import transaction
+from django.db.models import Count, F, Q
+
+from . import counters, outbox
+from .models import Conversation, ConversationReadState, Message
+
+
+def order_group(order_id):
+    """Nom du groupe Channels du chat d'une commande"""
+    return f"order_{order_id}"
+
+
+def publish_access_changed(order_ids):
+    """Prévenir les sockets de chat ouverts que l'accès aux commandes a changé (après le commit)"""
+    outbox.enqueue_many([
+        (order_group(order_id), {'type': 'chat.access_changed'})
+        for order_id in order_ids
+    ])
+
+
+def record_new_message(message, recipient_ids, count=1):
+    """Mettre à jour le résumé de la conversation après l'envoi de `message`.
+
+    `recipient_ids` : participants autres que l'expéditeur, dont le compteur
+    de non-lus augmente de `count` (nombre de messages envoyés, `message`
+    étant le dernier).
+    """
+    conversation_id = message.conversation_id
+    # Ne pas reculer si un message plus récent a déjà été enregistré
+    Conversation.objects.filter(
+        Q(last_message_at__isnull=True) | Q(last_message_at__lte=message.created_at),
+        pk=conversation_id,
+    ).update(last_message=message, last_message_at=message.created_at)
+
+    recipient_ids = list(recipient_ids)
+    if not recipient_ids:
+        return
+    ConversationReadState.objects.bulk_create(
+        [ConversationReadState(conversation_id=conversation_id, user_id=user_id) for user_id in recipient_ids],
+        ignore_conflicts=True,
+    )
+    ConversationReadState.objects.filter(
+        conversation_id=conversation_id, user_id__in=recipient_ids
+    ).update(unread_count=F('unread_count') + count)
+
+
+def post_messages(conversation_id, sender_id, contents, recipient_ids):
+    """Enregistrer plusieurs messages d'un même expéditeur en un seul INSERT.
+
+    `recipient_ids` : participants autres que l'expéditeur, connus de
+    l'appelant (pas de relecture des participants). `bulk_create` ne passe
+    pas par `message_post_save` : le résumé et les compteurs sont mis à jour
+    ici, une fois pour tout le lot.
+    """
+    recipient_ids = list(recipient_ids)
+    with transaction.atomic():
+        messages = Message.objects.bulk_create([
+            Message(conversation_id=conversation_id, sender_id=sender_id, content=content)
+            for content in contents
+        ])
+        if messages:
+            record_new_message(messages[-1], recipient_ids, count=len(messages))
+            counters.increment(counters.MESSAGES, recipient_ids, delta=len(messages))
+    return messages
+
+
+def _unread_by_sender(conversation_id):
+    """{id expéditeur: messages non lus} d'une conversation (une requête d'agrégat)"""
+    return dict(
+        Message.objects.filter(conversation_id=conversation_id, read=False)
+        .values_list('sender')
+        .annotate(n=Count('id'))
+        .order_by()
+    )
+
+
+def add_read_states(conversation_id, user_ids):
+    """Créer le résumé des participants ajoutés à une conversation, avec leurs non-lus actuels.
+
+    Les lignes déjà présentes ne sont pas modifiées. Les compteurs du menu
+    des participants ajoutés sont recalculés à la prochaine lecture.
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    unread_by_sender = _unread_by_sender(conversation_id)
+    total = sum(unread_by_sender.values())
+    ConversationReadState.objects.bulk_create(
+        [
+            ConversationReadState(
+                conversation_id=conversation_id,
+                user_id=user_id,
+                unread_count=total - unread_by_sender.get(user_id, 0),
+            )
+            for user_id in user_ids
+        ],
+        ignore_conflicts=True,
+    )
+    counters.invalidate(counters.MESSAGES, user_ids)
+
+
+def refresh_unread_counts(conversation):
+    """Recalculer les non-lus de chaque participant après un passage en "lu".
+
+    Le drapeau `Message.read` est commun à tous : les non-lus d'un participant
+    sont les messages non lus qu'il n'a pas envoyés. Un participant sans
+    résumé (ajouté avant son suivi) en reçoit un.
+    """
+    unread_by_sender = _unread_by_sender(conversation.pk)
+    total = sum(unread_by_sender.values())
+    states = list(conversation.read_states.all())
+    for state in states:
+        state.unread_count = total - unread_by_sender.get(state.user_id, 0)
+    ConversationReadState.objects.bulk_update(states, ['unread_count'])
+    missing = set(conversation.participants.values_list('id', flat=True)) - {s.user_id for s in states}
+    if missing:
+        ConversationReadState.objects.bulk_create(
+            [
+                ConversationReadState(
+                    conversation_id=conversation.pk,
+                    user_id=user_id,
+                    unread_count=total - unread_by_sender.get(user_id, 0),
+                )
+                for user_id in missing
+            ],
+            ignore_conflicts=True,
+        )
@@ -1,18 +1,56 @@
+import asyncio
 import json
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db.models import Min
 
-from .models import Order, Conversation, Message, Notification
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
+from .chat import order_group, post_messages
+from .models import Order, Conversation
+from .notifications import (
+    latest_sync_cursor,
+    notification_group,
+    notifications_since,
+    notify_coalesced,
+)
 
 User = get_user_model()
 
+# Notifications manquées renvoyées à la reconnexion ; au-delà, le client
+# complète via /notifications/sync/
+NOTIFICATIONS_CATCH_UP_LIMIT = 100
+
+
+def _coalesce_window():
+    """Fenêtre (secondes) pendant laquelle les messages d'un socket sont regroupés"""
+    return getattr(settings, 'CHAT_COALESCE_WINDOW', 0.05)
+
+
 class OrderChatConsumer(AsyncWebsocketConsumer):
+    """Chat d'une commande.
+
+    La commande (propriétaire, admin assigné, conversation) est lue une fois à
+    la connexion ; les participants sont résolus au premier message. Tout est
+    gardé pour la durée du socket et rechargé sur `chat.access_changed`
+    (réassignation de la commande). Les messages reçus pendant
+    `CHAT_COALESCE_WINDOW` sont enregistrés ensemble : un INSERT groupé et une
+    notification par destinataire pour tout le lot, regroupée avec les précédentes
+    non lues (voir `notifications.notify_coalesced`).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._order = None
+        self._conversation_id = None
+        self._participant_ids = None
+        self._pending = []
+        self._flush_task = None
+
     async def connect(self):
         self.order_id = self.scope['url_route']['kwargs']['order_id']
-        self.group_name = f"order_{self.order_id}"
+        self.group_name = order_group(self.order_id)
 
         user = self.scope['user']
         # Only authenticated users can join (further permission checks below)
@@ -30,29 +68,55 @@ class OrderChatConsumer(AsyncWebsocketConsumer):
         await self.accept()
 
     async def disconnect(self, close_code):
+        # Ne pas perdre les messages encore en attente d'écriture
+        if self._flush_task is not None:
+            await self._flush_task
         await self.channel_layer.group_discard(self.group_name, self.channel_name)
 
     async def receive(self, text_data=None, bytes_data=None):
         data = json.loads(text_data)
         message_text = data.get('message')
-        user = self.scope['user']
 
         if not message_text:
             return
 
-        # Save message to DB
-        message_obj = await self._create_message(user, int(self.order_id), message_text)
-
-        # Broadcast to group
-        await self.channel_layer.group_send(
-            self.group_name,
-            {
-                'type': 'chat.message',
-                'message': message_text,
-                'sender': user.username,
-                'created_at': message_obj.created_at.isoformat(),
-            }
-        )
+        self._pending.append(message_text)
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_pending())
+
+    async def _flush_pending(self):
+        try:
+            window = _coalesce_window()
+            if window:
+                await asyncio.sleep(window)
+            user = self.scope['user']
+            # Les messages arrivés pendant une écriture partent au tour suivant
+            while self._pending:
+                contents, self._pending = self._pending, []
+                # Save messages to DB
+                message_objs = await self._create_messages(user, int(self.order_id), contents)
+
+                # Broadcast to group
+                for message_obj in message_objs:
+                    await self.channel_layer.group_send(
+                        self.group_name,
+                        {
+                            'type': 'chat.message',
+                            'message': message_obj.content,
+                            'sender': user.username,
+                            'created_at': message_obj.created_at.isoformat(),
+                        }
+                    )
+        finally:
+            self._flush_task = None
+
+    async def chat_access_changed(self, event):
+        # Commande réassignée : relire l'accès et resynchroniser les participants
+        self._order = None
+        self._participant_ids = None
+        user = self.scope['user']
+        if not await self._user_can_access_order(user, int(self.order_id)):
+            await self.close()
 
     async def chat_message(self, event):
         await self.send(text_data=json.dumps({
@@ -61,59 +125,107 @@ class OrderChatConsumer(AsyncWebsocketConsumer):
             'created_at': event['created_at'],
         }))
 
+    def _load_order(self, order_id):
+        """Propriétaire, admin assigné et conversation de la commande, en une requête"""
+        self._order = (
+            Order.objects.filter(id=order_id)
+            .values('user_id', 'assigned_to_id')
+            .annotate(conversation_id=Min('conversations'))
+            # first() refuse un queryset agrégé sans tri explicite
+            .order_by('id')
+            .first()
+        )
+        if self._order is not None and self._order['conversation_id'] is not None:
+            self._conversation_id = self._order['conversation_id']
+        return self._order
+
     @database_sync_to_async
     def _user_can_access_order(self, user, order_id):
-        try:
-            order = Order.objects.get(id=order_id)
-        except Order.DoesNotExist:
+        order = self._load_order(order_id)
+        if order is None:
             return False
         # Owner can access
-        if order.user and order.user == user:
+        if order['user_id'] is not None and order['user_id'] == user.pk:
             return True
         # Staff (admin) can access
         if user.is_staff:
             return True
         return False
 
-    @database_sync_to_async
-    def _create_message(self, user, order_id, content):
-        order = Order.objects.get(id=order_id)
-        # Ensure a conversation exists
-        conv, _ = Conversation.objects.get_or_create(order=order)
-        # Ensure participants include sender and owner/admin
-        if order.user:
-            conv.participants.add(order.user)
-        if order.assigned_to:
-            conv.participants.add(order.assigned_to)
-        conv.participants.add(user)
-        msg = Message.objects.create(conversation=conv, sender=user, content=content)
-
-        # Create notifications for other participants
-        for participant in conv.participants.exclude(pk=user.pk).all():
-            try:
-                Notification.objects.create(
-                    recipient=participant,
-                    verb=f"Nouveau message sur la commande #{order.id}",
-                    url=f"/commande/{order.id}/chat/"
-                )
-            except Exception:
-                # Be resilient in case notifications cannot be created in some test environments
-                pass
+    def _ensure_conversation(self, user, order_id):
+        """Conversation et participants de la commande, résolus une fois par socket"""
+        if self._participant_ids is None:
+            order = self._order or self._load_order(order_id)
+            if self._conversation_id is None:
+                conv, _ = Conversation.objects.get_or_create(order_id=order_id)
+                self._conversation_id = conv.id
+            conv = Conversation(id=self._conversation_id)
+            participant_ids = set(conv.participants.values_list('id', flat=True))
+            # Ensure participants include sender and owner/admin
+            required = {order['user_id'], order['assigned_to_id'], user.pk} - {None}
+            if required - participant_ids:
+                conv.participants.add(*(required - participant_ids))
+            self._participant_ids = participant_ids | required
+        return self._conversation_id, self._participant_ids
+
+    def _write_messages(self, user, order_id, contents):
+        conversation_id, participant_ids = self._ensure_conversation(user, order_id)
+        recipient_ids = participant_ids - {user.pk}
+        messages = post_messages(conversation_id, user.pk, contents, recipient_ids)
+        # Une notification par destinataire pour tout le lot, regroupée avec la précédente
+        notify_coalesced(
+            recipient_ids,
+            f"Nouveau message sur la commande #{order_id}",
+            url=f"/commande/{order_id}/chat/",
+        )
+        return messages
 
-        return msg
+    @database_sync_to_async
+    def _create_messages(self, user, order_id, contents):
+        return self._write_messages(user, order_id, contents)
 
 
 class NotificationsConsumer(AsyncWebsocketConsumer):
-    """Gère les notifications en temps réel pour l'utilisateur connecté."""
+    """Gère les notifications en temps réel pour l'utilisateur connecté.
+
+    Un client qui se reconnecte passe `?since=<curseur>` (champ `cursor` du
+    dernier message reçu) : les notifications créées ou regroupées depuis
+    lui sont renvoyées avant un message
+    `{"sync": true, "cursor": ..., "has_more": ...}`. Sans `since` (ou avec un
+    curseur invalide), seul ce message est envoyé, pour que le client
+    connaisse son point de départ.
+    """
 
     async def connect(self):
         self.user = self.scope['user']
         if not self.user.is_authenticated:
             await self.close()
             return
-        self.group_name = f"notifications_{self.user.id}"
+        self.group_name = notification_group(self.user.id)
         await self.channel_layer.group_add(self.group_name, self.channel_name)
         await self.accept()
+        # Après group_add : une notification créée entre-temps peut arriver
+        # deux fois, le client dédoublonne par id
+        await self._catch_up(self._since())
+
+    def _since(self):
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        return query.get('since', [None])[0]
+
+    async def _catch_up(self, since):
+        payloads, cursor, has_more = await self._load_missed(since)
+        for payload in payloads:
+            await self.send(text_data=json.dumps(payload))
+        await self.send(text_data=json.dumps({'sync': True, 'cursor': cursor, 'has_more': has_more}))
+
+    @database_sync_to_async
+    def _load_missed(self, since):
+        if since is not None:
+            try:
+                return notifications_since(self.user.id, since, limit=NOTIFICATIONS_CATCH_UP_LIMIT)
+            except ValueError:
+                pass
+        return [], latest_sync_cursor(self.user.id), False
 
     async def disconnect(self, close_code):
         await self.channel_layer.group_discard(self.group_name, self.channel_name)
@@ -0,0 +1,80 @@
+"""Compteurs de non-lus par utilisateur, gardés en cache.
+
+Chaque compteur est calculé par une seule requête d'agrégat puis conservé en
+cache ; les créations l'incrémentent (après le commit) et les passages en
+"lu" l'invalident. La plupart des pages ne font donc aucune requête de
+comptage.
+"""
+from collections import Counter
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Sum
+
+from .models import ConversationReadState, Notification
+
+NOTIFICATIONS = 'notifications'
+MESSAGES = 'messages'
+
+# Filet de sécurité : un compteur ne reste jamais faux plus longtemps que ça
+TIMEOUT = 5 * 60
+
+
+def _key(kind, user_id):
+    return f"shop:unread:{kind}:{user_id}"
+
+
+def _count(kind, user_id):
+    if kind == NOTIFICATIONS:
+        return Notification.objects.filter(recipient_id=user_id, unread=True).count()
+    # Messages non lus (envoyés par les autres) dans les conversations de l'utilisateur,
+    # d'après les résumés tenus à jour par shop/chat.py
+    return (
+        ConversationReadState.objects
+        .filter(user_id=user_id)
+        .aggregate(total=Sum('unread_count'))['total']
+        or 0
+    )
+
+
+def get_unread(kind, user_id):
+    """Nombre de non-lus pour un utilisateur (depuis le cache si possible)"""
+    key = _key(kind, user_id)
+    value = cache.get(key)
+    if value is None:
+        value = _count(kind, user_id)
+        cache.set(key, value, TIMEOUT)
+    return max(value, 0)
+
+
+def set_unread(kind, user_id, value):
+    cache.set(_key(kind, user_id), value, TIMEOUT)
+
+
+def _apply_increments(kind, deltas):
+    for user_id, delta in deltas.items():
+        try:
+            cache.incr(_key(kind, user_id), delta)
+        except ValueError:
+            # Compteur absent du cache : il sera recalculé à la prochaine lecture
+            pass
+
+
+def increment(kind, user_ids, delta=1):
+    """Ajouter `delta` au compteur de chaque utilisateur, une fois la transaction validée.
+
+    `user_ids` peut contenir des doublons (plusieurs notifications pour le même
+    destinataire). `delta` négatif pour un passage en "lu".
+    """
+    deltas = Counter()
+    for user_id in user_ids:
+        deltas[user_id] += delta
+    if deltas:
+        transaction.on_commit(lambda: _apply_increments(kind, deltas))
+
+
+def invalidate(kind, user_ids):
+    """Oublier les compteurs : ils seront recalculés à la prochaine lecture"""
+    keys = [_key(kind, user_id) for user_id in user_ids]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
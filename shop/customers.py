@@ -0,0 +1,81 @@
+"""Statistiques client dénormalisées sur UserProfile (commandes, dépenses)."""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db.models import Case, DateTimeField, DecimalField, F, IntegerField, Value, When
+
+from .models import UserProfile
+
+# Seules les commandes livrées comptent comme dépensées (paiement à la livraison)
+SPENT_STATUS = 'delivered'
+
+
+def record_new_order(order):
+    """Nouvelle commande d'un client connecté : +1 commande, date de dernière commande"""
+    UserProfile.objects.filter(user_id=order.user_id).update(
+        order_count=F('order_count') + 1,
+        last_order_at=order.created_at,
+    )
+
+
+def record_new_orders(orders):
+    """Comme `record_new_order` pour des commandes créées en masse (`bulk_create`).
+
+    Un seul UPDATE pour tous les clients concernés.
+    """
+    counts = defaultdict(int)
+    latest = {}
+    for order in orders:
+        if not order.user_id:
+            continue
+        counts[order.user_id] += 1
+        if order.user_id not in latest or order.created_at > latest[order.user_id]:
+            latest[order.user_id] = order.created_at
+    if not counts:
+        return
+    UserProfile.objects.filter(user_id__in=counts).update(
+        order_count=F('order_count') + Case(
+            *[When(user_id=user_id, then=Value(n)) for user_id, n in counts.items()],
+            default=Value(0),
+            output_field=IntegerField(),
+        ),
+        last_order_at=Case(
+            *[When(user_id=user_id, then=Value(created_at)) for user_id, created_at in latest.items()],
+            default=F('last_order_at'),
+            output_field=DateTimeField(),
+        ),
+    )
+
+
+def add_lifetime_spend(deltas):
+    """Ajouter des montants (positifs ou négatifs) aux dépenses de plusieurs clients.
+
+    `deltas` : {user_id: montant}. Un seul UPDATE, quel que soit le nombre de
+    clients.
+    """
+    deltas = {user_id: amount for user_id, amount in deltas.items() if amount}
+    if not deltas:
+        return
+    UserProfile.objects.filter(user_id__in=deltas).update(
+        lifetime_spend=F('lifetime_spend') + Case(
+            *[When(user_id=user_id, then=Value(amount)) for user_id, amount in deltas.items()],
+            default=Value(Decimal('0')),
+            output_field=DecimalField(max_digits=12, decimal_places=2),
+        )
+    )
+
+
+def record_status_spend(orders, new_status):
+    """Mettre à jour les dépenses après un changement de statut.
+
+    `orders` : mêmes dicts que `record_status_changes` ('status' = ancien statut).
+    """
+    deltas = defaultdict(Decimal)
+    for o in orders:
+        if not o['user_id']:
+            continue
+        if new_status == SPENT_STATUS and o['status'] != SPENT_STATUS:
+            deltas[o['user_id']] += o['total_amount']
+        elif o['status'] == SPENT_STATUS and new_status != SPENT_STATUS:
+            deltas[o['user_id']] -= o['total_amount']
+    add_lifetime_spend(deltas)
@@ -0,0 +1,283 @@
+"""Déclinaisons redimensionnées des images produit (WebP et JPEG, plusieurs largeurs).
+
+Les fichiers sont rangés sous `<DIR>/<empreinte>/<largeur>.<format>`, où
+l'empreinte est le SHA-256 du fichier d'origine : une image déjà traitée
+n'est jamais recalculée, et une nouvelle image obtient de nouvelles URL (le
+cache des navigateurs n'a pas à être invalidé). Les URL sont construites à
+partir de l'empreinte enregistrée sur le produit, sans accès au stockage.
+
+Après l'envoi d'une image (admin), la génération part dans un thread
+d'arrière-plan : la requête n'attend pas l'encodage. Pour tout le catalogue
+(nouvelle largeur, nouveau format), `python manage.py regenerate_images`
+répartit le travail sur tous les cœurs (`regenerate_derivatives`). Les
+fichiers existants ne sont jamais réécrits : pour changer la qualité, changer
+aussi DIR afin que les navigateurs ne gardent pas les anciennes versions.
+"""
+import hashlib
+import io
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, connections
+from django.db.models import Case, CharField, F, Value, When
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'WIDTHS': (320, 640, 960),       # largeurs générées (px), jamais agrandies
+    'FORMATS': ('webp', 'jpeg'),     # le premier est proposé en priorité par <picture>
+    'QUALITY': 80,
+    'DIR': 'products/derivatives',   # sous MEDIA_ROOT
+    'SIZES': '(max-width: 576px) 100vw, (max-width: 768px) 50vw, (max-width: 992px) 33vw, 25vw',
+    'BACKGROUND': True,              # False : génération dans le callback on_commit (tests)
+    'CHUNK_SIZE': 200,               # images par lot pour regenerate_derivatives
+}
+
+CONTENT_TYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+EXTENSIONS = {'webp': 'webp', 'jpeg': 'jpg'}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'IMAGE_DERIVATIVES', {})}
+
+
+def content_hash(field_file):
+    """SHA-256 du fichier d'origine"""
+    digest = hashlib.sha256()
+    with field_file.open('rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def derivative_name(image_hash, width, fmt):
+    return f"{get_config()['DIR']}/{image_hash[:2]}/{image_hash}/{width}.{EXTENSIONS[fmt]}"
+
+
+def _encode(image, width, fmt, quality):
+    resized = image.copy()
+    resized.thumbnail((width, width * 4), Image.LANCZOS)
+    if fmt == 'jpeg' and resized.mode != 'RGB':
+        # JPEG sans transparence : fond blanc
+        background = Image.new('RGB', resized.size, (255, 255, 255))
+        rgba = resized.convert('RGBA')
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        resized = background
+    buffer = io.BytesIO()
+    resized.save(buffer, format=fmt.upper(), quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def missing_derivatives(image_hash):
+    """(largeur, format) des déclinaisons absentes du stockage"""
+    config = get_config()
+    return [
+        (width, fmt)
+        for width in config['WIDTHS']
+        for fmt in config['FORMATS']
+        if not default_storage.exists(derivative_name(image_hash, width, fmt))
+    ]
+
+
+def generate_derivatives(field_file, image_hash=None):
+    """Créer les déclinaisons manquantes de `field_file`. Renvoie l'empreinte de l'original."""
+    config = get_config()
+    image_hash = image_hash or content_hash(field_file)
+    missing = missing_derivatives(image_hash)
+    if not missing:
+        return image_hash
+    with field_file.open('rb') as f:
+        image = Image.open(f)
+        # Photos de téléphone : appliquer l'orientation EXIF avant de redimensionner
+        image = ImageOps.exif_transpose(image)
+        image.load()
+    for width, fmt in missing:
+        default_storage.save(
+            derivative_name(image_hash, width, fmt),
+            ContentFile(_encode(image, width, fmt, config['QUALITY'])),
+        )
+    return image_hash
+
+
+def image_sources(image_hash):
+    """srcset par format et URL de repli pour <picture>, ou None si pas de déclinaisons"""
+    if not image_hash:
+        return None
+    config = get_config()
+    widths = sorted(config['WIDTHS'])
+    sources = [
+        {
+            'type': CONTENT_TYPES[fmt],
+            'srcset': ', '.join(
+                f"{default_storage.url(derivative_name(image_hash, width, fmt))} {width}w" for width in widths
+            ),
+        }
+        for fmt in config['FORMATS']
+    ]
+    fallback_format = 'jpeg' if 'jpeg' in config['FORMATS'] else config['FORMATS'][-1]
+    return {
+        'sources': sources,
+        'src': default_storage.url(derivative_name(image_hash, widths[len(widths) // 2], fallback_format)),
+        'sizes': config['SIZES'],
+    }
+
+
+def refresh_product_image(product_id):
+    """Générer les déclinaisons d'un produit et enregistrer l'empreinte de son image"""
+    from .catalog import bump_catalog_version
+    from .models import Product
+
+    product = Product.objects.filter(pk=product_id).only('image', 'image_hash').first()
+    if product is None or not product.image:
+        return None
+    try:
+        image_hash = generate_derivatives(product.image)
+    except (OSError, ValueError):
+        # Image illisible : l'original reste servi tel quel
+        logger.exception("Déclinaisons impossibles pour l'image du produit #%s", product_id)
+        return None
+    if image_hash != product.image_hash:
+        # update() : pas de post_save, donc pas de nouvelle génération
+        Product.objects.filter(pk=product_id, image=product.image.name).update(image_hash=image_hash)
+        bump_catalog_version()
+    return image_hash
+
+
+# --- Génération en arrière-plan après un envoi ---
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _background():
+    # Un seul thread : les envois sont rares, et Pillow libère le GIL pendant l'encodage
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='image-derivatives')
+    return _executor
+
+
+def _refresh_in_background(product_id):
+    try:
+        refresh_product_image(product_id)
+    except Exception:
+        logger.exception("Erreur inattendue pendant la génération des déclinaisons du produit #%s", product_id)
+    finally:
+        # Connexion propre à ce thread
+        connection.close()
+
+
+def schedule_refresh(product_id):
+    """Générer les déclinaisons d'un produit hors de la requête (appelé après le commit)"""
+    if get_config()['BACKGROUND']:
+        _background().submit(_refresh_in_background, product_id)
+    else:
+        refresh_product_image(product_id)
+
+
+# --- Régénération de tout le catalogue ---
+def _init_worker():
+    # Processus démarrés par forkserver/spawn : Django n'y est pas encore chargé
+    import django
+    django.setup()
+
+
+def _process(job):
+    """Traiter une image dans un processus de travail (sans accès à la base).
+
+    `job` : (id produit, nom du fichier, empreinte enregistrée). Renvoie
+    (id, nom, empreinte ou None, 'generated' | 'skipped' | 'error').
+    """
+    from .models import Product
+
+    product_id, name, recorded_hash = job
+    image = Product(pk=product_id, image=name).image
+    try:
+        image_hash = content_hash(image)
+        if image_hash == recorded_hash and not missing_derivatives(image_hash):
+            return product_id, name, image_hash, 'skipped'
+        generate_derivatives(image, image_hash)
+    except (OSError, ValueError):
+        logger.exception("Déclinaisons impossibles pour l'image du produit #%s", product_id)
+        return product_id, name, None, 'error'
+    return product_id, name, image_hash, 'generated'
+
+
+def _save_hashes(changed):
+    """Enregistrer les nouvelles empreintes d'un lot en un seul UPDATE.
+
+    `changed` : (id, nom du fichier, empreinte). Une image remplacée entre-temps
+    garde son empreinte (le nom ne correspond plus).
+    """
+    from .catalog import bump_catalog_version
+    from .models import Product
+
+    if not changed:
+        return
+    Product.objects.filter(pk__in=[pid for pid, _, _ in changed]).update(
+        image_hash=Case(
+            *[When(pk=pid, image=name, then=Value(image_hash)) for pid, name, image_hash in changed],
+            default=F('image_hash'),
+            output_field=CharField(),
+        )
+    )
+    bump_catalog_version()
+
+
+def products_with_images(after_id=0):
+    from .models import Product
+    return Product.objects.exclude(image='').exclude(image__isnull=True).filter(pk__gt=after_id)
+
+
+def regenerate_derivatives(workers=None, after_id=0, chunk_size=None):
+    """Créer les déclinaisons manquantes de toutes les images produit, par ordre d'id.
+
+    Les images sont réparties entre `workers` processus (un par cœur par
+    défaut ; 1 = dans le processus courant). Une image dont l'empreinte est
+    inchangée et dont toutes les déclinaisons existent n'est pas décodée.
+    Générateur : produit après chaque lot un dict de progression
+    {'total', 'done', 'generated', 'skipped', 'errors', 'last_id'} ; relancer
+    avec `after_id=last_id` reprend là où le traitement s'est arrêté.
+    """
+    chunk_size = chunk_size or get_config()['CHUNK_SIZE']
+    progress = {
+        'total': products_with_images(after_id).count(),
+        'done': 0, 'generated': 0, 'skipped': 0, 'errors': 0, 'last_id': after_id,
+    }
+    executor = None
+    if workers != 1:
+        # Pas de connexion partagée avec les processus de travail
+        connections.close_all()
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+    try:
+        while True:
+            jobs = list(
+                products_with_images(progress['last_id'])
+                .order_by('pk')
+                .values_list('pk', 'image', 'image_hash')[:chunk_size]
+            )
+            if not jobs:
+                break
+            if executor is None:
+                results = [_process(job) for job in jobs]
+            else:
+                results = list(executor.map(_process, jobs))
+            recorded = {pid: image_hash for pid, _, image_hash in jobs}
+            _save_hashes([
+                (pid, name, image_hash)
+                for pid, name, image_hash, status in results
+                if image_hash and image_hash != recorded[pid]
+            ])
+            for _, _, _, status in results:
+                progress['errors' if status == 'error' else status] += 1
+            progress['done'] += len(jobs)
+            progress['last_id'] = jobs[-1][0]
+            yield dict(progress)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
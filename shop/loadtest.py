@@ -0,0 +1,228 @@
+"""Banc de charge des WebSockets : combien de sockets de chat et de notifications par processus.
+
+`run_load_test` ouvre `users` sockets de notifications et autant de sockets
+de chat (un utilisateur et une commande de test par paire), dans le
+processus courant, avec `WebsocketCommunicator` sur les routes de
+shop/routing.py : les consumers, la base et le channel layer sont les vrais,
+seuls Daphne et l'authentification par session sont court-circuités.
+Ensuite :
+
+- notifications : `messages` envois par utilisateur via `group_send` sur son
+  groupe, comme l'outbox ;
+- chat : `messages` messages par socket, enregistrés en base puis diffusés
+  au groupe de la commande.
+
+Les horodatages voyagent dans les messages : la latence mesurée va de
+l'envoi à la réception par le client. La mémoire par connexion est mesurée
+avec tracemalloc pendant l'ouverture des sockets (client de test compris).
+
+À lancer avec `python manage.py loadtest_channels` ; `--baseline` compare à
+un résultat enregistré et échoue en cas de régression (CI). Le banc écrit
+dans la base configurée (utilisateurs, commandes, messages) : il refuse de
+tourner hors DEBUG sans `allow_db` (`--allow-db`), à réserver à une base
+jetable.
+"""
+import asyncio
+import json
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test.utils import override_settings
+
+from .models import DeliveryLocation, Order
+from .notifications import notification_group
+
+User = get_user_model()
+
+# Préfixe des utilisateurs créés pour le banc, supprimés à la fin
+USERNAME_PREFIX = 'loadtest-'
+LOCATION_NAME = 'Banc de charge'
+
+# Mesures comparées à la référence : plus haut = moins bon
+METRICS = (
+    'connect_p50_ms', 'connect_p99_ms',
+    'notify_p50_ms', 'notify_p99_ms',
+    'chat_p50_ms', 'chat_p99_ms',
+    'memory_per_connection',
+)
+
+
+class UnsafeDatabaseError(Exception):
+    """Banc lancé hors DEBUG sur une base qui n'a pas été déclarée jetable"""
+
+
+def layer_config(layer, redis_url=None):
+    """Réglage CHANNEL_LAYERS['default'] pour `layer` ('inmemory' ou 'redis')"""
+    if layer == 'inmemory':
+        return {'BACKEND': 'channels.layers.InMemoryChannelLayer'}
+    if layer == 'redis':
+        return {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {'hosts': [redis_url or 'redis://localhost:6379']},
+        }
+    raise ValueError(f"Channel layer inconnu : {layer}")
+
+
+def percentile(values, p):
+    """Percentile `p` (0-100) par rang le plus proche, None si `values` est vide"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+
+def compare_results(results, baseline, tolerance):
+    """Régressions de `results` par rapport à `baseline` (liste de messages, vide si tout va bien).
+
+    Une mesure régresse si elle dépasse la référence de plus de `tolerance`
+    (0.25 = 25 %). Un message perdu est toujours une régression.
+    """
+    regressions = []
+    if results['lost']:
+        regressions.append(f"{results['lost']} message(s) perdu(s)")
+    for metric in METRICS:
+        reference, value = baseline.get(metric), results.get(metric)
+        if reference is None or value is None:
+            continue
+        if value > reference * (1 + tolerance):
+            regressions.append(f"{metric} : {value:.2f} (référence {reference:.2f})")
+    return regressions
+
+
+# --- Données de test ---
+def create_fixtures(users):
+    """Créer `users` utilisateurs avec une commande chacun. Renvoie [(user, order_id)]."""
+    delete_fixtures()
+    location = DeliveryLocation.objects.create(name=LOCATION_NAME)
+    User.objects.bulk_create([User(username=f'{USERNAME_PREFIX}{i}') for i in range(users)])
+    # Relus pour avoir les id quelle que soit la base
+    created = list(User.objects.filter(username__startswith=USERNAME_PREFIX).order_by('pk'))
+    # bulk_create : pas de statistiques client ni de notification pour ces commandes
+    orders = Order.objects.bulk_create([
+        Order(user=user, delivery_location=location, total_amount=0, status='pending')
+        for user in created
+    ])
+    return [(user, order.id) for user, order in zip(created, orders)]
+
+
+def delete_fixtures():
+    Order.objects.filter(user__username__startswith=USERNAME_PREFIX).delete()
+    User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+    DeliveryLocation.objects.filter(name=LOCATION_NAME).delete()
+
+
+# --- Banc ---
+def _application():
+    from channels.routing import URLRouter
+
+    from .routing import websocket_urlpatterns
+    return URLRouter(websocket_urlpatterns)
+
+
+async def _open(application, path, user, timeout):
+    from channels.testing import WebsocketCommunicator
+
+    communicator = WebsocketCommunicator(application, path)
+    communicator.scope['user'] = user
+    started = time.perf_counter()
+    connected, _ = await communicator.connect(timeout=timeout)
+    if not connected:
+        raise RuntimeError(f"Connexion refusée : {path}")
+    if path.startswith('/ws/notifications/'):
+        # Le socket n'est prêt qu'après le message de synchronisation
+        await communicator.receive_json_from(timeout=timeout)
+    return communicator, (time.perf_counter() - started) * 1000
+
+
+async def _receive_latencies(communicator, expected, timeout, sent_at):
+    """Latences (ms) des `expected` messages suivants ; le nombre manquant si le délai expire"""
+    latencies = []
+    while len(latencies) < expected:
+        try:
+            data = await communicator.receive_json_from(timeout=timeout)
+        except asyncio.TimeoutError:
+            break
+        stamp = sent_at(data)
+        if stamp is not None:
+            latencies.append((time.perf_counter() - stamp) * 1000)
+    return latencies, expected - len(latencies)
+
+
+async def _run(fixtures, messages, timeout):
+    from channels.layers import get_channel_layer
+
+    application = _application()
+    layer = get_channel_layer()
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    opened = await asyncio.gather(
+        *[_open(application, '/ws/notifications/', user, timeout) for user, _ in fixtures],
+        *[_open(application, f'/ws/orders/{order_id}/', user, timeout) for user, order_id in fixtures],
+    )
+    memory = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    notify_sockets = [c for c, _ in opened[:len(fixtures)]]
+    chat_sockets = [c for c, _ in opened[len(fixtures):]]
+    connect = [ms for _, ms in opened]
+
+    try:
+        # Notifications : la latence inclut l'attente dans la file du channel layer
+        for _ in range(messages):
+            for user, _ in fixtures:
+                await layer.group_send(notification_group(user.id), {
+                    'type': 'notify',
+                    'payload': {'id': 0, 'sent_at': time.perf_counter()},
+                })
+        notify = await asyncio.gather(*[
+            _receive_latencies(c, messages, timeout, lambda data: data.get('sent_at'))
+            for c in notify_sockets
+        ])
+
+        # Chat : écriture en base (regroupée par CHAT_COALESCE_WINDOW) puis diffusion
+        for _ in range(messages):
+            for c in chat_sockets:
+                await c.send_json_to({'message': json.dumps(time.perf_counter())})
+        chat = await asyncio.gather(*[
+            _receive_latencies(c, messages, timeout, lambda data: json.loads(data['message']))
+            for c in chat_sockets
+        ])
+    finally:
+        await asyncio.gather(*[c.disconnect() for c in notify_sockets + chat_sockets])
+
+    notify_ms = [ms for latencies, _ in notify for ms in latencies]
+    chat_ms = [ms for latencies, _ in chat for ms in latencies]
+    return {
+        'sockets': len(opened),
+        'messages': 2 * messages * len(fixtures),
+        'lost': sum(lost for _, lost in notify) + sum(lost for _, lost in chat),
+        'connect_p50_ms': percentile(connect, 50),
+        'connect_p99_ms': percentile(connect, 99),
+        'notify_p50_ms': percentile(notify_ms, 50),
+        'notify_p99_ms': percentile(notify_ms, 99),
+        'chat_p50_ms': percentile(chat_ms, 50),
+        'chat_p99_ms': percentile(chat_ms, 99),
+        'memory_per_connection': memory / len(opened),
+    }
+
+
+def run_load_test(users=100, messages=10, layer='inmemory', redis_url=None, timeout=10.0, allow_db=False):
+    """Ouvrir 2 × `users` sockets, faire circuler les messages et renvoyer les mesures.
+
+    Renvoie un dict : 'sockets', 'messages', 'lost', les percentiles de
+    connexion et de livraison (ms) et 'memory_per_connection' (octets).
+    Les utilisateurs et commandes de test sont supprimés à la fin.
+    `UnsafeDatabaseError` hors DEBUG si `allow_db` n'est pas vrai.
+    """
+    if not (settings.DEBUG or allow_db):
+        raise UnsafeDatabaseError(
+            "Le banc écrit dans la base configurée : DEBUG ou allow_db requis (base jetable uniquement)"
+        )
+    fixtures = create_fixtures(users)
+    try:
+        with override_settings(CHANNEL_LAYERS={'default': layer_config(layer, redis_url)}):
+            return asyncio.run(_run(fixtures, messages, timeout))
+    finally:
+        delete_fixtures()
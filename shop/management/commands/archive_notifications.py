@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from shop.retention import archivable_notifications, archive_notifications, get_config
+
+
+class Command(BaseCommand):
+    help = "Archive (JSONL gzip) puis supprime les notifications lues anciennes, par lots."
+
+    def add_arguments(self, parser):
+        config = get_config()
+        parser.add_argument('--days', type=int, default=config['DAYS'],
+                            help="Ancienneté minimale (jours) des notifications lues à archiver")
+        parser.add_argument('--batch-size', type=int, default=config['BATCH_SIZE'],
+                            help="Lignes archivées et supprimées par transaction")
+        parser.add_argument('--archive-dir', default=config['ARCHIVE_DIR'],
+                            help="Dossier des fichiers d'archive")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Afficher le nombre de notifications concernées sans rien modifier")
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            count = archivable_notifications(options['days']).count()
+            self.stdout.write(f"{count} notification(s) à archiver.")
+            return
+        total, path = archive_notifications(
+            days=options['days'],
+            batch_size=options['batch_size'],
+            archive_dir=options['archive_dir'],
+        )
+        if path is None:
+            self.stdout.write("Aucune notification à archiver.")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"{total} notification(s) archivée(s) dans {path}."))
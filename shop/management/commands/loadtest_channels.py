@@ -0,0 +1,68 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.loadtest import UnsafeDatabaseError, compare_results, run_load_test
+
+
+def _ms(value):
+    return '-' if value is None else f"{value:.2f} ms"
+
+
+class Command(BaseCommand):
+    help = ("Banc de charge des WebSockets : ouvre des sockets de chat et de notifications, "
+            "mesure connexion, latence de livraison et mémoire, et compare à une référence.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100,
+                            help="Utilisateurs simulés (deux sockets chacun)")
+        parser.add_argument('--messages', type=int, default=10,
+                            help="Messages de chat et notifications par utilisateur")
+        parser.add_argument('--layer', choices=['inmemory', 'redis'], default='inmemory')
+        parser.add_argument('--redis-url', help="Redis local pour --layer redis (redis://localhost:6379)")
+        parser.add_argument('--timeout', type=float, default=10.0,
+                            help="Secondes d'attente max d'une connexion ou d'un message")
+        parser.add_argument('--output', help="Enregistrer les mesures (JSON), par ex. comme nouvelle référence")
+        parser.add_argument('--baseline', help="Mesures de référence (JSON) : échec en cas de régression")
+        parser.add_argument('--allow-db', action='store_true',
+                            help="Autoriser l'écriture dans la base configurée hors DEBUG (base jetable uniquement)")
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help="Dépassement toléré de la référence (0.25 = 25 %%)")
+
+    def handle(self, *args, **options):
+        if options['users'] < 1 or options['messages'] < 1:
+            raise CommandError("--users et --messages doivent être au moins 1")
+        try:
+            results = run_load_test(
+                users=options['users'],
+                messages=options['messages'],
+                layer=options['layer'],
+                redis_url=options['redis_url'],
+                timeout=options['timeout'],
+                allow_db=options['allow_db'],
+            )
+        except UnsafeDatabaseError as e:
+            raise CommandError(str(e))
+        results['layer'] = options['layer']
+        self.stdout.write(
+            f"{results['sockets']} socket(s), {results['messages']} message(s), {results['lost']} perdu(s)"
+        )
+        for name, key in (('connexion', 'connect'), ('notifications', 'notify'), ('chat', 'chat')):
+            self.stdout.write(f"{name:>14} : p50 {_ms(results[f'{key}_p50_ms'])}, p99 {_ms(results[f'{key}_p99_ms'])}")
+        self.stdout.write(f"{'mémoire':>14} : {results['memory_per_connection'] / 1024:.1f} Kio par connexion")
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+        if options['baseline']:
+            try:
+                with open(options['baseline']) as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Référence illisible : {e}")
+            regressions = compare_results(results, baseline, options['tolerance'])
+            if regressions:
+                raise CommandError("Régression : " + " ; ".join(regressions))
+            self.stdout.write(self.style.SUCCESS("Pas de régression par rapport à la référence."))
+        elif results['lost']:
+            raise CommandError(f"{results['lost']} message(s) perdu(s)")
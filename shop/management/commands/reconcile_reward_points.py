@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from shop.rewards import reconcile_balances
+
+
+class Command(BaseCommand):
+    help = "Recalcule les soldes de points de fidélité à partir du journal des mouvements, par lots."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help="Soldes recalculés par transaction")
+
+    def handle(self, *args, **options):
+        fixed = reconcile_balances(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f"{fixed} solde(s) corrigé(s)."))
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.images import products_with_images, regenerate_derivatives
+
+
+class Command(BaseCommand):
+    help = ("Crée les déclinaisons manquantes de toutes les images produit (nouvelle largeur, "
+            "nouveau format), réparties sur tous les cœurs.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int,
+                            help="Processus de travail (par défaut un par cœur, 1 = sans sous-processus)")
+        parser.add_argument('--chunk-size', type=int, help="Images traitées entre deux points de reprise")
+        parser.add_argument('--after-id', type=int, default=0,
+                            help="Reprendre après ce produit (valeur affichée à chaque lot)")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Afficher le nombre d'images à examiner sans rien générer")
+
+    def handle(self, *args, **options):
+        if options['workers'] is not None and options['workers'] < 1:
+            raise CommandError("--workers doit être au moins 1")
+        if options['dry_run']:
+            self.stdout.write(f"{products_with_images(options['after_id']).count()} image(s) à examiner.")
+            return
+        progress = None
+        try:
+            for progress in regenerate_derivatives(
+                workers=options['workers'], after_id=options['after_id'], chunk_size=options['chunk_size'],
+            ):
+                self.stdout.write(
+                    f"{progress['done']}/{progress['total']} image(s) : {progress['generated']} générée(s), "
+                    f"{progress['skipped']} inchangée(s), {progress['errors']} en erreur "
+                    f"(--after-id {progress['last_id']})"
+                )
+        except KeyboardInterrupt:
+            last_id = progress['last_id'] if progress else options['after_id']
+            raise CommandError(f"Interrompu : relancer avec --after-id {last_id} pour reprendre.")
+        if progress is None:
+            self.stdout.write("Aucune image à traiter.")
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f"{progress['generated']} image(s) générée(s), {progress['skipped']} inchangée(s), "
+            f"{progress['errors']} en erreur."
+        ))
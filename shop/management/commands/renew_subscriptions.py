@@ -0,0 +1,32 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from shop.subscriptions import due_subscriptions, renew_due_subscriptions
+
+
+class Command(BaseCommand):
+    help = "Crée les commandes des abonnements actifs arrivés à échéance, par lots."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help="Date de référence (AAAA-MM-JJ, par défaut aujourd'hui)")
+        parser.add_argument('--chunk-size', type=int, help="Abonnements traités par transaction")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Afficher le nombre d'abonnements à renouveler sans rien créer")
+
+    def handle(self, *args, **options):
+        today = timezone.localdate()
+        if options['date']:
+            try:
+                today = datetime.date.fromisoformat(options['date'])
+            except ValueError:
+                raise CommandError("Date invalide, format attendu : AAAA-MM-JJ")
+        if options['dry_run']:
+            self.stdout.write(f"{due_subscriptions(today).count()} abonnement(s) à renouveler.")
+            return
+        result = renew_due_subscriptions(today=today, chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"{result['orders']} commande(s) créée(s), {result['waiting']} abonnement(s) en attente de stock, "
+            f"{result['unavailable']} sans produit disponible."
+        ))
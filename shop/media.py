@@ -0,0 +1,138 @@
+"""Fichiers envoyés (MEDIA_ROOT) : noms par empreinte et service avec cache HTTP.
+
+Les images produit sont enregistrées sous `products/<empreinte>.<ext>` : une
+URL désigne toujours le même contenu et peut être mise en cache un an
+(`immutable`), comme les déclinaisons de shop/images.py. Les autres fichiers
+(anciens noms) ont un cache court et sont revalidés par ETag.
+
+`serve_media` sert ces fichiers quand Django/Daphne s'en charge (DEBUG ou
+SERVE_MEDIA) : requêtes conditionnelles (304), plages d'octets (206) et
+`FileResponse`, qui passe par `wsgi.file_wrapper` (sendfile) quand le serveur
+le propose.
+"""
+import hashlib
+import mimetypes
+import os
+import re
+import stat
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+DEFAULTS = {
+    'MAX_AGE': 3600,                 # secondes, fichiers dont le nom ne dépend pas du contenu
+    'IMMUTABLE_MAX_AGE': 31536000,   # secondes, fichiers nommés par empreinte
+}
+
+# Nom par empreinte, éventuellement suffixé par le stockage si le même contenu est renvoyé
+HASHED_NAME_RE = re.compile(r'^products/[0-9a-f]{32}(_[A-Za-z0-9]{7})?\.\w+$')
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'MEDIA_CACHE', {})}
+
+
+def product_image_upload_to(instance, filename):
+    """`products/<SHA-256 tronqué>.<ext>` : le nom change avec le contenu"""
+    digest = hashlib.sha256()
+    for chunk in instance.image.chunks():
+        digest.update(chunk)
+    return f"products/{digest.hexdigest()[:32]}{os.path.splitext(filename)[1].lower()}"
+
+
+def is_immutable(name):
+    """Vrai si le contenu derrière `name` ne peut pas changer"""
+    from .images import get_config as image_config
+    return bool(HASHED_NAME_RE.match(name)) or name.startswith(image_config()['DIR'] + '/')
+
+
+def parse_range(header, size):
+    """(début, fin incluse) d'un en-tête Range à une plage, ou None pour servir tout le fichier"""
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        # bytes=-N : les N derniers octets
+        if int(last) == 0:
+            raise RangeNotSatisfiable
+        return max(size - int(last), 0), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+def _iter_range(f, start, length, block_size=FileResponse.block_size):
+    with f:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(block_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+
+def _add_cache_headers(response, path, etag, st):
+    config = get_config()
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(st.st_mtime)
+    if is_immutable(path):
+        patch_cache_control(response, public=True, max_age=config['IMMUTABLE_MAX_AGE'], immutable=True)
+    else:
+        patch_cache_control(response, public=True, max_age=config['MAX_AGE'])
+
+
+def serve_media(request, path):
+    """Servir un fichier de MEDIA_ROOT avec ETag, Last-Modified, Cache-Control et Range"""
+    fullpath = safe_join(settings.MEDIA_ROOT, path)
+    try:
+        st = os.stat(fullpath)
+    except OSError:
+        raise Http404("Fichier introuvable")
+    if not stat.S_ISREG(st.st_mode):
+        raise Http404("Fichier introuvable")
+
+    # ETag calculé depuis stat() : pas de lecture du fichier
+    etag = f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+    response = get_conditional_response(request, etag=etag, last_modified=int(st.st_mtime))
+    if response is not None:
+        # 304 ou 412
+        _add_cache_headers(response, path, etag, st)
+        return response
+
+    byte_range = None
+    # If-Range : la plage ne vaut que pour la version connue du client
+    if 'Range' in request.headers and request.headers.get('If-Range', etag) == etag:
+        try:
+            byte_range = parse_range(request.headers['Range'], st.st_size)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{st.st_size}'
+            return response
+
+    content_type = mimetypes.guess_type(fullpath)[0] or 'application/octet-stream'
+    f = open(fullpath, 'rb')
+    if byte_range is None:
+        response = FileResponse(f, content_type=content_type)
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            _iter_range(f, start, end - start + 1), status=206, content_type=content_type
+        )
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f'bytes {start}-{end}/{st.st_size}'
+    response['Accept-Ranges'] = 'bytes'
+    _add_cache_headers(response, path, etag, st)
+    return response
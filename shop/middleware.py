@@ -0,0 +1,15 @@
+from .cart import get_cart_storage
+
+
+class CartMiddleware:
+    """Laisse le stockage du panier écrire son cookie dans la réponse"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        # Seulement si le panier a été utilisé pendant cette requête
+        if getattr(request, '_cart_storage', None) is not None:
+            get_cart_storage(request).update_response(response)
+        return response
@@ -0,0 +1,68 @@
+# Generated by Django 6.0 on 2026-10-16 20:39
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_conversation_summaries(apps, schema_editor):
+    """Remplir le dernier message et les non-lus des conversations existantes"""
+    Conversation = apps.get_model('shop', 'Conversation')
+    ConversationReadState = apps.get_model('shop', 'ConversationReadState')
+    Message = apps.get_model('shop', 'Message')
+
+    for conv in Conversation.objects.prefetch_related('participants').iterator(chunk_size=500):
+        last = Message.objects.filter(conversation=conv).order_by('-created_at', '-id').first()
+        if last is not None:
+            conv.last_message = last
+            conv.last_message_at = last.created_at
+            conv.save(update_fields=['last_message', 'last_message_at'])
+
+        unread_by_sender = dict(
+            Message.objects.filter(conversation=conv, read=False)
+            .values_list('sender').annotate(n=Count('id')).order_by()
+        )
+        total = sum(unread_by_sender.values())
+        ConversationReadState.objects.bulk_create([
+            ConversationReadState(
+                conversation=conv,
+                user=participant,
+                unread_count=total - unread_by_sender.get(participant.id, 0),
+            )
+            for participant in conv.participants.all()
+        ], ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0003_order_assigned_to_conversation_message_notification_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='shop.message'),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='ConversationReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='shop.conversation')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_read_states', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('conversation', 'user'), name='unique_conversation_read_state')],
+            },
+        ),
+        migrations.RunPython(backfill_conversation_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 6.0 on 2026-10-16 20:55
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Q, Sum
+
+
+def backfill_order_stats(apps, schema_editor):
+    """Calculer les statistiques de commandes des profils existants"""
+    Order = apps.get_model('shop', 'Order')
+    UserProfile = apps.get_model('shop', 'UserProfile')
+
+    stats = (
+        Order.objects.filter(user__isnull=False)
+        .values('user_id')
+        .annotate(
+            n=Count('id'),
+            spent=Sum('total_amount', filter=Q(status='delivered')),
+            last=Max('created_at'),
+        )
+        .order_by()
+    )
+    for row in stats.iterator(chunk_size=500):
+        UserProfile.objects.filter(user_id=row['user_id']).update(
+            order_count=row['n'],
+            lifetime_spend=row['spent'] or 0,
+            last_order_at=row['last'],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0005_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='last_order_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Dernière commande'),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='lifetime_spend',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='Total dépensé (XOF)'),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='order_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Nombre de commandes'),
+        ),
+        migrations.RunPython(backfill_order_stats, migrations.RunPython.noop),
+    ]
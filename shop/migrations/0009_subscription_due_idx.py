@@ -0,0 +1,17 @@
+# Generated by Django 6.0 on 2026-10-16 21:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0007_notification_coalescing'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(fields=['status', 'next_delivery'], name='subscription_due_idx'),
+        ),
+    ]
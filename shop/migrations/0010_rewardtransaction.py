@@ -0,0 +1,48 @@
+# Generated by Django 6.0 on 2026-10-16 22:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_ledger(apps, schema_editor):
+    """Reprendre les soldes existants dans le journal, pour que la réconciliation les retrouve"""
+    RewardPoint = apps.get_model('shop', 'RewardPoint')
+    RewardTransaction = apps.get_model('shop', 'RewardTransaction')
+    balances = RewardPoint.objects.exclude(points=0, total_earned=0).values_list('user_id', 'points', 'total_earned')
+    transactions = []
+    for user_id, points, earned in balances.iterator(chunk_size=1000):
+        if earned:
+            transactions.append(RewardTransaction(user_id=user_id, kind='earn', points=earned))
+        if points - earned:
+            transactions.append(RewardTransaction(user_id=user_id, kind='adjust', points=points - earned))
+    RewardTransaction.objects.bulk_create(transactions, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0009_subscription_due_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RewardTransaction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('earn', 'Gain (commande livrée)'), ('reversal', 'Annulation de gain'), ('redeem', 'Utilisation'), ('adjust', 'Ajustement')], max_length=20, verbose_name='Type')),
+                ('points', models.IntegerField(verbose_name='Points')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='reward_transactions', to='shop.order', verbose_name='Commande')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reward_transactions', to=settings.AUTH_USER_MODEL, verbose_name='Utilisateur')),
+            ],
+            options={
+                'verbose_name': 'Mouvement de points',
+                'verbose_name_plural': 'Mouvements de points',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['user', '-created_at'], name='reward_tx_user_created_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_ledger, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 6.0 on 2026-10-16 23:40
+
+from django.db import migrations, models
+
+import shop.media
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0011_product_image_hash'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='product',
+            name='image',
+            field=models.ImageField(blank=True, null=True, upload_to=shop.media.product_image_upload_to, verbose_name='Image'),
+        ),
+    ]
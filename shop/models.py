@@ -1,12 +1,18 @@
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 from django.contrib.auth.models import User
 
+from .media import product_image_upload_to
+
 class Product(models.Model):
     """Modèle pour les produits (croquettes)"""
     name = models.CharField(max_length=200, verbose_name="Nom")
     description = models.TextField(verbose_name="Description")
     price = models.DecimalField(max_digits=10, decimal_places=2, verbose_name="Prix (XOF)")
-    image = models.ImageField(upload_to='products/', blank=True, null=True, verbose_name="Image")
+    # Nom par empreinte du contenu : URL mise en cache sans limite (voir shop/media.py)
+    image = models.ImageField(upload_to=product_image_upload_to, blank=True, null=True, verbose_name="Image")
+    # Empreinte de l'image dont les déclinaisons redimensionnées existent (voir shop/images.py)
+    image_hash = models.CharField(max_length=64, blank=True, editable=False)
     stock = models.IntegerField(default=0, verbose_name="Stock disponible")
     is_active = models.BooleanField(default=True, verbose_name="Actif")
     created_at = models.DateTimeField(auto_now_add=True)
@@ -19,6 +25,25 @@ class Product(models.Model):
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Image au chargement : product_changed ne régénère les déclinaisons que si elle change
+        if 'image' not in instance.get_deferred_fields():
+            instance._loaded_image_name = instance.image.name
+        return instance
+
+    def image_needs_derivatives(self):
+        if not self.image:
+            return False
+        return not self.image_hash or self.image.name != getattr(self, '_loaded_image_name', None)
+
+    @property
+    def image_sources(self):
+        """Déclinaisons redimensionnées pour <picture> (None tant qu'elles ne sont pas prêtes)"""
+        from .images import image_sources
+        return image_sources(self.image_hash)
+
 
 class DeliveryLocation(models.Model):
     """Lieux de livraison (ajoutés par l'admin)"""
@@ -35,6 +60,53 @@ class DeliveryLocation(models.Model):
         return self.name
 
 
+class OrderQuerySet(models.QuerySet):
+    def _lock_status_changes(self, new_status):
+        """Commandes du queryset dont le statut va changer (verrouillées jusqu'au commit)"""
+        return list(
+            self.select_for_update()
+            .exclude(status=new_status)
+            .order_by('pk')
+            .values('id', 'status', 'user_id', 'assigned_to_id', 'total_amount')
+        )
+
+    def update(self, **kwargs):
+        """update() qui enregistre aussi l'historique et les notifications quand le statut change,
+        et prévient les sockets de chat quand l'assignation change"""
+        new_status = kwargs.get('status')
+        tracks_status = isinstance(new_status, str)
+        reassigns = 'assigned_to' in kwargs or 'assigned_to_id' in kwargs
+        if not tracks_status and not reassigns:
+            return super().update(**kwargs)
+        from .chat import publish_access_changed
+
+        with transaction.atomic(using=self.db):
+            changed = self._lock_status_changes(new_status) if tracks_status else []
+            order_ids = list(self.values_list('pk', flat=True)) if reassigns else []
+            updated = super().update(**kwargs)
+            record_status_changes(changed, new_status)
+            publish_access_changed(order_ids)
+        return updated
+
+    def transition_status(self, new_status, changed_by=None):
+        """Passer toutes les commandes du queryset à `new_status`.
+
+        Nombre de requêtes fixe quel que soit le nombre de commandes : un
+        SELECT, un UPDATE, un INSERT groupé pour l'historique et un pour les
+        notifications (publiées en un lot après le commit). Renvoie le nombre
+        de commandes dont le statut a changé.
+        """
+        with transaction.atomic(using=self.db):
+            changed = self._lock_status_changes(new_status)
+            if changed:
+                # _base_manager : UPDATE simple, l'historique est écrit juste après
+                self.model._base_manager.using(self.db).filter(
+                    pk__in=[o['id'] for o in changed]
+                ).update(status=new_status, updated_at=timezone.now())
+                record_status_changes(changed, new_status, changed_by=changed_by)
+        return len(changed)
+
+
 class Order(models.Model):
     """Commandes (clients connectés ou invités)"""
     STATUS_CHOICES = [
@@ -69,17 +141,58 @@ class Order(models.Model):
     notes = models.TextField(blank=True, verbose_name="Notes")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Date de commande")
     updated_at = models.DateTimeField(auto_now=True)
+
+    objects = OrderQuerySet.as_manager()
+
+    # Valeurs d'origine gardées sur l'instance pour détecter les changements
+    # sans relire la ligne (voir order_status_change)
+    TRACKED_FIELDS = ('status', 'assigned_to_id')
     
     class Meta:
         verbose_name = "Commande"
         verbose_name_plural = "Commandes"
         ordering = ['-created_at']
+        indexes = [
+            # Historique client (profil, mes commandes)
+            models.Index(fields=['user', '-created_at', '-id'], name='order_user_created_idx'),
+            # Liste staff : commandes assignées, filtrées par statut
+            models.Index(fields=['assigned_to', 'status', '-created_at', '-id'], name='order_assignee_status_idx'),
+            # Liste superuser filtrée par statut
+            models.Index(fields=['status', '-created_at', '-id'], name='order_status_created_idx'),
+        ]
     
     def __str__(self):
         if self.user:
             return f"Commande #{self.id} - {self.user.username}"
         return f"Commande #{self.id} - {self.guest_name} (invité)"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.snapshot_tracked_fields()
+        return instance
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self.snapshot_tracked_fields()
+
+    def snapshot_tracked_fields(self):
+        """Mémoriser la valeur actuelle des champs suivis (hors champs différés)"""
+        deferred = self.get_deferred_fields()
+        self._original_values = {
+            name: getattr(self, name)
+            for name in self.TRACKED_FIELDS
+            if name not in deferred
+        }
+
+    def get_original(self, name, default=None):
+        """Valeur du champ suivi `name` lors du chargement (ou du dernier save)"""
+        return getattr(self, '_original_values', {}).get(name, default)
+
+    def has_changed(self, name):
+        original = getattr(self, '_original_values', {})
+        return name in original and original[name] != getattr(self, name)
+
 
 class OrderItem(models.Model):
     """Articles dans une commande"""
@@ -124,6 +237,10 @@ class Subscription(models.Model):
     class Meta:
         verbose_name = "Abonnement"
         verbose_name_plural = "Abonnements"
+        indexes = [
+            # Renouvellement : abonnements actifs arrivés à échéance (voir shop/subscriptions.py)
+            models.Index(fields=['status', 'next_delivery'], name='subscription_due_idx'),
+        ]
     
     def __str__(self):
         return f"Abonnement de {self.user.username} - {self.get_frequency_display()}"
@@ -143,12 +260,48 @@ class RewardPoint(models.Model):
     def __str__(self):
         return f"{self.user.username} - {self.points} points"
 
+
+class RewardTransaction(models.Model):
+    """Mouvement de points de fidélité (journal en ajout seul).
+
+    Le solde `RewardPoint` est la somme des mouvements de l'utilisateur ; il est
+    tenu à jour par incréments (voir shop/rewards.py) et recalculable à partir
+    du journal.
+    """
+    KIND_CHOICES = [
+        ('earn', 'Gain (commande livrée)'),
+        ('reversal', 'Annulation de gain'),
+        ('redeem', 'Utilisation'),
+        ('adjust', 'Ajustement'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='reward_transactions', verbose_name="Utilisateur")
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True, related_name='reward_transactions', verbose_name="Commande")
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES, verbose_name="Type")
+    points = models.IntegerField(verbose_name="Points")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Mouvement de points"
+        verbose_name_plural = "Mouvements de points"
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='reward_tx_user_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} : {self.points:+d} ({self.get_kind_display()})"
+
 class UserProfile(models.Model):
     """Profil utilisateur étendu"""
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     phone = models.CharField(max_length=20, blank=True, verbose_name="Téléphone")
     address = models.TextField(blank=True, verbose_name="Adresse")
     created_at = models.DateTimeField(auto_now_add=True)
+    # Statistiques dénormalisées pour l'en-tête du profil (voir shop/customers.py)
+    order_count = models.PositiveIntegerField(default=0, verbose_name="Nombre de commandes")
+    lifetime_spend = models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name="Total dépensé (XOF)")
+    last_order_at = models.DateTimeField(null=True, blank=True, verbose_name="Dernière commande")
     
     class Meta:
         verbose_name = "Profil utilisateur"
@@ -159,7 +312,7 @@ class UserProfile(models.Model):
 
 
 # Signal pour créer automatiquement un profil et des points lors de l'inscription
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
 @receiver(post_save, sender=User)
@@ -176,6 +329,27 @@ def save_user_profile(sender, instance, **kwargs):
         instance.profile.save()
 
 
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def product_changed(sender, instance, **kwargs):
+    """Toute modification d'un produit invalide les pages du catalogue en cache"""
+    from .catalog import bump_catalog_version_on_commit
+    bump_catalog_version_on_commit()
+
+
+@receiver(post_save, sender=Product)
+def product_image_changed(sender, instance, **kwargs):
+    """Nouvelle image : générer ses déclinaisons en arrière-plan après le commit"""
+    if instance.image_needs_derivatives():
+        from .images import schedule_refresh
+        product_id = instance.pk
+        transaction.on_commit(lambda: schedule_refresh(product_id))
+        instance._loaded_image_name = instance.image.name
+    elif not instance.image and instance.image_hash:
+        Product.objects.filter(pk=instance.pk).update(image_hash='')
+        instance.image_hash = ''
+
+
 # --- Notifications / Chat / Historique des statuts ---
 class Notification(models.Model):
     """Notifications pour utilisateurs (site only)."""
@@ -183,10 +357,21 @@ class Notification(models.Model):
     verb = models.CharField(max_length=255, verbose_name='Action')
     url = models.CharField(max_length=255, blank=True, verbose_name='Lien relatif')
     unread = models.BooleanField(default=True)
+    # Notifications identiques regroupées (voir notifications.notify_coalesced)
+    count = models.PositiveIntegerField(default=1, verbose_name='Occurrences')
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(default=timezone.now, verbose_name='Dernière occurrence')
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['recipient', '-created_at'], name='notif_recipient_created_idx'),
+            # Page des notifications (les regroupées remontent à chaque occurrence) et
+            # rattrapage après reconnexion : (updated_at, id) après le curseur du client
+            models.Index(fields=['recipient', '-updated_at'], name='notif_recipient_updated_idx'),
+            # Index partiel : seules les notifications non lues, pour le compteur du menu
+            models.Index(fields=['recipient'], condition=models.Q(unread=True), name='notif_unread_idx'),
+        ]
 
     def __str__(self):
         return f"Notification pour {self.recipient.username} - {self.verb}"
@@ -213,11 +398,29 @@ class Conversation(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='conversations')
     participants = models.ManyToManyField(User, related_name='conversations')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Résumé dénormalisé, mis à jour à chaque nouveau message (voir shop/chat.py)
+    last_message = models.ForeignKey('Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_message_at = models.DateTimeField(null=True, blank=True, db_index=True)
 
     def __str__(self):
         return f"Conversation #{self.id} (Order #{self.order.id})"
 
 
+class ConversationReadState(models.Model):
+    """Nombre de messages non lus d'une conversation, pour un participant."""
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='read_states')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='conversation_read_states')
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'user'], name='unique_conversation_read_state'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - Conversation #{self.conversation_id}: {self.unread_count} non lu(s)"
+
+
 class Message(models.Model):
     """Message d'une conversation."""
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages')
@@ -228,84 +431,153 @@ class Message(models.Model):
 
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            # Non-lus d'une conversation par expéditeur. Index partiel plutôt que
+            # (conversation, read, sender) : Django écrit `read=False` sous la forme
+            # `NOT read`, que SQLite ne sait pas utiliser comme colonne d'index.
+            models.Index(fields=['conversation', 'sender'], condition=models.Q(read=False), name='message_unread_idx'),
+            models.Index(fields=['conversation', 'created_at'], name='message_conv_created_idx'),
+        ]
 
     def __str__(self):
         return f"Message #{self.id} by {self.sender.username}"
 
 
 # Signals pour notifications et historique de statut
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import m2m_changed, post_save
 
 @receiver(post_save, sender=Order)
 def order_post_save(sender, instance, created, **kwargs):
     # Nouvelle commande : notifier les admin (is_staff=True) et l'utilisateur
     if created:
-        admins = User.objects.filter(is_staff=True)
-        for admin in admins:
-            Notification.objects.create(
-                recipient=admin,
+        from .customers import record_new_order
+        from .notifications import dispatch
+
+        # Un seul INSERT pour tous les destinataires, quel que soit le nombre d'admins
+        admin_ids = User.objects.filter(is_staff=True).values_list('id', flat=True)
+        notifications = [
+            Notification(
+                recipient_id=admin_id,
                 verb=f"Nouvelle commande #{instance.id}",
                 url=f"/admin/shop/order/{instance.id}/change/"
             )
-        if instance.user:
-            Notification.objects.create(
-                recipient=instance.user,
+            for admin_id in admin_ids
+        ]
+        if instance.user_id:
+            notifications.append(Notification(
+                recipient_id=instance.user_id,
                 verb=f"Votre commande #{instance.id} a été passée.",
                 url=f"/commande/{instance.id}/"
-            )
+            ))
+            record_new_order(instance)
+        dispatch(notifications)
 
 
 # Lorsqu'une Notification est créée, on envoie aussi un push via Channels au destinataire
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
-
 @receiver(post_save, sender=Notification)
 def notification_post_save(sender, instance, created, **kwargs):
+    from . import counters, outbox
+    from .notifications import notification_event, notification_group
+
+    if not created:
+        # Peut avoir été marquée comme lue : le compteur sera recalculé
+        counters.invalidate(counters.NOTIFICATIONS, [instance.recipient_id])
+        return
+    counters.increment(counters.NOTIFICATIONS, [instance.recipient_id])
+    outbox.enqueue(notification_group(instance.recipient_id), notification_event(instance))
+
+
+@receiver(post_save, sender=Message)
+def message_post_save(sender, instance, created, **kwargs):
+    # Nouveau message : résumé de la conversation et +1 non lu pour les autres participants
     if not created:
         return
-    channel_layer = get_channel_layer()
-    group = f"notifications_{instance.recipient.id}"
-    payload = {
-        'id': instance.id,
-        'verb': instance.verb,
-        'url': instance.url,
-        'created_at': instance.created_at.isoformat(),
-    }
-    try:
-        async_to_sync(channel_layer.group_send)(group, {
-            'type': 'notify',
-            'payload': payload,
-        })
-    except Exception:
-        # Ne pas planter si Channel layer n'est pas disponible (dev without Redis)
-        pass
-
-@receiver(pre_save, sender=Order)
-def order_status_change(sender, instance, **kwargs):
-    # Si la commande existe déjà, on détecte changement de statut
-    if not instance.pk:
+    from . import counters
+    from .chat import record_new_message
+
+    recipient_ids = list(
+        instance.conversation.participants
+        .exclude(pk=instance.sender_id)
+        .values_list('id', flat=True)
+    )
+    record_new_message(instance, recipient_ids)
+    counters.increment(counters.MESSAGES, recipient_ids)
+
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def conversation_participants_added(sender, instance, action, reverse, pk_set, **kwargs):
+    # Nouveau participant : son résumé de non-lus existe dès l'ajout
+    if action != 'post_add' or not pk_set:
         return
-    try:
-        old = Order.objects.get(pk=instance.pk)
-    except Order.DoesNotExist:
+    from .chat import add_read_states
+
+    if reverse:
+        # user.conversations.add(...) : `instance` est l'utilisateur
+        for conversation_id in pk_set:
+            add_read_states(conversation_id, [instance.pk])
+    else:
+        add_read_states(instance.pk, pk_set)
+
+
+def record_status_changes(orders, new_status, changed_by=None):
+    """Historique + notifications pour des commandes passées à `new_status`.
+
+    `orders` : dicts avec 'id', 'status' (ancien statut), 'user_id',
+    'assigned_to_id' et 'total_amount'. Un INSERT groupé pour l'historique,
+    un autre pour les notifications, quel que soit le nombre de commandes.
+    Le stock des commandes annulées est rendu (voir `record_status_stock`).
+    """
+    from .customers import record_status_spend
+    from .notifications import dispatch
+    from .orders import record_status_stock
+    from .rewards import record_status_points
+
+    orders = [o for o in orders if o['status'] != new_status]
+    if not orders:
         return
-    if old.status != instance.status:
-        OrderStatusHistory.objects.create(
-            order=instance,
-            old_status=old.status,
-            new_status=instance.status,
-            changed_by=None
+    # En premier : une commande rétablie sans stock suffisant lève OutOfStockError
+    record_status_stock(orders, new_status)
+    OrderStatusHistory.objects.bulk_create([
+        OrderStatusHistory(
+            order_id=o['id'],
+            old_status=o['status'],
+            new_status=new_status,
+            changed_by=changed_by
         )
-        # Notifications côté client et admin assigné
-        if instance.user:
-            Notification.objects.create(
-                recipient=instance.user,
-                verb=f"Le statut de votre commande #{instance.id} est passé de {old.status} à {instance.status}.",
-                url=f"/commande/{instance.id}/"
-            )
-        if instance.assigned_to:
-            Notification.objects.create(
-                recipient=instance.assigned_to,
-                verb=f"Le statut de la commande #{instance.id} a changé: {instance.status}.",
-                url=f"/admin/shop/order/{instance.id}/change/"
-            )
+        for o in orders
+    ])
+    # Notifications côté client et admin assigné
+    notifications = []
+    for o in orders:
+        if o['user_id']:
+            notifications.append(Notification(
+                recipient_id=o['user_id'],
+                verb=f"Le statut de votre commande #{o['id']} est passé de {o['status']} à {new_status}.",
+                url=f"/commande/{o['id']}/"
+            ))
+        if o['assigned_to_id']:
+            notifications.append(Notification(
+                recipient_id=o['assigned_to_id'],
+                verb=f"Le statut de la commande #{o['id']} a changé: {new_status}.",
+                url=f"/admin/shop/order/{o['id']}/change/"
+            ))
+    dispatch(notifications)
+    record_status_spend(orders, new_status)
+    record_status_points(orders, new_status)
+
+
+@receiver(post_save, sender=Order)
+def order_status_change(sender, instance, created, **kwargs):
+    # Changement de statut détecté grâce aux valeurs d'origine gardées sur l'instance.
+    # Les vues peuvent indiquer l'auteur du changement via `instance.status_changed_by`.
+    if not created and instance.has_changed('assigned_to_id'):
+        from .chat import publish_access_changed
+        publish_access_changed([instance.id])
+    if not created and instance.has_changed('status'):
+        record_status_changes([{
+            'id': instance.id,
+            'status': instance.get_original('status'),
+            'user_id': instance.user_id,
+            'assigned_to_id': instance.assigned_to_id,
+            'total_amount': instance.total_amount,
+        }], instance.status, changed_by=getattr(instance, 'status_changed_by', None))
+    instance.snapshot_tracked_fields()
@@ -0,0 +1,176 @@
+"""Envoi des notifications : insertion groupée + push temps réel via Channels."""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import counters, outbox
+from .models import Notification
+from .pagination import decode_cursor, encode_cursor, keyset_paginate
+
+# Ordre de synchronisation : une notification regroupée (mise à jour sur
+# place par `notify_coalesced`) change d'`updated_at` et repasse après le
+# curseur du client
+SYNC_ORDERING = ('updated_at', 'id')
+
+
+def notification_group(user_id):
+    """Nom du groupe Channels des notifications d'un utilisateur"""
+    return f"notifications_{user_id}"
+
+
+def notification_payload(notification, coalesced=False):
+    """Représentation JSON d'une notification envoyée au client (push ou rattrapage).
+
+    `coalesced` : la notification existait déjà (non lue) et a seulement été
+    mise à jour ; le client la remplace au lieu d'en ajouter une.
+    """
+    return {
+        'id': notification.id,
+        'verb': notification.verb,
+        'url': notification.url,
+        'unread': notification.unread,
+        'count': notification.count,
+        'coalesced': coalesced,
+        'created_at': notification.created_at.isoformat(),
+        'updated_at': notification.updated_at.isoformat(),
+        'cursor': sync_cursor(notification),
+    }
+
+
+def sync_cursor(notification=None):
+    """Curseur de synchronisation juste après `notification` (avant toutes si None)"""
+    if notification is None:
+        return encode_cursor([datetime(1970, 1, 1, tzinfo=dt_timezone.utc), 0])
+    return encode_cursor([notification.updated_at, notification.id])
+
+
+def notification_event(notification, coalesced=False):
+    """Message Channels envoyé au NotificationsConsumer pour une notification"""
+    return {'type': 'notify', 'payload': notification_payload(notification, coalesced)}
+
+
+def notifications_since(user_id, cursor, limit=100):
+    """Notifications de `user_id` créées ou regroupées après `cursor`, dans l'ordre (updated_at, id).
+
+    Renvoie (payloads, curseur suivant, reste-t-il des notifications) ; au
+    plus `limit` notifications, le client redemande à partir du curseur
+    renvoyé. Une notification créée avant `cursor` et regroupée depuis est
+    marquée `coalesced` : le client la remplace sans recompter. `ValueError`
+    si le curseur est invalide.
+    """
+    since = decode_cursor(cursor, Notification, SYNC_ORDERING)
+    if since is None:
+        raise ValueError("Curseur de synchronisation invalide")
+    page = keyset_paginate(
+        Notification.objects.filter(recipient_id=user_id), cursor, per_page=limit, ordering=SYNC_ORDERING
+    )
+    payloads = [notification_payload(n, coalesced=n.created_at <= since[0]) for n in page]
+    next_cursor = sync_cursor(page.items[-1]) if page.items else cursor
+    return payloads, next_cursor, page.has_next
+
+
+def latest_sync_cursor(user_id):
+    """Curseur après la dernière notification créée ou regroupée de `user_id`"""
+    return sync_cursor(
+        Notification.objects.filter(recipient_id=user_id)
+        .order_by('-updated_at', '-id').only('id', 'updated_at').first()
+    )
+
+
+def coalesce_window():
+    """Fenêtre (secondes) pendant laquelle les notifications identiques sont regroupées"""
+    return getattr(settings, 'NOTIFICATION_COALESCE_WINDOW', 300)
+
+
+def dispatch(notifications):
+    """Enregistrer des notifications avec un seul INSERT et les pousser après le commit.
+
+    `bulk_create` ne déclenche pas `post_save` : le push est confié ici à
+    l'outbox, en un seul lot.
+    """
+    notifications = Notification.objects.bulk_create(notifications)
+    events = [
+        (notification_group(n.recipient_id), notification_event(n))
+        for n in notifications
+        if n.pk is not None
+    ]
+    counters.increment(counters.NOTIFICATIONS, [n.recipient_id for n in notifications])
+    outbox.enqueue_many(events)
+    return notifications
+
+
+def mark_read(user_id, ids=None):
+    """Marquer lues des notifications de `user_id` (toutes si `ids` vaut None).
+
+    Un seul UPDATE conditionnel (`WHERE unread`), sans `post_save` : le
+    compteur de non-lus est diminué du nombre de lignes réellement modifiées,
+    sans recomptage. Renvoie ce nombre.
+    """
+    queryset = Notification.objects.filter(recipient_id=user_id, unread=True)
+    if ids is not None:
+        queryset = queryset.filter(id__in=ids)
+    marked = queryset.update(unread=False)
+    if marked:
+        counters.increment(counters.NOTIFICATIONS, [user_id], delta=-marked)
+    return marked
+
+
+def notify(recipient_ids, verb, url=''):
+    """Notifier plusieurs utilisateurs (ids) avec le même message"""
+    return dispatch([
+        Notification(recipient_id=recipient_id, verb=verb, url=url)
+        for recipient_id in dict.fromkeys(recipient_ids)
+    ])
+
+
+def notify_coalesced(recipient_ids, verb, url):
+    """Comme `notify`, en regroupant avec la notification récente de même lien.
+
+    Pour chaque destinataire ayant déjà une notification non lue vers `url`
+    mise à jour dans la fenêtre `NOTIFICATION_COALESCE_WINDOW`, celle-ci est
+    mise à jour (compteur +1, libellé et date) au lieu d'en créer une autre ;
+    un seul UPDATE pour tous ces destinataires. Les autres reçoivent une
+    nouvelle notification (un INSERT groupé).
+    """
+    recipient_ids = list(dict.fromkeys(recipient_ids))
+    window = coalesce_window()
+    if not window or not url or not recipient_ids:
+        return notify(recipient_ids, verb, url=url)
+    now = timezone.now()
+    with transaction.atomic():
+        candidates = (
+            Notification.objects.select_for_update()
+            .filter(
+                recipient_id__in=recipient_ids,
+                url=url,
+                unread=True,
+                updated_at__gte=now - timedelta(seconds=window),
+            )
+            .order_by('-updated_at', '-id')
+            .values('id', 'recipient_id', 'count', 'created_at')
+        )
+        # La plus récente par destinataire
+        latest = {}
+        for row in candidates:
+            latest.setdefault(row['recipient_id'], row)
+        coalesced = [
+            Notification(
+                id=row['id'], recipient_id=row['recipient_id'], verb=verb, url=url,
+                count=row['count'] + 1, created_at=row['created_at'], updated_at=now,
+            )
+            for row in latest.values()
+        ]
+        if coalesced:
+            Notification.objects.filter(pk__in=[n.id for n in coalesced]).update(
+                count=F('count') + 1, verb=verb, updated_at=now,
+            )
+            # Déjà non lues : pas de changement des compteurs, seulement le push
+            outbox.enqueue_many([
+                (notification_group(n.recipient_id), notification_event(n, coalesced=True))
+                for n in coalesced
+            ])
+        created = notify([r for r in recipient_ids if r not in latest], verb, url=url)
+    return coalesced + created
@@ -0,0 +1,133 @@
+"""Passage de commande : une seule transaction, réservation du stock, insertion groupée.
+
+Le stock réservé est rendu quand la commande est annulée (`record_status_stock`).
+"""
+from collections import Counter
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Sum, Value, When
+
+from . import rewards
+from .catalog import bump_catalog_version_on_commit
+from .models import Order, OrderItem, Product
+
+CANCELLED_STATUS = 'cancelled'
+
+
+class OutOfStockError(Exception):
+    """Stock insuffisant pour un produit du panier"""
+
+    def __init__(self, product, requested):
+        # `product` vaut None si le produit a été supprimé entre-temps
+        self.product = product
+        self.requested = requested
+        name = product.name if product is not None else "un produit retiré du catalogue"
+        super().__init__(f"Stock insuffisant pour {name} ({requested} demandé(s))")
+
+
+class EmptyOrderError(Exception):
+    """Aucun article à commander (panier vide ou produits retirés du catalogue)"""
+
+
+def reserve_stock(quantities):
+    """Décrémenter le stock de plusieurs produits, ou aucun.
+
+    `quantities` : {product_id: quantité}. Chaque décrément est un
+    `UPDATE ... WHERE stock >= n` : deux commandes concurrentes ne peuvent
+    pas vendre la même unité. Les produits sont traités dans l'ordre de leur
+    id pour que deux transactions ne se bloquent pas mutuellement. Doit être
+    appelé dans une transaction.
+    """
+    for product_id in sorted(quantities):
+        quantity = quantities[product_id]
+        updated = Product.objects.filter(pk=product_id, stock__gte=quantity).update(stock=F('stock') - quantity)
+        if not updated:
+            raise OutOfStockError(Product.objects.filter(pk=product_id).first(), quantity)
+    # update() ne passe pas par post_save : le stock affiché au catalogue a changé
+    bump_catalog_version_on_commit()
+
+
+def release_stock(quantities):
+    """Remettre en stock {product_id: quantité} en un seul UPDATE (pendant de `reserve_stock`)"""
+    quantities = {product_id: n for product_id, n in quantities.items() if n}
+    if not quantities:
+        return
+    Product.objects.filter(pk__in=quantities).update(stock=F('stock') + Case(
+        *[When(pk=product_id, then=Value(n)) for product_id, n in quantities.items()],
+        default=Value(0),
+        output_field=IntegerField(),
+    ))
+    bump_catalog_version_on_commit()
+
+
+def ordered_quantities(order_ids):
+    """{product_id: quantité} des articles des commandes `order_ids`, regroupés par produit"""
+    if not order_ids:
+        return {}
+    rows = (
+        OrderItem.objects.filter(order_id__in=order_ids)
+        .values('product_id')
+        .annotate(quantity=Sum('quantity'))
+        .order_by()
+    )
+    return {row['product_id']: row['quantity'] for row in rows}
+
+
+def record_status_stock(orders, new_status):
+    """Stock après un changement de statut. `orders` : dicts avec 'id' et 'status' (ancien statut).
+
+    Passage à "annulée" : les articles reviennent en stock. Sortie de
+    "annulée" : ils sont réservés de nouveau, ou `OutOfStockError` si le stock
+    ne suffit plus (l'appelant annule alors sa transaction, statut compris).
+    """
+    if new_status == CANCELLED_STATUS:
+        release_stock(ordered_quantities([o['id'] for o in orders if o['status'] != CANCELLED_STATUS]))
+        return
+    reopened = [o['id'] for o in orders if o['status'] == CANCELLED_STATUS]
+    if reopened:
+        with transaction.atomic():
+            reserve_stock(ordered_quantities(reopened))
+
+
+def place_order(items, *, user=None, delivery_location, guest_name='', guest_email='', guest_phone='', notes='',
+                redeem_points=False):
+    """Créer une commande à partir des articles du panier.
+
+    `items` : dicts avec 'product', 'quantity' et 'price' (ce que renvoie
+    l'itération sur `Cart`). Tout est fait dans une transaction : si un
+    produit manque, rien n'est écrit et `OutOfStockError` est levée ; sans
+    article, `EmptyOrderError`.
+    `redeem_points` : utiliser des points de fidélité pour une réduction
+    (`InsufficientPointsError` si le solde ne suffit pas).
+    """
+    items = list(items)
+    if not items:
+        raise EmptyOrderError("Aucun article à commander")
+    quantities = Counter()
+    for item in items:
+        quantities[item['product'].id] += item['quantity']
+    total = sum(item['price'] * item['quantity'] for item in items)
+
+    with transaction.atomic():
+        if redeem_points:
+            rewards.redeem_discount(user.id)
+            total -= (total * rewards.DISCOUNT_RATE).quantize(Decimal('0.01'))
+        reserve_stock(quantities)
+        order = Order.objects.create(
+            user=user,
+            guest_name=guest_name,
+            guest_email=guest_email,
+            guest_phone=guest_phone,
+            delivery_location=delivery_location,
+            total_amount=total,
+            notes=notes,
+            status='pending'
+        )
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=item['product'], quantity=item['quantity'], price=item['price'])
+            for item in items
+        ])
+        if redeem_points:
+            rewards.record_redemption(order)
+    return order
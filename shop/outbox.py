@@ -0,0 +1,227 @@
+"""Outbox des événements Channels.
+
+Les événements sont enregistrés pendant la requête et ne partent qu'après le
+commit (`transaction.on_commit`). Ils sont alors déposés dans une file bornée
+vidée par un thread d'arrière-plan, qui les envoie par lots et réessaie en cas
+d'échec. La requête HTTP n'attend donc jamais Redis.
+
+Avec Redis, le thread envoie depuis sa propre boucle asyncio. Le channel
+layer en mémoire (développement) n'est pas utilisable depuis une autre
+boucle : ses files appartiennent à celle du serveur. `OutboxLoopMiddleware`
+(voir croquettes_config/asgi.py) enregistre alors la boucle du serveur et
+les envois y sont planifiés avec `run_coroutine_threadsafe`.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'MAX_QUEUE_SIZE': 10000,   # au-delà, les nouveaux événements sont abandonnés
+    'BATCH_SIZE': 100,         # nombre max d'événements envoyés ensemble
+    'MAX_RETRIES': 3,          # nouvelles tentatives pour un envoi en échec
+    'RETRY_DELAY': 0.2,        # secondes, doublé à chaque tentative
+    'DELAY_THRESHOLD': 1.0,    # secondes entre commit et envoi au-delà desquelles l'événement est "en retard"
+}
+
+# Attente max (secondes) d'un lot planifié sur la boucle du serveur
+SERVER_LOOP_TIMEOUT = 10.0
+
+
+class ChannelOutbox:
+    """File d'envoi vers le channel layer, vidée par un thread dédié."""
+
+    def __init__(self, max_queue_size, batch_size, max_retries, retry_delay, delay_threshold):
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.delay_threshold = delay_threshold
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._server_loop = None
+        self._counters = {
+            'enqueued': 0,
+            'sent': 0,
+            'retried': 0,
+            'delayed': 0,
+            'dropped': 0,
+        }
+
+    @classmethod
+    def from_settings(cls):
+        config = {**DEFAULTS, **getattr(settings, 'CHANNELS_OUTBOX', {})}
+        return cls(
+            max_queue_size=config['MAX_QUEUE_SIZE'],
+            batch_size=config['BATCH_SIZE'],
+            max_retries=config['MAX_RETRIES'],
+            retry_delay=config['RETRY_DELAY'],
+            delay_threshold=config['DELAY_THRESHOLD'],
+        )
+
+    # --- Côté requête ---
+    def enqueue(self, group, message):
+        """Envoyer `message` au groupe `group` une fois la transaction validée"""
+        self.enqueue_many([(group, message)])
+
+    def enqueue_many(self, events):
+        """Comme `enqueue`, pour une liste de (groupe, message)"""
+        events = list(events)
+        if events:
+            transaction.on_commit(lambda: self.submit(events))
+
+    def submit(self, events):
+        """Déposer des événements dans la file (sans attendre l'envoi)"""
+        self._ensure_worker()
+        now = time.monotonic()
+        for group, message in events:
+            try:
+                self._queue.put_nowait((group, message, now))
+            except queue.Full:
+                self._count('dropped')
+                logger.warning("Outbox pleine : événement pour %s abandonné", group)
+            else:
+                self._count('enqueued')
+
+    def bind_loop(self, loop):
+        """Envoyer désormais depuis `loop` (boucle du serveur ASGI) plutôt que depuis le thread"""
+        self._server_loop = loop
+
+    # --- Supervision ---
+    def stats(self):
+        """Compteurs de l'outbox (événements envoyés, en retard, abandonnés...)"""
+        with self._lock:
+            stats = dict(self._counters)
+        stats['pending'] = self._queue.unfinished_tasks
+        return stats
+
+    def flush(self, timeout=5.0):
+        """Attendre que tous les événements en file soient traités. Renvoie False si le délai expire."""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    # --- Thread d'envoi ---
+    def _count(self, name, n=1):
+        with self._lock:
+            self._counters[name] += n
+
+    def _ensure_worker(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='channels-outbox', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._deliver(loop, batch)
+            except Exception:
+                logger.exception("Erreur inattendue dans l'outbox Channels")
+                self._count('dropped', len(batch))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _deliver(self, loop, batch):
+        pending = batch
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self._count('retried', len(pending))
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            pending = self._send_batch(loop, pending)
+            if not pending:
+                return
+        self._count('dropped', len(pending))
+        logger.warning("Outbox : %d événement(s) abandonné(s) après %d tentatives", len(pending), self.max_retries + 1)
+
+    def _send_batch(self, loop, batch):
+        server_loop = self._server_loop
+        if server_loop is None or server_loop.is_closed() or not server_loop.is_running():
+            return loop.run_until_complete(self._send(batch))
+        future = asyncio.run_coroutine_threadsafe(self._send(batch), server_loop)
+        try:
+            return future.result(timeout=SERVER_LOOP_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            return batch
+
+    async def _send(self, batch):
+        """Envoyer un lot ; renvoie les événements en échec"""
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return []
+        results = await asyncio.gather(
+            *(channel_layer.group_send(group, message) for group, message, _ in batch),
+            return_exceptions=True,
+        )
+        now = time.monotonic()
+        failed = []
+        for item, result in zip(batch, results):
+            if isinstance(result, Exception):
+                failed.append(item)
+                continue
+            self._count('sent')
+            if now - item[2] > self.delay_threshold:
+                self._count('delayed')
+        return failed
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox():
+    """Outbox partagée par le processus"""
+    global _outbox
+    if _outbox is None:
+        with _outbox_lock:
+            if _outbox is None:
+                _outbox = ChannelOutbox.from_settings()
+    return _outbox
+
+
+def bind_current_loop():
+    """Boucle courante pour les envois, si le channel layer ne supporte pas plusieurs boucles"""
+    if isinstance(get_channel_layer(), InMemoryChannelLayer):
+        get_outbox().bind_loop(asyncio.get_running_loop())
+
+
+class OutboxLoopMiddleware:
+    """Middleware ASGI : enregistre la boucle du serveur pour l'outbox (channel layer en mémoire)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        bind_current_loop()
+        return await self.app(scope, receive, send)
+
+
+def enqueue(group, message):
+    get_outbox().enqueue(group, message)
+
+
+def enqueue_many(events):
+    get_outbox().enqueue_many(events)
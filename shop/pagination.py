@@ -0,0 +1,118 @@
+"""Pagination par curseur (keyset).
+
+Au lieu d'un OFFSET (qui parcourt toutes les lignes précédentes) et d'un
+COUNT(*), la page suivante est obtenue par une condition sur les valeurs du
+dernier élément affiché : `(created_at, id) < (dernier created_at, dernier id)`.
+Une page profonde coûte alors autant que la première.
+"""
+import base64
+import binascii
+import datetime
+import json
+
+from django.core.exceptions import ValidationError
+from django.db import connections
+from django.db.models import Q
+
+
+class KeysetPage:
+    """Une page de résultats et le curseur de la suivante"""
+
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def _json_default(value):
+    # isoformat() complet : DjangoJSONEncoder tronque les microsecondes, ce qui
+    # ferait sauter des lignes créées dans la même milliseconde
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+
+def encode_cursor(values):
+    data = json.dumps(values, default=_json_default, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, model, ordering):
+    """Valeurs du curseur converties selon les champs de `ordering`, ou None si invalide"""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(values, list) or len(values) != len(ordering):
+            return None
+        return [
+            model._meta.get_field(name.lstrip('-')).to_python(value)
+            for name, value in zip(ordering, values)
+        ]
+    except (ValueError, binascii.Error, ValidationError):
+        return None
+
+
+def _after(ordering, values):
+    """Condition "strictement après `values`" dans l'ordre `ordering`"""
+    condition = Q()
+    for i, name in enumerate(ordering):
+        field = name.lstrip('-')
+        lookup = 'lt' if name.startswith('-') else 'gt'
+        step = Q(**{f'{field}__{lookup}': values[i]})
+        for previous, value in zip(ordering[:i], values[:i]):
+            step &= Q(**{previous.lstrip('-'): value})
+        condition |= step
+    return condition
+
+
+def keyset_paginate(queryset, cursor=None, per_page=20, ordering=('-created_at', '-id')):
+    """Page de `queryset` commençant après `cursor`.
+
+    `ordering` doit se terminer par un champ unique (l'id) pour que l'ordre
+    soit total. Une ligne de plus est lue pour savoir s'il existe une page
+    suivante, sans COUNT(*).
+    """
+    ordering = list(ordering)
+    queryset = queryset.order_by(*ordering)
+    values = decode_cursor(cursor, queryset.model, ordering)
+    if values is not None:
+        queryset = queryset.filter(_after(ordering, values))
+
+    items = list(queryset[:per_page + 1])
+    next_cursor = None
+    if len(items) > per_page:
+        items = items[:per_page]
+        last = items[-1]
+        next_cursor = encode_cursor([getattr(last, name.lstrip('-')) for name in ordering])
+    return KeysetPage(items, next_cursor)
+
+
+def approximate_count(queryset, limit=1000):
+    """Nombre de lignes sans COUNT(*) complet : renvoie (nombre, approximatif).
+
+    Sous PostgreSQL, estimation du planificateur (EXPLAIN). Ailleurs, COUNT
+    plafonné à `limit` (au-delà, le nombre renvoyé est `limit`).
+    """
+    queryset = queryset.order_by()
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows']), True
+    count = queryset[:limit + 1].count()
+    return min(count, limit), count > limit
@@ -0,0 +1,78 @@
+"""Rétention des notifications : archivage puis suppression des anciennes lues.
+
+Les notifications lues dont la dernière occurrence date de plus de `DAYS`
+jours sont écrites dans un fichier JSONL compressé (gzip) puis supprimées,
+par lots de `BATCH_SIZE` : chaque lot est une transaction courte et la table
+garde une taille stable. Les notifications non lues ne sont jamais touchées.
+
+À lancer périodiquement (cron, timer systemd...) :
+`python manage.py archive_notifications`.
+"""
+import gzip
+import json
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Notification
+
+DEFAULTS = {
+    'DAYS': 90,           # ancienneté (jours) au-delà de laquelle une notification lue est archivée
+    'BATCH_SIZE': 1000,   # lignes archivées et supprimées par transaction
+    'ARCHIVE_DIR': None,  # dossier des archives (None : <BASE_DIR>/archives/notifications)
+}
+
+ARCHIVED_FIELDS = ('id', 'recipient_id', 'verb', 'url', 'count', 'created_at', 'updated_at')
+
+
+def get_config():
+    config = {**DEFAULTS, **getattr(settings, 'NOTIFICATION_RETENTION', {})}
+    if config['ARCHIVE_DIR'] is None:
+        config['ARCHIVE_DIR'] = Path(settings.BASE_DIR) / 'archives' / 'notifications'
+    return config
+
+
+def archivable_notifications(days, now=None):
+    """Notifications lues dont la dernière occurrence est plus ancienne que `days` jours"""
+    cutoff = (now or timezone.now()) - timedelta(days=days)
+    return Notification.objects.filter(unread=False, updated_at__lt=cutoff)
+
+
+def archive_notifications(days=None, batch_size=None, archive_dir=None, now=None):
+    """Archiver puis supprimer les notifications lues anciennes.
+
+    Renvoie (nombre archivé, chemin du fichier ou None si rien à archiver).
+    Un lot est écrit dans l'archive avant d'être supprimé : en cas d'échec,
+    une ligne peut se retrouver deux fois dans les archives, jamais perdue.
+    """
+    config = get_config()
+    days = config['DAYS'] if days is None else days
+    batch_size = batch_size or config['BATCH_SIZE']
+    archive_dir = Path(archive_dir or config['ARCHIVE_DIR'])
+    now = now or timezone.now()
+    queryset = archivable_notifications(days, now).order_by('id')
+
+    path = archive_dir / f"notifications-{now:%Y%m%d-%H%M%S}.jsonl.gz"
+    archive = None
+    total = 0
+    try:
+        while True:
+            with transaction.atomic():
+                rows = list(queryset.values(*ARCHIVED_FIELDS)[:batch_size])
+                if not rows:
+                    break
+                if archive is None:
+                    archive_dir.mkdir(parents=True, exist_ok=True)
+                    archive = gzip.open(path, 'at', encoding='utf-8')
+                archive.writelines(json.dumps(row, cls=DjangoJSONEncoder) + '\n' for row in rows)
+                archive.flush()
+                Notification.objects.filter(pk__in=[row['id'] for row in rows]).delete()
+            total += len(rows)
+    finally:
+        if archive is not None:
+            archive.close()
+    return total, (path if archive is not None else None)
@@ -0,0 +1,171 @@
+"""Points de fidélité : journal des mouvements et soldes incrémentaux.
+
+Chaque gain ou utilisation est une ligne de `RewardTransaction` (insérées en
+masse lors des changements de statut). Le solde `RewardPoint` est mis à jour
+dans la même transaction par `UPDATE ... SET points = points + n`, jamais en
+relisant puis réécrivant la ligne : le profil ne lit qu'une ligne.
+`reconcile_balances` recalcule les soldes depuis le journal en cas de doute.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Min, Q, Sum, Value, When
+
+from .customers import SPENT_STATUS
+from .models import RewardPoint, RewardTransaction
+
+# 1 point pour chaque tranche de 100 XOF d'une commande livrée
+XOF_PER_POINT = 100
+# Réduction à la commande : 100 points pour 10 %
+DISCOUNT_POINTS = 100
+DISCOUNT_RATE = Decimal('0.10')
+
+# Mouvements comptés dans `total_earned`
+EARNING_KINDS = ('earn', 'reversal')
+
+
+class InsufficientPointsError(Exception):
+    """Solde de points insuffisant pour la réduction demandée"""
+
+
+def points_for_amount(amount):
+    return int(amount // XOF_PER_POINT)
+
+
+def _increment_balances(points, earned):
+    """Un seul UPDATE : `points` et `earned` sont des {user_id: delta}"""
+    points = {user_id: n for user_id, n in points.items() if n}
+    if not points:
+        return
+    RewardPoint.objects.filter(user_id__in=points).update(
+        points=F('points') + Case(
+            *[When(user_id=user_id, then=Value(n)) for user_id, n in points.items()],
+            default=Value(0),
+            output_field=IntegerField(),
+        ),
+        total_earned=F('total_earned') + Case(
+            *[When(user_id=user_id, then=Value(n)) for user_id, n in earned.items() if n],
+            default=Value(0),
+            output_field=IntegerField(),
+        ),
+    )
+
+
+def record_transactions(transactions):
+    """Enregistrer des mouvements (un INSERT groupé) et les reporter sur les soldes (un UPDATE)"""
+    transactions = [t for t in transactions if t.points]
+    if not transactions:
+        return []
+    with transaction.atomic():
+        transactions = RewardTransaction.objects.bulk_create(transactions)
+        points, earned = defaultdict(int), defaultdict(int)
+        for t in transactions:
+            points[t.user_id] += t.points
+            if t.kind in EARNING_KINDS:
+                earned[t.user_id] += t.points
+        _increment_balances(points, earned)
+    return transactions
+
+
+def _redemption_corrections(orders, new_status):
+    """Mouvements 'redeem' qui rendent les points d'une réduction quand la commande est annulée.
+
+    Si la commande est rétablie, la réduction reste appliquée : les points
+    sont débités de nouveau (le solde peut alors devenir négatif).
+    """
+    from .orders import CANCELLED_STATUS
+
+    cancelling = new_status == CANCELLED_STATUS
+    order_ids = [o['id'] for o in orders if cancelling or o['status'] == CANCELLED_STATUS]
+    if not order_ids:
+        return []
+    rows = (
+        RewardTransaction.objects.filter(order_id__in=order_ids, kind='redeem')
+        .values('order_id', 'user_id')
+        .annotate(net=Sum('points'), debit=Min('points'))
+        .order_by()
+    )
+    transactions = []
+    for row in rows:
+        # Annulée : utilisations ramenées à 0 ; rétablie : au débit d'origine
+        points = (0 if cancelling else row['debit']) - row['net']
+        transactions.append(RewardTransaction(
+            user_id=row['user_id'], order_id=row['order_id'], kind='redeem', points=points,
+        ))
+    return transactions
+
+
+def record_status_points(orders, new_status):
+    """Gains de points après un changement de statut (mêmes dicts que `record_status_changes`).
+
+    Passage à "livrée" : gain ; retour depuis "livrée" : annulation du gain.
+    Annulation : les points utilisés pour une réduction sont rendus.
+    """
+    transactions = _redemption_corrections(orders, new_status)
+    for o in orders:
+        if not o['user_id']:
+            continue
+        points = points_for_amount(o['total_amount'])
+        if new_status == SPENT_STATUS and o['status'] != SPENT_STATUS:
+            transactions.append(RewardTransaction(user_id=o['user_id'], order_id=o['id'], kind='earn', points=points))
+        elif o['status'] == SPENT_STATUS and new_status != SPENT_STATUS:
+            transactions.append(RewardTransaction(user_id=o['user_id'], order_id=o['id'], kind='reversal', points=-points))
+    record_transactions(transactions)
+
+
+def redeem_discount(user_id):
+    """Débiter DISCOUNT_POINTS points si le solde le permet, sinon `InsufficientPointsError`.
+
+    `UPDATE ... WHERE points >= n` : deux commandes simultanées ne peuvent pas
+    utiliser les mêmes points. Doit être appelé dans une transaction ; le
+    mouvement est enregistré par `record_redemption` une fois la commande créée.
+    """
+    updated = RewardPoint.objects.filter(user_id=user_id, points__gte=DISCOUNT_POINTS).update(
+        points=F('points') - DISCOUNT_POINTS
+    )
+    if not updated:
+        raise InsufficientPointsError(f"{DISCOUNT_POINTS} points nécessaires")
+
+
+def record_redemption(order):
+    RewardTransaction.objects.create(user_id=order.user_id, order=order, kind='redeem', points=-DISCOUNT_POINTS)
+
+
+def reconcile_balances(chunk_size=1000):
+    """Recalculer les soldes depuis le journal, par lots de `chunk_size` utilisateurs.
+
+    Les lignes du lot sont verrouillées pendant le recalcul. Renvoie le nombre
+    de soldes corrigés.
+    """
+    fixed = 0
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            balances = list(
+                RewardPoint.objects.select_for_update()
+                .filter(pk__gt=last_id)
+                .order_by('pk')[:chunk_size]
+            )
+            if not balances:
+                break
+            totals = {
+                row['user_id']: row
+                for row in RewardTransaction.objects
+                .filter(user_id__in=[b.user_id for b in balances])
+                .values('user_id')
+                # Alias distinct du champ : sinon le second Sum('points') viserait le premier
+                .annotate(balance=Sum('points'), earned=Sum('points', filter=Q(kind__in=EARNING_KINDS)))
+                .order_by()
+            }
+            wrong = []
+            for balance in balances:
+                row = totals.get(balance.user_id, {})
+                points, earned = row.get('balance') or 0, row.get('earned') or 0
+                if (balance.points, balance.total_earned) != (points, earned):
+                    balance.points, balance.total_earned = points, earned
+                    wrong.append(balance)
+            RewardPoint.objects.bulk_update(wrong, ['points', 'total_earned'])
+        fixed += len(wrong)
+        last_id = balances[-1].pk
+    return fixed
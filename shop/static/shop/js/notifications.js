@@ -1,6 +1,12 @@
 (function(){
   const wsScheme = window.location.protocol === 'https:' ? 'wss' : 'ws';
-  const notificationsSocket = new WebSocket(wsScheme + '://' + window.location.host + '/ws/notifications/');
+  // Curseur (updated_at, id) de la dernière notification reçue : à la reconnexion, le
+  // serveur renvoie seulement les notifications créées ou regroupées depuis
+  let cursor = null;
+  let cursorKey = null;
+  let catchingUp = true;
+  let reconnectAttempts = 0;
+  const seen = new Set();
 
   function updateBadge(increment) {
     const badgeContainer = document.getElementById('notifications-badge');
@@ -16,36 +22,93 @@
     }
   }
 
-  notificationsSocket.onmessage = function(e) {
-    const data = JSON.parse(e.data);
-    // Update badge by +1
-    updateBadge(1);
+  // Garder le curseur le plus avancé (dates ISO en UTC : l'ordre des chaînes suit celui des dates)
+  function advanceCursor(data) {
+    if (!data.cursor) return;
+    const key = [data.updated_at || '', data.id || 0];
+    if (cursorKey === null || key[0] > cursorKey[0] || (key[0] === cursorKey[0] && key[1] > cursorKey[1])) {
+      cursorKey = key;
+      cursor = data.cursor;
+    }
+  }
+
+  function showNotification(data) {
+    advanceCursor(data);
+    // Déjà affichée (push + rattrapage, ou regroupée depuis) : remplacée sur place, sans recompter
+    const known = seen.has(data.id);
+    seen.add(data.id);
 
-    // Prepend to notifications list if present
+    // Regroupée avec une notification déjà non lue : le badge ne change pas
+    if (!known && !data.coalesced && data.unread !== false) updateBadge(1);
+
+    // Prepend to notifications list if present (replacing the previous version of a coalesced one)
     const list = document.getElementById('notifications-list');
     if (list) {
+      const previous = list.querySelector('li[data-id="' + data.id + '"]');
+      if (previous) previous.remove();
+      const unread = data.unread !== false;
+      const count = data.count > 1 ? ' <span class="badge bg-secondary">' + data.count + '</span>' : '';
       const li = document.createElement('li');
-      li.className = 'list-group-item d-flex justify-content-between align-items-start list-group-item-warning';
+      li.className = 'list-group-item d-flex justify-content-between align-items-start' + (unread ? ' list-group-item-warning' : '');
       li.setAttribute('data-id', data.id || '');
       li.innerHTML = `
         <div>
-          <div>${data.verb} ${data.url ? '<a href="'+data.url+'">Voir</a>' : ''}</div>
-          <small class="text-muted">${data.created_at || ''}</small>
+          <div>${data.verb}${count} ${data.url ? '<a href="'+data.url+'">Voir</a>' : ''}</div>
+          <small class="text-muted">${data.updated_at || data.created_at || ''}</small>
         </div>
         <div>
-          <button class="btn btn-sm btn-outline-secondary mark-read">Marquer lu</button>
+          ${unread ? '<button class="btn btn-sm btn-outline-secondary mark-read">Marquer lu</button>' : ''}
         </div>
       `;
       list.insertBefore(li, list.firstChild);
     }
 
-    // Browser notification
-    if (window.Notification && Notification.permission === 'granted') {
+    // Browser notification (pas pour les notifications rattrapées)
+    if (!catchingUp && window.Notification && Notification.permission === 'granted') {
       new Notification(data.verb || 'Notification', { body: (data.verb || '') });
     }
-  };
+  }
 
-  notificationsSocket.onclose = function(e){ console.error('Notifications socket closed'); };
+  // Au-delà de ce que le socket a renvoyé, compléter par l'endpoint JSON
+  function fetchMissed(since) {
+    fetch('/notifications/sync/?since=' + encodeURIComponent(since))
+      .then(r => r.json())
+      .then(data => {
+        if (!data.ok) return;
+        data.notifications.forEach(showNotification);
+        if (data.has_more) fetchMissed(data.cursor);
+      });
+  }
+
+  function connect() {
+    let url = wsScheme + '://' + window.location.host + '/ws/notifications/';
+    if (cursor !== null) url += '?since=' + encodeURIComponent(cursor);
+    const notificationsSocket = new WebSocket(url);
+    catchingUp = true;
+
+    notificationsSocket.onmessage = function(e) {
+      const data = JSON.parse(e.data);
+      if (data.sync) {
+        reconnectAttempts = 0;
+        catchingUp = false;
+        if (cursor === null) cursor = data.cursor;
+        if (data.has_more) fetchMissed(data.cursor);
+        return;
+      }
+      showNotification(data);
+    };
+
+    notificationsSocket.onclose = function(e) {
+      console.error('Notifications socket closed');
+      // Reconnexion avec backoff exponentiel et aléatoire : après un redémarrage
+      // du serveur, les clients ne reviennent pas tous au même instant
+      const delay = Math.min(30000, 1000 * Math.pow(2, reconnectAttempts)) * (0.5 + Math.random());
+      reconnectAttempts++;
+      setTimeout(connect, delay);
+    };
+  }
+
+  connect();
 
   // handle mark-as-read clicks
   document.addEventListener('click', function(e) {
@@ -63,6 +126,26 @@
           }
         });
     }
+    if (e.target && e.target.id === 'mark-page-read') {
+      // Toutes les notifications non lues affichées, en une seule requête
+      const items = Array.from(document.querySelectorAll('#notifications-list li.list-group-item-warning'));
+      const body = new URLSearchParams();
+      items.forEach(li => body.append('ids', li.getAttribute('data-id')));
+      if (!items.length) return;
+      fetch('/notifications/mark_read/', { method: 'POST', headers: {'X-CSRFToken': getCookie('csrftoken') }, body: body })
+        .then(r => r.json())
+        .then(data => {
+          if (data.ok) {
+            items.forEach(li => {
+              li.classList.remove('list-group-item-warning');
+              const btn = li.querySelector('.mark-read');
+              if (btn) btn.remove();
+            });
+            updateBadge(-9999);
+            if (data.unread > 0) updateBadge(data.unread);
+          }
+        });
+    }
     if (e.target && e.target.id === 'mark-all-read') {
       fetch('/notifications/mark_all_read/', { method: 'POST', headers: {'X-CSRFToken': getCookie('csrftoken') } })
         .then(r => r.json())
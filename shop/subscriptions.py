@@ -0,0 +1,180 @@
+"""Renouvellement des abonnements : commandes générées en masse, par lots.
+
+Chaque lot d'abonnements actifs arrivés à échéance est traité dans une
+transaction : stock réservé, commandes et articles insérés avec
+`bulk_create`, `next_delivery` avancée. Un abonnement renouvelé n'est donc
+plus à échéance et une seconde exécution ne le reprend pas ; si le lot
+échoue, rien n'est écrit. Les abonnements dont un produit manque sont
+laissés à échéance et repris à l'exécution suivante ; ceux dont aucun
+produit n'est plus disponible (inactifs ou supprimés) sautent cette
+livraison, sans quoi chaque exécution les reprendrait.
+
+À lancer périodiquement (cron, timer systemd...) :
+`python manage.py renew_subscriptions`.
+"""
+import calendar
+import datetime
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from .customers import record_new_orders
+from .models import Notification, Order, OrderItem, Product, Subscription
+from .notifications import dispatch, notify
+from .orders import reserve_stock
+
+DEFAULT_CHUNK_SIZE = 500
+
+
+def add_months(day, months):
+    """`day` décalé de `months` mois (dernier jour du mois si besoin : 31/01 -> 28/02)"""
+    month = day.month - 1 + months
+    year = day.year + month // 12
+    month = month % 12 + 1
+    return day.replace(year=year, month=month, day=min(day.day, calendar.monthrange(year, month)[1]))
+
+
+def next_delivery_after(day, frequency, today):
+    """Prochaine date de livraison après `day`, strictement postérieure à `today`.
+
+    Un abonnement en retard de plusieurs périodes ne génère qu'une commande.
+    """
+    while day <= today:
+        if frequency == 'weekly':
+            day += datetime.timedelta(weeks=1)
+        elif frequency == 'biweekly':
+            day += datetime.timedelta(weeks=2)
+        else:
+            day = add_months(day, 1)
+    return day
+
+
+def due_subscriptions(today):
+    """Abonnements actifs dont la livraison est due (index subscription_due_idx)"""
+    return Subscription.objects.filter(status='active', next_delivery__lte=today)
+
+
+def _advance_deliveries(subscriptions, today):
+    # Un UPDATE par nouvelle date de livraison (quelques-unes par lot)
+    advanced = defaultdict(list)
+    for sub in subscriptions:
+        advanced[next_delivery_after(sub['next_delivery'], sub['frequency'], today)].append(sub['id'])
+    for next_delivery, sub_ids in advanced.items():
+        Subscription.objects.filter(pk__in=sub_ids).update(next_delivery=next_delivery)
+
+
+def _renew_chunk(subscriptions, today):
+    """Renouveler un lot (dicts 'id', 'user_id', 'delivery_location_id', 'frequency', 'next_delivery').
+
+    Doit être appelé dans une transaction. Renvoie (commandes créées, ids
+    des abonnements laissés en attente de stock, ids des abonnements sans
+    produit disponible, dont la livraison est sautée).
+    """
+    ids = [s['id'] for s in subscriptions]
+    product_ids = defaultdict(list)
+    links = (
+        Subscription.products.through.objects
+        .filter(subscription_id__in=ids)
+        .order_by('product_id')
+        .values_list('subscription_id', 'product_id')
+    )
+    for subscription_id, product_id in links:
+        product_ids[subscription_id].append(product_id)
+
+    # Stock lu sous verrou : la répartition ci-dessous ne peut plus être contredite
+    products = {
+        p.id: p
+        for p in Product.objects.select_for_update().filter(
+            pk__in={pid for pids in product_ids.values() for pid in pids}, is_active=True
+        ).order_by('pk')
+    }
+    remaining = {pid: p.stock for pid, p in products.items()}
+
+    renewed, waiting, unavailable = [], [], []
+    for sub in subscriptions:
+        lot = [products[pid] for pid in product_ids[sub['id']] if pid in products]
+        if not lot:
+            unavailable.append(sub)
+            continue
+        if any(remaining[p.id] < 1 for p in lot):
+            waiting.append(sub['id'])
+            continue
+        for p in lot:
+            remaining[p.id] -= 1
+        renewed.append((sub, lot))
+    # Sans produit disponible : livraison sautée, comme pour un abonnement renouvelé
+    _advance_deliveries([sub for sub, _ in renewed] + unavailable, today)
+    unavailable = [sub['id'] for sub in unavailable]
+    if not renewed:
+        return [], waiting, unavailable
+
+    quantities = Counter(p.id for _, lot in renewed for p in lot)
+    reserve_stock(quantities)
+    orders = Order.objects.bulk_create([
+        Order(
+            user_id=sub['user_id'],
+            delivery_location_id=sub['delivery_location_id'],
+            total_amount=sum(p.price for p in lot),
+            notes=f"Abonnement #{sub['id']} - livraison du {sub['next_delivery']:%d/%m/%Y}",
+            status='pending',
+        )
+        for sub, lot in renewed
+    ])
+    OrderItem.objects.bulk_create([
+        OrderItem(order=order, product=p, quantity=1, price=p.price)
+        for order, (_, lot) in zip(orders, renewed)
+        for p in lot
+    ])
+
+    # bulk_create ne passe pas par order_post_save : statistiques et notification client ici
+    record_new_orders(orders)
+    dispatch([
+        Notification(
+            recipient_id=order.user_id,
+            verb=f"Votre commande d'abonnement #{order.id} a été créée.",
+            url=f"/commande/{order.id}/",
+        )
+        for order in orders
+    ])
+    return orders, waiting, unavailable
+
+
+def renew_due_subscriptions(today=None, chunk_size=None):
+    """Créer les commandes des abonnements arrivés à échéance.
+
+    Lots de `chunk_size` abonnements (réglage SUBSCRIPTION_RENEWAL_CHUNK_SIZE),
+    une transaction par lot. Une seule notification est envoyée à chaque
+    admin à la fin. Renvoie {'orders': n, 'waiting': n, 'unavailable': n}.
+    """
+    today = today or timezone.localdate()
+    chunk_size = chunk_size or getattr(settings, 'SUBSCRIPTION_RENEWAL_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+    created = waiting = unavailable = 0
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            chunk = list(
+                due_subscriptions(today)
+                .filter(pk__gt=last_id)
+                .select_for_update(skip_locked=True)
+                .order_by('pk')
+                .values('id', 'user_id', 'delivery_location_id', 'frequency', 'next_delivery')[:chunk_size]
+            )
+            if not chunk:
+                break
+            orders, skipped, empty = _renew_chunk(chunk, today)
+        created += len(orders)
+        waiting += len(skipped)
+        unavailable += len(empty)
+        last_id = chunk[-1]['id']
+
+    if created or waiting or unavailable:
+        verb = f"Renouvellement des abonnements : {created} commande(s) créée(s)"
+        if waiting:
+            verb += f", {waiting} en attente de stock"
+        if unavailable:
+            verb += f", {unavailable} sans produit disponible (livraison sautée)"
+        notify(User.objects.filter(is_staff=True).values_list('id', flat=True), verb + ".", url='/staff/commandes/')
+    return {'orders': created, 'waiting': waiting, 'unavailable': unavailable}
@@ -1,11 +1,13 @@
-from django.test import TestCase, Client, override_settings
+from django.test import TestCase, TransactionTestCase, Client, override_settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from .models import Order, DeliveryLocation, Notification, Message
 
 User = get_user_model()
 
 class NotificationsTests(TestCase):
     def setUp(self):
+        cache.clear()
         self.client_user = User.objects.create_user('alice', 'alice@example.com', 'pass')
         self.admin = User.objects.create_user('bob', 'bob@example.com', 'pass', is_staff=True)
         self.loc = DeliveryLocation.objects.create(name='Test')
@@ -18,8 +20,1408 @@ class NotificationsTests(TestCase):
         user_notifications = Notification.objects.filter(recipient=self.client_user, verb__icontains=f"Votre commande #{order.id}")
         self.assertTrue(user_notifications.exists())
 
+    def test_order_notifications_use_single_insert(self):
+        for i in range(5):
+            User.objects.create_user(f'staff{i}', f'staff{i}@example.com', 'pass', is_staff=True)
+        # INSERT commande + SELECT des admins + UPDATE des stats du profil
+        # + un seul INSERT groupé des notifications
+        with self.assertNumQueries(4):
+            order = Order.objects.create(user=self.client_user, delivery_location=self.loc, total_amount=500, status='pending')
+        self.assertEqual(Notification.objects.filter(verb=f"Nouvelle commande #{order.id}").count(), 6)
+
+    def test_order_notifications_pushed_once_after_commit(self):
+        from unittest import mock
+        from .outbox import ChannelOutbox
+        with mock.patch.object(ChannelOutbox, 'submit') as submit:
+            with self.captureOnCommitCallbacks(execute=True):
+                order = Order.objects.create(user=self.client_user, delivery_location=self.loc, total_amount=500, status='pending')
+                submit.assert_not_called()
+        submit.assert_called_once()
+        events = submit.call_args[0][0]
+        self.assertEqual(
+            sorted(group for group, _ in events),
+            sorted([f"notifications_{self.admin.id}", f"notifications_{self.client_user.id}"])
+        )
+        self.assertTrue(all(event['payload']['url'] for _, event in events))
+        self.assertIn(f"#{order.id}", events[0][1]['payload']['verb'])
+
+class NotificationCoalescingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice', 'alice@example.com', 'pass')
+        self.bob = User.objects.create_user('bob', 'bob@example.com', 'pass')
+
+    def test_repeated_notifications_collapse_into_one_row(self):
+        from unittest import mock
+        from .notifications import notify_coalesced
+        from .outbox import ChannelOutbox
+        notify_coalesced([self.alice.id], 'Nouveau message', url='/commande/1/chat/')
+        first = Notification.objects.get(recipient=self.alice)
+        with mock.patch.object(ChannelOutbox, 'submit') as submit:
+            with self.captureOnCommitCallbacks(execute=True):
+                notify_coalesced([self.alice.id, self.bob.id], 'Nouveau message', url='/commande/1/chat/')
+        first.refresh_from_db()
+        self.assertEqual(first.count, 2)
+        self.assertGreater(first.updated_at, first.created_at)
+        self.assertEqual(Notification.objects.filter(recipient=self.alice).count(), 1)
+        self.assertEqual(Notification.objects.filter(recipient=self.bob).count(), 1)
+        events = {group: event['payload'] for call in submit.call_args_list for group, event in call[0][0]}
+        self.assertEqual(events[f"notifications_{self.alice.id}"]['id'], first.id)
+        self.assertTrue(events[f"notifications_{self.alice.id}"]['coalesced'])
+        self.assertFalse(events[f"notifications_{self.bob.id}"]['coalesced'])
+
+    def test_read_or_stale_notifications_are_not_reused(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from .notifications import notify_coalesced
+        notify_coalesced([self.alice.id], 'Nouveau message', url='/commande/1/chat/')
+        Notification.objects.update(unread=False)
+        notify_coalesced([self.alice.id], 'Nouveau message', url='/commande/1/chat/')
+        Notification.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+        notify_coalesced([self.alice.id], 'Nouveau message', url='/commande/1/chat/')
+        notify_coalesced([self.alice.id], 'Autre', url='/commande/2/chat/')
+        self.assertEqual(Notification.objects.filter(recipient=self.alice).count(), 4)
+
+    @override_settings(NOTIFICATION_COALESCE_WINDOW=0)
+    def test_zero_window_disables_coalescing(self):
+        from .notifications import notify_coalesced
+        notify_coalesced([self.alice.id], 'Nouveau message', url='/commande/1/chat/')
+        notify_coalesced([self.alice.id], 'Nouveau message', url='/commande/1/chat/')
+        self.assertEqual(Notification.objects.filter(recipient=self.alice).count(), 2)
+
+
+class NotificationRetentionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'pass')
+
+    def _notifications(self, n, unread, age_days):
+        from datetime import timedelta
+        from django.utils import timezone
+        when = timezone.now() - timedelta(days=age_days)
+        notes = Notification.objects.bulk_create([
+            Notification(recipient=self.user, verb=f'n{i}', url='/', unread=unread) for i in range(n)
+        ])
+        Notification.objects.filter(pk__in=[n.pk for n in notes]).update(updated_at=when)
+        return notes
+
+    def test_old_read_notifications_archived_in_batches(self):
+        import gzip
+        import json
+        import tempfile
+        from .retention import archive_notifications
+        old_read = self._notifications(5, unread=False, age_days=120)
+        old_unread = self._notifications(2, unread=True, age_days=120)
+        recent_read = self._notifications(2, unread=False, age_days=1)
+        with tempfile.TemporaryDirectory() as tmp:
+            total, path = archive_notifications(days=90, batch_size=2, archive_dir=tmp)
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                archived = [json.loads(line) for line in f]
+        self.assertEqual(total, 5)
+        self.assertEqual(sorted(row['id'] for row in archived), sorted(n.pk for n in old_read))
+        self.assertEqual(
+            set(Notification.objects.values_list('pk', flat=True)),
+            {n.pk for n in old_unread + recent_read}
+        )
+
+    def test_nothing_to_archive_writes_no_file(self):
+        import os
+        import tempfile
+        from .retention import archive_notifications
+        self._notifications(2, unread=True, age_days=120)
+        with tempfile.TemporaryDirectory() as tmp:
+            self.assertEqual(archive_notifications(days=90, archive_dir=tmp), (0, None))
+            self.assertEqual(os.listdir(tmp), [])
+
+    def test_command_dry_run_changes_nothing(self):
+        from io import StringIO
+        from django.core.management import call_command
+        self._notifications(3, unread=False, age_days=120)
+        out = StringIO()
+        call_command('archive_notifications', '--days', '90', '--dry-run', stdout=out)
+        self.assertIn('3 notification(s)', out.getvalue())
+        self.assertEqual(Notification.objects.count(), 3)
+
+    def test_notifications_page_is_paginated(self):
+        from django.urls import reverse
+        from .views import NOTIFICATIONS_PER_PAGE
+        self._notifications(NOTIFICATIONS_PER_PAGE + 5, unread=True, age_days=0)
+        client = Client()
+        client.login(username='alice', password='pass')
+        r = client.get(reverse('notifications'))
+        self.assertEqual(len(r.context['notifications']), NOTIFICATIONS_PER_PAGE)
+        r = client.get(reverse('notifications'), {'cursor': r.context['notifications'].next_cursor})
+        self.assertEqual(len(r.context['notifications']), 5)
+
+
+class NotificationSyncTests(TestCase):
+    def setUp(self):
+        import datetime
+        from django.utils import timezone
+        cache.clear()
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'pass')
+        other = User.objects.create_user('bob', 'bob@example.com', 'pass')
+        base = timezone.now() - datetime.timedelta(hours=1)
+        self.notes = Notification.objects.bulk_create([
+            Notification(
+                recipient=self.user if i % 2 == 0 else other, verb=f'n{i}', url=f'/n{i}/',
+                updated_at=base + datetime.timedelta(seconds=i),
+            )
+            for i in range(8)
+        ])
+        # Created when they last occurred (auto_now_add ignores the value given above)
+        from django.db.models import F
+        Notification.objects.update(created_at=F('updated_at'))
+        self.mine = [n for n in self.notes if n.recipient_id == self.user.id]
+        self.client = Client()
+        self.client.login(username='alice', password='pass')
+
+    def test_sync_returns_only_newer_notifications(self):
+        from django.urls import reverse
+        from .notifications import sync_cursor
+        r = self.client.get(reverse('notifications_sync'), {'since': sync_cursor(self.mine[1])})
+        data = r.json()
+        self.assertEqual([n['id'] for n in data['notifications']], [n.id for n in self.mine[2:]])
+        self.assertEqual(data['cursor'], sync_cursor(self.mine[-1]))
+        self.assertFalse(data['has_more'])
+        self.assertEqual(data['unread'], 4)
+
+        data = self.client.get(reverse('notifications_sync'), {'since': data['cursor']}).json()
+        self.assertEqual(data['notifications'], [])
+        self.assertEqual(data['cursor'], sync_cursor(self.mine[-1]))
+
+    def test_sync_replays_coalesced_updates(self):
+        from django.urls import reverse
+        from .notifications import notify_coalesced, sync_cursor
+        since = sync_cursor(self.mine[-1])
+        with override_settings(NOTIFICATION_COALESCE_WINDOW=7200):
+            notify_coalesced([self.user.id], 'n0 encore', url='/n0/')
+        data = self.client.get(reverse('notifications_sync'), {'since': since}).json()
+        self.assertEqual(len(data['notifications']), 1)
+        replayed = data['notifications'][0]
+        self.assertEqual((replayed['id'], replayed['count'], replayed['verb']), (self.mine[0].id, 2, 'n0 encore'))
+        # Already known to the client: replaced in place, not counted again
+        self.assertTrue(replayed['coalesced'])
+        self.assertEqual(replayed['cursor'], data['cursor'])
+
+    def test_sync_pages_through_backlog(self):
+        from unittest import mock
+        from django.urls import reverse
+        with mock.patch('shop.views.NOTIFICATIONS_SYNC_LIMIT', 3):
+            data = self.client.get(reverse('notifications_sync')).json()
+        self.assertEqual([n['id'] for n in data['notifications']], [n.id for n in self.mine[:3]])
+        self.assertTrue(data['has_more'])
+
+    def test_sync_rejects_invalid_since(self):
+        from django.urls import reverse
+        self.assertEqual(self.client.get(reverse('notifications_sync'), {'since': 'abc'}).status_code, 400)
+
+    def test_consumer_catch_up_after_reconnect(self):
+        from asgiref.sync import async_to_sync
+        from .consumers import NotificationsConsumer
+        from .notifications import sync_cursor
+        consumer = NotificationsConsumer()
+        # as_asgi() normally provides the scope; the constructor ignores it
+        consumer.scope = {'user': self.user, 'query_string': f'since={sync_cursor(self.mine[0])}'.encode()}
+        consumer.user = self.user
+        self.assertEqual(consumer._since(), sync_cursor(self.mine[0]))
+        missed, cursor, has_more = async_to_sync(consumer._load_missed)(consumer._since())
+        self.assertEqual([n['id'] for n in missed], [n.id for n in self.mine[1:]])
+        self.assertEqual((cursor, has_more), (sync_cursor(self.mine[-1]), False))
+        # First connection (or unreadable cursor): nothing replayed, only the starting point
+        self.assertEqual(async_to_sync(consumer._load_missed)(None), ([], sync_cursor(self.mine[-1]), False))
+        self.assertEqual(async_to_sync(consumer._load_missed)('abc'), ([], sync_cursor(self.mine[-1]), False))
+
+
+class OutboxTests(TestCase):
+    def _outbox(self, **kwargs):
+        from .outbox import ChannelOutbox
+        options = dict(max_queue_size=100, batch_size=10, max_retries=2, retry_delay=0, delay_threshold=60)
+        options.update(kwargs)
+        return ChannelOutbox(**options)
+
+    def _fake_layer(self, failures=0):
+        from unittest import mock
+        sent = []
+        state = {'failures': failures}
+
+        async def group_send(group, message):
+            if state['failures']:
+                state['failures'] -= 1
+                raise ConnectionError('redis down')
+            sent.append((group, message))
+        return mock.Mock(group_send=group_send), sent
+
+    def test_events_sent_only_after_commit(self):
+        from unittest import mock
+        box = self._outbox()
+        layer, sent = self._fake_layer()
+        with mock.patch('shop.outbox.get_channel_layer', return_value=layer):
+            with self.captureOnCommitCallbacks(execute=True):
+                box.enqueue('g1', {'type': 'notify'})
+                box.enqueue('g2', {'type': 'notify'})
+                self.assertEqual(box.stats()['enqueued'], 0)
+            self.assertTrue(box.flush())
+        self.assertEqual(sorted(g for g, _ in sent), ['g1', 'g2'])
+        self.assertEqual(box.stats()['sent'], 2)
+
+    def test_failed_sends_are_retried(self):
+        from unittest import mock
+        box = self._outbox()
+        layer, sent = self._fake_layer(failures=1)
+        with mock.patch('shop.outbox.get_channel_layer', return_value=layer):
+            box.submit([('g1', {'type': 'notify'})])
+            self.assertTrue(box.flush())
+        self.assertEqual(len(sent), 1)
+        stats = box.stats()
+        self.assertEqual((stats['sent'], stats['retried'], stats['dropped']), (1, 1, 0))
+
+    def test_events_dropped_when_channel_layer_stays_down(self):
+        from unittest import mock
+        box = self._outbox(max_retries=1)
+        layer, sent = self._fake_layer(failures=10)
+        with mock.patch('shop.outbox.get_channel_layer', return_value=layer):
+            with self.assertLogs('shop.outbox', 'WARNING'):
+                box.submit([('g1', {'type': 'notify'})])
+                self.assertTrue(box.flush())
+        self.assertEqual(sent, [])
+        self.assertEqual(box.stats()['dropped'], 1)
+
+    def test_sends_run_on_bound_server_loop(self):
+        import asyncio
+        import threading
+        from unittest import mock
+        loop = asyncio.new_event_loop()
+        server = threading.Thread(target=loop.run_forever, daemon=True)
+        server.start()
+        self.addCleanup(loop.close)
+        self.addCleanup(server.join)
+        self.addCleanup(loop.call_soon_threadsafe, loop.stop)
+        threads = []
+
+        async def group_send(group, message):
+            threads.append(threading.get_ident())
+        box = self._outbox()
+        box.bind_loop(loop)
+        with mock.patch('shop.outbox.get_channel_layer', return_value=mock.Mock(group_send=group_send)):
+            box.submit([('g1', {'type': 'notify'})])
+            self.assertTrue(box.flush())
+        self.assertEqual(threads, [server.ident])
+        self.assertEqual(box.stats()['sent'], 1)
+
+    def test_events_dropped_when_queue_is_full(self):
+        from unittest import mock
+        box = self._outbox(max_queue_size=1)
+        with mock.patch.object(box, '_ensure_worker'), self.assertLogs('shop.outbox', 'WARNING'):
+            box.submit([('g1', {}), ('g2', {})])
+        self.assertEqual(box.stats()['enqueued'], 1)
+        self.assertEqual(box.stats()['dropped'], 1)
+
+
+class UnreadCountersTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_user('admin', 'admin@example.com', 'pass', is_staff=True)
+        self.user = User.objects.create_user('u', 'u@example.com', 'pass')
+        self.loc = DeliveryLocation.objects.create(name='Local')
+        self.order = Order.objects.create(user=self.user, delivery_location=self.loc, total_amount=100, status='pending')
+        from .models import Conversation
+        self.conv = Conversation.objects.create(order=self.order)
+        self.conv.participants.add(self.admin, self.user)
+
+    def test_counters_use_one_query_each_then_cache(self):
+        from . import counters
+        for i in range(3):
+            conv = self.conv.__class__.objects.create(order=self.order)
+            conv.participants.add(self.admin, self.user)
+            Message.objects.create(conversation=conv, sender=self.user, content=f'm{i}')
+        with self.assertNumQueries(1):
+            self.assertEqual(counters.get_unread(counters.MESSAGES, self.admin.id), 3)
+        with self.assertNumQueries(1):
+            self.assertEqual(counters.get_unread(counters.NOTIFICATIONS, self.admin.id), 1)
+        with self.assertNumQueries(0):
+            counters.get_unread(counters.MESSAGES, self.admin.id)
+            counters.get_unread(counters.NOTIFICATIONS, self.admin.id)
+
+    def test_counters_follow_new_and_read_rows(self):
+        from . import counters
+        self.assertEqual(counters.get_unread(counters.MESSAGES, self.admin.id), 0)
+        self.assertEqual(counters.get_unread(counters.NOTIFICATIONS, self.user.id), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.create(conversation=self.conv, sender=self.user, content='Bonjour')
+            Notification.objects.create(recipient=self.user, verb='Test', url='/')
+        with self.assertNumQueries(0):
+            self.assertEqual(counters.get_unread(counters.MESSAGES, self.admin.id), 1)
+            self.assertEqual(counters.get_unread(counters.NOTIFICATIONS, self.user.id), 2)
+
+        self.client.login(username='admin', password='pass')
+        from django.urls import reverse
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse('admin_message_detail', args=[self.conv.id]))
+        self.assertEqual(counters.get_unread(counters.MESSAGES, self.admin.id), 0)
+
+    def test_mark_read_decrements_counter_without_recount(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from django.urls import reverse
+        from . import counters
+        with self.captureOnCommitCallbacks(execute=True):
+            notes = [Notification.objects.create(recipient=self.user, verb=f'n{i}', url='/') for i in range(3)]
+        self.assertEqual(counters.get_unread(counters.NOTIFICATIONS, self.user.id), 4)
+        self.client.login(username='u', password='pass')
+
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as ctx:
+            r = self.client.post(reverse('mark_notification_read', args=[notes[0].id]))
+        self.assertEqual(r.status_code, 200)
+        notification_queries = [q['sql'] for q in ctx.captured_queries if 'shop_notification' in q['sql']]
+        self.assertEqual(len(notification_queries), 1)
+        self.assertTrue(notification_queries[0].startswith('UPDATE'))
+        with self.assertNumQueries(0):
+            self.assertEqual(counters.get_unread(counters.NOTIFICATIONS, self.user.id), 3)
+
+        # Batch: already read and foreign ids are ignored
+        foreign = Notification.objects.filter(recipient=self.admin).first()
+        ids = [notes[0].id, notes[1].id, notes[2].id, foreign.id]
+        with self.captureOnCommitCallbacks(execute=True):
+            r = self.client.post(reverse('mark_notifications_read'), {'ids': ids})
+        self.assertEqual(r.json()['marked'], 2)
+        self.assertEqual(counters.get_unread(counters.NOTIFICATIONS, self.user.id), 1)
+        foreign.refresh_from_db()
+        self.assertTrue(foreign.unread)
+
+        # Marking an already read notification again is a no-op, a foreign one is a 404
+        self.assertEqual(self.client.post(reverse('mark_notification_read', args=[notes[0].id])).status_code, 200)
+        self.assertEqual(self.client.post(reverse('mark_notification_read', args=[foreign.id])).status_code, 404)
+        self.assertEqual(self.client.post(reverse('mark_notifications_read'), {'ids': 'x'}).status_code, 400)
+
+
+class ConversationSummaryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_user('admin', 'admin@example.com', 'pass', is_staff=True)
+        self.user = User.objects.create_user('u', 'u@example.com', 'pass')
+        self.loc = DeliveryLocation.objects.create(name='Local')
+        self.order = Order.objects.create(user=self.user, delivery_location=self.loc, total_amount=100, status='pending')
+
+    def _conversation(self, messages=1):
+        from .models import Conversation
+        conv = Conversation.objects.create(order=self.order)
+        conv.participants.add(self.admin, self.user)
+        for i in range(messages):
+            Message.objects.create(conversation=conv, sender=self.user, content=f'message {i}')
+        return conv
+
+    def test_summary_follows_new_and_read_messages(self):
+        conv = self._conversation(messages=2)
+        reply = Message.objects.create(conversation=conv, sender=self.admin, content='Réponse')
+        conv.refresh_from_db()
+        self.assertEqual(conv.last_message, reply)
+        self.assertEqual(conv.read_states.get(user=self.admin).unread_count, 2)
+        self.assertEqual(conv.read_states.get(user=self.user).unread_count, 1)
+
+        self.client.login(username='admin', password='pass')
+        from django.urls import reverse
+        self.client.get(reverse('admin_message_detail', args=[conv.id]))
+        self.assertEqual(conv.read_states.get(user=self.admin).unread_count, 0)
+        self.assertEqual(conv.read_states.get(user=self.user).unread_count, 1)
+
+    def test_messages_list_query_count_is_constant(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from django.urls import reverse
+        self.client.login(username='admin', password='pass')
+
+        def list_queries():
+            with CaptureQueriesContext(connection) as ctx:
+                r = self.client.get(reverse('admin_messages_list'))
+            self.assertEqual(r.status_code, 200)
+            return len(ctx.captured_queries)
+
+        self._conversation()
+        list_queries()  # session et compteurs en cache
+        few = list_queries()
+        for _ in range(5):
+            self._conversation(messages=2)
+        self.assertEqual(list_queries(), few)
+
+    def test_messages_list_ordered_by_last_activity(self):
+        from django.urls import reverse
+        older = self._conversation()
+        newer = self._conversation()
+        Message.objects.create(conversation=older, sender=self.user, content='relance')
+        self.client.login(username='admin', password='pass')
+        r = self.client.get(reverse('admin_messages_list'))
+        self.assertEqual([c.id for c in r.context['conversations']], [older.id, newer.id])
+        self.assertEqual(r.context['conversations'][0].unread, 2)
+
+    def test_late_participant_gets_current_unread_count(self):
+        from .counters import MESSAGES, get_unread
+        conv = self._conversation(messages=3)
+        other_admin = User.objects.create_user('admin2', 'admin2@example.com', 'pass', is_staff=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            conv.participants.add(other_admin)
+        self.assertEqual(conv.read_states.get(user=other_admin).unread_count, 3)
+        self.assertEqual(get_unread(MESSAGES, other_admin.id), 3)
+        Message.objects.create(conversation=conv, sender=self.user, content='encore')
+        self.assertEqual(conv.read_states.get(user=other_admin).unread_count, 4)
+
+    def test_superuser_outside_conversation_sees_real_unread_count(self):
+        from django.urls import reverse
+        self._conversation(messages=2)
+        User.objects.create_superuser('root', 'root@example.com', 'pass')
+        self.client.login(username='root', password='pass')
+        r = self.client.get(reverse('admin_messages_list'))
+        self.assertEqual(r.context['conversations'][0].unread, 2)
+
+
+class SubscriptionRenewalTests(TestCase):
+    def setUp(self):
+        import datetime
+        from .models import Product, Subscription
+        cache.clear()
+        self.today = datetime.date(2026, 1, 31)
+        self.admin = User.objects.create_user('admin', 'admin@example.com', 'pass', is_staff=True)
+        self.loc = DeliveryLocation.objects.create(name='Local')
+        self.kibble = Product.objects.create(name='Croquettes', description='', price=1000, stock=10)
+        self.treats = Product.objects.create(name='Friandises', description='', price=250, stock=1)
+        self.users = [User.objects.create_user(f'u{i}', f'u{i}@example.com', 'pass') for i in range(3)]
+
+        def subscribe(user, frequency, next_delivery, products, status='active'):
+            sub = Subscription.objects.create(
+                user=user, delivery_location=self.loc, frequency=frequency,
+                next_delivery=next_delivery, status=status,
+            )
+            sub.products.add(*products)
+            return sub
+
+        self.weekly = subscribe(self.users[0], 'weekly', self.today - datetime.timedelta(days=15), [self.kibble, self.treats])
+        self.monthly = subscribe(self.users[1], 'monthly', self.today, [self.kibble, self.treats])
+        self.later = subscribe(self.users[2], 'weekly', self.today + datetime.timedelta(days=1), [self.kibble])
+        self.paused = subscribe(self.users[2], 'weekly', self.today, [self.kibble], status='paused')
+
+    def test_due_subscriptions_renewed_in_chunks(self):
+        import datetime
+        from .models import OrderItem
+        from .subscriptions import renew_due_subscriptions
+        result = renew_due_subscriptions(today=self.today, chunk_size=1)
+        # Only one unit of treats: the first due subscription gets it, the other waits
+        self.assertEqual(result, {'orders': 1, 'waiting': 1, 'unavailable': 0})
+        order = Order.objects.get(user=self.users[0])
+        self.assertEqual(order.total_amount, 1250)
+        self.assertEqual(sorted(OrderItem.objects.filter(order=order).values_list('product__name', flat=True)), ['Croquettes', 'Friandises'])
+        self.kibble.refresh_from_db()
+        self.treats.refresh_from_db()
+        self.assertEqual((self.kibble.stock, self.treats.stock), (9, 0))
+        # Overdue weekly subscription jumps past today with a single order
+        self.weekly.refresh_from_db()
+        self.assertEqual(self.weekly.next_delivery, datetime.date(2026, 2, 6))
+        self.monthly.refresh_from_db()
+        self.assertEqual(self.monthly.next_delivery, self.today)
+        self.users[0].profile.refresh_from_db()
+        self.assertEqual(self.users[0].profile.order_count, 1)
+        self.assertTrue(Notification.objects.filter(recipient=self.users[0], verb__contains=f"#{order.id}").exists())
+        # One aggregated notification for staff
+        self.assertEqual(
+            list(Notification.objects.filter(recipient=self.admin).values_list('verb', flat=True)),
+            ["Renouvellement des abonnements : 1 commande(s) créée(s), 1 en attente de stock."]
+        )
+
+    def test_second_run_is_idempotent(self):
+        from .subscriptions import renew_due_subscriptions
+        self.treats.stock = 5
+        self.treats.save()
+        self.assertEqual(renew_due_subscriptions(today=self.today), {'orders': 2, 'waiting': 0, 'unavailable': 0})
+        self.assertEqual(renew_due_subscriptions(today=self.today), {'orders': 0, 'waiting': 0, 'unavailable': 0})
+        self.assertEqual(Order.objects.count(), 2)
+        self.monthly.refresh_from_db()
+        self.assertEqual(str(self.monthly.next_delivery), '2026-02-28')
+
+    def test_subscription_without_available_products_skips_delivery(self):
+        from .models import Product
+        from .subscriptions import renew_due_subscriptions
+        Product.objects.filter(pk__in=[self.kibble.pk, self.treats.pk]).update(is_active=False)
+        self.assertEqual(renew_due_subscriptions(today=self.today), {'orders': 0, 'waiting': 0, 'unavailable': 2})
+        self.assertFalse(Order.objects.exists())
+        self.monthly.refresh_from_db()
+        self.assertEqual(str(self.monthly.next_delivery), '2026-02-28')
+        self.assertEqual(
+            list(Notification.objects.filter(recipient=self.admin).values_list('verb', flat=True)),
+            ["Renouvellement des abonnements : 0 commande(s) créée(s), 2 sans produit disponible (livraison sautée)."]
+        )
+        # Plus à échéance : pas repris à l'exécution suivante
+        self.assertEqual(renew_due_subscriptions(today=self.today), {'orders': 0, 'waiting': 0, 'unavailable': 0})
+
+    def test_command_dry_run(self):
+        from io import StringIO
+        from django.core.management import call_command
+        out = StringIO()
+        call_command('renew_subscriptions', '--date', '2026-01-31', '--dry-run', stdout=out)
+        self.assertIn('2 abonnement(s)', out.getvalue())
+        self.assertFalse(Order.objects.exists())
+
+
+class RewardPointsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('u', 'u@example.com', 'pass')
+        self.loc = DeliveryLocation.objects.create(name='Local')
+
+    def _balance(self):
+        from .models import RewardPoint
+        return RewardPoint.objects.filter(user=self.user).values_list('points', 'total_earned').get()
+
+    def test_points_earned_on_delivery_and_reversed(self):
+        from .models import RewardTransaction
+        orders = [
+            Order.objects.create(user=self.user, delivery_location=self.loc, total_amount=amount, status='pending')
+            for amount in (1250, 480)
+        ]
+        Order.objects.filter(pk__in=[o.pk for o in orders]).transition_status('delivered')
+        self.assertEqual(self._balance(), (16, 16))
+        self.assertEqual(RewardTransaction.objects.filter(user=self.user, kind='earn').count(), 2)
+
+        order = Order.objects.get(pk=orders[0].pk)
+        order.status = 'cancelled'
+        order.save()
+        self.assertEqual(self._balance(), (4, 4))
+        self.assertEqual(RewardTransaction.objects.get(order=order, kind='reversal').points, -12)
+
+    def test_checkout_redeems_points_once(self):
+        from django.urls import reverse
+        from .models import Product, RewardTransaction
+        from .rewards import record_transactions
+        record_transactions([RewardTransaction(user=self.user, kind='adjust', points=150)])
+        kibble = Product.objects.create(name='Kibble', description='Tasty', price=1000, stock=5)
+        self.client.login(username='u', password='pass')
+        self.client.get(reverse('cart_add', args=[kibble.id]))
+        self.client.post(reverse('checkout'), {'delivery_location': self.loc.id, 'use_points': '1'})
+        order = Order.objects.get(user=self.user)
+        self.assertEqual(order.total_amount, 900)
+        self.assertEqual(self._balance(), (50, 0))
+        self.assertEqual(RewardTransaction.objects.get(order=order).points, -100)
+
+        # Not enough points left: nothing is written
+        self.client.get(reverse('cart_add', args=[kibble.id]))
+        self.client.post(reverse('checkout'), {'delivery_location': self.loc.id, 'use_points': '1'})
+        self.assertEqual(Order.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(self._balance(), (50, 0))
+        kibble.refresh_from_db()
+        self.assertEqual(kibble.stock, 4)
+
+    def test_cancelling_order_refunds_redeemed_points(self):
+        from .models import RewardTransaction
+        from .rewards import record_transactions
+        record_transactions([RewardTransaction(user=self.user, kind='adjust', points=150)])
+        order = Order.objects.create(user=self.user, delivery_location=self.loc, total_amount=900, status='pending')
+        record_transactions([RewardTransaction(user=self.user, order=order, kind='redeem', points=-100)])
+        Order.objects.filter(pk=order.pk).transition_status('cancelled')
+        self.assertEqual(self._balance(), (150, 0))
+        self.assertEqual(
+            list(RewardTransaction.objects.filter(order=order).order_by('pk').values_list('kind', 'points')),
+            [('redeem', -100), ('redeem', 100)]
+        )
+        # Rétablie : la réduction reste appliquée, les points sont débités de nouveau
+        Order.objects.filter(pk=order.pk).transition_status('pending')
+        self.assertEqual(self._balance(), (50, 0))
+        Order.objects.filter(pk=order.pk).transition_status('cancelled')
+        self.assertEqual(self._balance(), (150, 0))
+
+    def test_reconcile_rebuilds_balances_from_ledger(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from .models import RewardPoint, RewardTransaction
+        from .rewards import record_transactions
+        record_transactions([
+            RewardTransaction(user=self.user, kind='earn', points=30),
+            RewardTransaction(user=self.user, kind='redeem', points=-10),
+        ])
+        other = User.objects.create_user('v', 'v@example.com', 'pass')
+        RewardPoint.objects.filter(user=self.user).update(points=999)
+        RewardPoint.objects.filter(user=other).update(points=5)
+        out = StringIO()
+        call_command('reconcile_reward_points', '--chunk-size', '1', stdout=out)
+        self.assertIn('2 solde(s)', out.getvalue())
+        self.assertEqual(self._balance(), (20, 30))
+        self.assertEqual(RewardPoint.objects.get(user=other).points, 0)
+
+
+class CheckoutTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('u', 'u@example.com', 'pass')
+        self.loc = DeliveryLocation.objects.create(name='Local')
+        from .models import Product
+        self.kibble = Product.objects.create(name='Kibble', description='Tasty', price=1000, stock=5)
+        self.crunch = Product.objects.create(name='Crunch', description='Crispy', price=500, stock=1)
+
+    def _checkout(self, cart):
+        from django.urls import reverse
+        self.client.login(username='u', password='pass')
+        for product, quantity in cart:
+            for _ in range(quantity):
+                self.client.get(reverse('cart_add', args=[product.id]))
+        return self.client.post(reverse('checkout'), {'delivery_location': self.loc.id})
+
+    def test_checkout_reserves_stock_and_inserts_items(self):
+        self._checkout([(self.kibble, 2), (self.crunch, 1)])
+        order = Order.objects.get(user=self.user)
+        self.assertEqual(order.total_amount, 2500)
+        self.assertEqual(sorted(order.items.values_list('product__name', 'quantity')), [('Crunch', 1), ('Kibble', 2)])
+        self.kibble.refresh_from_db()
+        self.crunch.refresh_from_db()
+        self.assertEqual((self.kibble.stock, self.crunch.stock), (3, 0))
+
+    def test_checkout_out_of_stock_writes_nothing(self):
+        from django.urls import reverse
+        r = self._checkout([(self.kibble, 1), (self.crunch, 2)])
+        self.assertRedirects(r, reverse('cart_detail'))
+        self.assertFalse(Order.objects.exists())
+        self.kibble.refresh_from_db()
+        self.assertEqual(self.kibble.stock, 5)
+
+    def test_cart_of_deleted_products_creates_no_order(self):
+        from django.urls import reverse
+        self.client.login(username='u', password='pass')
+        self.client.get(reverse('cart_add', args=[self.crunch.id]))
+        self.crunch.delete()
+        r = self.client.post(reverse('checkout'), {'delivery_location': self.loc.id})
+        self.assertRedirects(r, reverse('home'), fetch_redirect_response=False)
+        self.assertFalse(Order.objects.exists())
+
+    def test_product_deleted_during_checkout(self):
+        from .orders import EmptyOrderError, OutOfStockError, place_order, reserve_stock
+        product_id = self.crunch.id
+        self.crunch.delete()
+        with self.assertRaises(OutOfStockError) as ctx:
+            reserve_stock({product_id: 1})
+        self.assertIsNone(ctx.exception.product)
+        with self.assertRaises(EmptyOrderError):
+            place_order([], user=self.user, delivery_location=self.loc)
+
+    def test_cancelling_order_releases_stock(self):
+        self._checkout([(self.kibble, 2), (self.crunch, 1)])
+        order = Order.objects.get(user=self.user)
+        order.status = 'cancelled'
+        order.save()
+        self.kibble.refresh_from_db()
+        self.crunch.refresh_from_db()
+        self.assertEqual((self.kibble.stock, self.crunch.stock), (5, 1))
+        # Rétablie : stock repris ; annulée par update() : rendu de nouveau
+        Order.objects.filter(pk=order.pk).transition_status('confirmed')
+        self.kibble.refresh_from_db()
+        self.assertEqual(self.kibble.stock, 3)
+        Order.objects.filter(pk=order.pk).update(status='cancelled')
+        self.kibble.refresh_from_db()
+        self.assertEqual(self.kibble.stock, 5)
+
+    def test_reopening_without_stock_keeps_order_cancelled(self):
+        from .models import Product
+        from .orders import OutOfStockError
+        self._checkout([(self.crunch, 1)])
+        order = Order.objects.get(user=self.user)
+        Order.objects.filter(pk=order.pk).transition_status('cancelled')
+        Product.objects.filter(pk=self.crunch.pk).update(stock=0)
+        with self.assertRaises(OutOfStockError):
+            Order.objects.filter(pk=order.pk).transition_status('pending')
+        order.refresh_from_db()
+        self.assertEqual(order.status, 'cancelled')
+        self.assertFalse(order.status_history.filter(new_status='pending').exists())
+
+
+@override_settings(CART_STORAGE='shop.cart.SessionCartStorage')
+class CartTests(TestCase):
+    def setUp(self):
+        from django.test import RequestFactory
+        from django.contrib.sessions.backends.signed_cookies import SessionStore
+        from .models import Product
+        self.kibble = Product.objects.create(name='Kibble', description='Tasty', price=1000, stock=5)
+        self.crunch = Product.objects.create(name='Crunch', description='Crispy', price=500, stock=5)
+        self.request = RequestFactory().get('/')
+        self.request.session = SessionStore()
+
+    def test_session_keeps_only_ids_and_quantities(self):
+        from .cart import Cart
+        cart = Cart(self.request)
+        cart.add(self.kibble, 2)
+        cart.add(self.crunch)
+        list(cart)
+        self.assertEqual(self.request.session['cart'], {str(self.kibble.id): 2, str(self.crunch.id): 1})
+
+    def test_products_resolved_once_per_request(self):
+        from .cart import Cart
+        self.request.session['cart'] = {str(self.kibble.id): 2, str(self.crunch.id): 1}
+        with self.assertNumQueries(1):
+            cart = Cart(self.request)
+            self.assertEqual(len(cart), 3)
+            self.assertEqual(cart.get_total_price(), 2500)
+            self.assertEqual(len(list(cart)), 2)
+            # Un second panier pendant la même requête (context processor) réutilise les produits
+            self.assertEqual(Cart(self.request).get_total_price(), 2500)
+
+    def test_len_does_not_query(self):
+        from .cart import Cart
+        self.request.session['cart'] = {str(self.kibble.id): 4}
+        with self.assertNumQueries(0):
+            self.assertEqual(len(Cart(self.request)), 4)
+
+    def test_legacy_session_format_is_upgraded(self):
+        from .cart import Cart
+        self.request.session['cart'] = {str(self.kibble.id): {'quantity': 3, 'price': '900'}}
+        cart = Cart(self.request)
+        self.assertEqual(self.request.session['cart'], {str(self.kibble.id): 3})
+        self.assertEqual(cart.get_total_price(), 3000)
+
+
+class CartStorageTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        from .models import Product
+        self.kibble = Product.objects.create(name='Kibble', description='Tasty', price=1000, stock=5)
+
+    def _add_and_view(self):
+        from django.urls import reverse
+        self.client.get(reverse('cart_add', args=[self.kibble.id]))
+        self.client.get(reverse('cart_add', args=[self.kibble.id]))
+        r = self.client.get(reverse('cart_detail'))
+        self.assertEqual(len(r.context['cart']), 2)
+        self.assertEqual(r.context['cart'].get_total_price(), 2000)
+        return r
+
+    def test_anonymous_browsing_creates_no_session(self):
+        from django.contrib.sessions.models import Session
+        from django.urls import reverse
+        for storage in ['shop.cart.SessionCartStorage', 'shop.cart.SignedCookieCartStorage']:
+            with self.subTest(storage=storage), self.settings(CART_STORAGE=storage):
+                self.client.get(reverse('home'))
+                self.client.get(reverse('cart_detail'))
+                self.assertNotIn('sessionid', self.client.cookies)
+                self.assertFalse(Session.objects.exists())
+
+    def test_signed_cookie_storage_writes_no_session(self):
+        from django.contrib.sessions.models import Session
+        self._add_and_view()
+        self.assertFalse(Session.objects.exists())
+        self.assertIn('cart', self.client.cookies)
+
+    def test_tampered_cookie_gives_empty_cart(self):
+        from django.urls import reverse
+        self.client.cookies['cart'] = 'eyJ4Ijo5OX0:forged:signature'
+        r = self.client.get(reverse('cart_detail'))
+        self.assertEqual(len(r.context['cart']), 0)
+
+    @override_settings(CART_STORAGE='shop.cart.CacheCartStorage')
+    def test_cache_storage(self):
+        from django.contrib.sessions.models import Session
+        self._add_and_view()
+        self.assertFalse(Session.objects.exists())
+
+    def test_clear_removes_cookie(self):
+        from django.urls import reverse
+        self._add_and_view()
+        self.client.get(reverse('cart_remove', args=[self.kibble.id]))
+        self.assertEqual(self.client.cookies['cart'].value, '')
+
+    def test_logout_empties_cart(self):
+        from django.urls import reverse
+        User.objects.create_user('u', 'u@example.com', 'pass')
+        for storage in ['shop.cart.SignedCookieCartStorage', 'shop.cart.CacheCartStorage']:
+            with self.subTest(storage=storage), self.settings(CART_STORAGE=storage):
+                self.client.login(username='u', password='pass')
+                self._add_and_view()
+                self.client.get(reverse('logout'))
+                self.assertEqual(self.client.cookies['cart'].value, '')
+                r = self.client.get(reverse('cart_detail'))
+                self.assertEqual(len(r.context['cart']), 0)
+
+
+class CheckoutConcurrencyTests(TransactionTestCase):
+    """Test de charge : des commandes en parallèle ne doivent jamais survendre."""
+    CHECKOUTS = 200
+    STOCK = 50
+
+    def test_parallel_checkouts_never_oversell(self):
+        import threading
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+        from django.db import OperationalError, connection
+        from .models import Product
+        from .orders import OutOfStockError, place_order
+
+        cache.clear()
+        loc = DeliveryLocation.objects.create(name='Local')
+        product = Product.objects.create(name='Kibble', description='Tasty', price=1000, stock=self.STOCK)
+        start = threading.Barrier(20)
+
+        def checkout(i):
+            try:
+                start.wait(timeout=5)
+            except threading.BrokenBarrierError:
+                pass
+            try:
+                # SQLite n'accepte qu'un écrivain à la fois : on réessaie la transaction entière
+                for _ in range(500):
+                    try:
+                        place_order(
+                            [{'product': product, 'quantity': 1, 'price': product.price}],
+                            delivery_location=loc, guest_name=f'client {i}', guest_email='c@example.com',
+                        )
+                        return True
+                    except OutOfStockError:
+                        return False
+                    except OperationalError as e:
+                        if 'locked' not in str(e):
+                            raise
+                        time.sleep(0.005)
+                raise AssertionError('database stayed locked')
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=20) as pool:
+            results = list(pool.map(checkout, range(self.CHECKOUTS)))
+
+        product.refresh_from_db()
+        self.assertEqual(results.count(True), self.STOCK)
+        self.assertEqual(product.stock, 0)
+        self.assertEqual(Order.objects.count(), self.STOCK)
+        from .models import OrderItem
+        self.assertEqual(OrderItem.objects.count(), self.STOCK)
+
+
+class OrderStatusTrackingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_user('admin', 'admin@example.com', 'pass', is_staff=True)
+        self.user = User.objects.create_user('u', 'u@example.com', 'pass')
+        self.loc = DeliveryLocation.objects.create(name='Local')
+        self.order = Order.objects.create(user=self.user, assigned_to=self.admin, delivery_location=self.loc, total_amount=100, status='pending')
+
+    def test_status_change_on_save_does_not_reread_order(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        order = Order.objects.get(pk=self.order.pk)
+        order.status = 'confirmed'
+        with CaptureQueriesContext(connection) as ctx:
+            order.save()
+        selects = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('SELECT')]
+        self.assertEqual(selects, [])
+        history = self.order.status_history.get()
+        self.assertEqual((history.old_status, history.new_status), ('pending', 'confirmed'))
+        self.assertTrue(Notification.objects.filter(recipient=self.user, verb__contains='de pending à confirmed').exists())
+
+        # Un second save sans changement n'ajoute rien
+        order.save()
+        self.assertEqual(self.order.status_history.count(), 1)
+
+    def test_queryset_update_records_history(self):
+        other = Order.objects.create(user=self.user, delivery_location=self.loc, total_amount=50, status='delivered')
+        updated = Order.objects.filter(pk__in=[self.order.pk, other.pk]).update(status='delivered')
+        self.assertEqual(updated, 2)
+        from .models import OrderStatusHistory
+        self.assertEqual(
+            list(OrderStatusHistory.objects.values_list('order_id', 'old_status', 'new_status')),
+            [(self.order.pk, 'pending', 'delivered')]
+        )
+        self.assertTrue(Notification.objects.filter(recipient=self.admin, verb__contains=f"commande #{self.order.id} a changé").exists())
+
+
+class BulkStatusTransitionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_superuser('root', 'root@example.com', 'pass')
+        self.user = User.objects.create_user('u', 'u@example.com', 'pass')
+        self.loc = DeliveryLocation.objects.create(name='Local')
+
+    def _orders(self, n):
+        return [
+            Order.objects.create(user=self.user, delivery_location=self.loc, total_amount=100, status='pending').id
+            for _ in range(n)
+        ]
+
+    def test_transition_query_count_is_constant(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        def transition(ids):
+            with CaptureQueriesContext(connection) as ctx:
+                changed = Order.objects.filter(pk__in=ids).transition_status('delivered', changed_by=self.admin)
+            self.assertEqual(changed, len(ids))
+            return len(ctx.captured_queries)
+
+        self.assertEqual(transition(self._orders(2)), transition(self._orders(20)))
+
+    def test_admin_action_writes_one_history_row_and_notification_per_order(self):
+        from .models import OrderStatusHistory
+        ids = self._orders(3)
+        Order.objects.filter(pk=ids[0]).update(status='delivered')
+        OrderStatusHistory.objects.all().delete()
+        Notification.objects.all().delete()
+
+        self.client.login(username='root', password='pass')
+        self.client.post('/admin/shop/order/', {'action': 'mark_delivered', '_selected_action': ids})
+
+        self.assertEqual(Order.objects.filter(status='delivered').count(), 3)
+        history = OrderStatusHistory.objects.all()
+        self.assertEqual(sorted(h.order_id for h in history), sorted(ids[1:]))
+        self.assertTrue(all(h.changed_by == self.admin for h in history))
+        self.assertEqual(Notification.objects.filter(recipient=self.user).count(), 2)
+
+    def test_admin_order_detail_records_author(self):
+        from django.urls import reverse
+        from .models import OrderStatusHistory
+        order_id = self._orders(1)[0]
+        self.client.login(username='root', password='pass')
+        self.client.post(reverse('admin_order_detail', args=[order_id]), {'status': 'confirmed'})
+        history = OrderStatusHistory.objects.get(order_id=order_id)
+        self.assertEqual((history.old_status, history.changed_by), ('pending', self.admin))
+
+
+class ProductImageTests(TestCase):
+    def setUp(self):
+        import shutil
+        import tempfile
+        cache.clear()
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=self.media, IMAGE_DERIVATIVES={'BACKGROUND': False})
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def _upload(self, name='photo.png', size=(1200, 900)):
+        import io
+        from PIL import Image
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        buffer = io.BytesIO()
+        Image.new('RGBA', size, (200, 120, 40, 128)).save(buffer, format='PNG')
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+    def _product(self, **kwargs):
+        from .models import Product
+        with self.captureOnCommitCallbacks(execute=True):
+            product = Product.objects.create(name='Kibble', description='Tasty', price=1000, stock=5, **kwargs)
+        product.refresh_from_db()
+        return product
+
+    def test_derivatives_generated_once_on_upload(self):
+        import os
+        from unittest import mock
+        from PIL import Image
+        from django.core.files.storage import default_storage
+        from .images import derivative_name
+        product = self._product(image=self._upload())
+        self.assertEqual(len(product.image_hash), 64)
+        for width in (320, 640, 960):
+            for fmt in ('webp', 'jpeg'):
+                with default_storage.open(derivative_name(product.image_hash, width, fmt)) as f:
+                    self.assertEqual(Image.open(f).width, width)
+        small = os.path.getsize(default_storage.path(derivative_name(product.image_hash, 320, 'webp')))
+        self.assertLess(small, product.image.size)
+
+        # Same bytes uploaded again: same hash, nothing re-encoded
+        with mock.patch('shop.images._encode') as encode:
+            twin = self._product(image=self._upload(name='copie.png'))
+        encode.assert_not_called()
+        self.assertEqual(twin.image_hash, product.image_hash)
+
+        # Saving other fields does not touch the image
+        with mock.patch('shop.images.generate_derivatives') as generate:
+            with self.captureOnCommitCallbacks(execute=True):
+                product.stock = 3
+                product.save()
+        generate.assert_not_called()
+
+    def test_small_images_are_not_upscaled(self):
+        from PIL import Image
+        from django.core.files.storage import default_storage
+        from .images import derivative_name
+        product = self._product(image=self._upload(size=(400, 300)))
+        with default_storage.open(derivative_name(product.image_hash, 960, 'jpeg')) as f:
+            self.assertEqual(Image.open(f).size, (400, 300))
+
+    def test_catalog_serves_srcset(self):
+        from django.urls import reverse
+        product = self._product(image=self._upload())
+        html = self.client.get(reverse('home')).content.decode()
+        self.assertIn('type="image/webp"', html)
+        self.assertIn(f"{product.image_hash}/320.webp 320w", html)
+        self.assertNotIn(product.image.url, html)
+
+    def test_upload_is_processed_outside_the_request(self):
+        from unittest import mock
+        from .models import Product
+        with override_settings(IMAGE_DERIVATIVES={'BACKGROUND': True}):
+            with mock.patch('shop.images._background') as background:
+                with self.captureOnCommitCallbacks(execute=True):
+                    product = Product.objects.create(
+                        name='Kibble', description='Tasty', price=1000, stock=5, image=self._upload()
+                    )
+        background.return_value.submit.assert_called_once_with(mock.ANY, product.pk)
+        product.refresh_from_db()
+        self.assertEqual(product.image_hash, '')
+
+    def test_regenerate_adds_new_width_and_resumes(self):
+        import io
+        from unittest import mock
+        from django.core.files.storage import default_storage
+        from django.core.management import call_command
+        from .images import derivative_name
+        first = self._product(image=self._upload())
+        second = self._product(image=self._upload(name='autre.png', size=(1000, 800)))
+
+        with override_settings(IMAGE_DERIVATIVES={'BACKGROUND': False, 'WIDTHS': (320, 480, 640, 960)}):
+            out = io.StringIO()
+            call_command('regenerate_images', '--workers', '1', '--after-id', str(first.pk), stdout=out)
+            self.assertIn('1/1 image(s) : 1 générée(s)', out.getvalue())
+            self.assertFalse(default_storage.exists(derivative_name(first.image_hash, 480, 'webp')))
+            self.assertTrue(default_storage.exists(derivative_name(second.image_hash, 480, 'webp')))
+
+            call_command('regenerate_images', '--workers', '1', stdout=io.StringIO())
+            self.assertTrue(default_storage.exists(derivative_name(first.image_hash, 480, 'jpeg')))
+
+            # Everything up to date: no image decoded
+            with mock.patch('shop.images.generate_derivatives') as generate:
+                out = io.StringIO()
+                call_command('regenerate_images', '--workers', '1', stdout=out)
+            generate.assert_not_called()
+            self.assertIn('0 image(s) générée(s), 2 inchangée(s)', out.getvalue())
+
+    def test_regenerate_records_missing_hash(self):
+        import io
+        from django.core.management import call_command
+        from .models import Product
+        product = self._product(image=self._upload())
+        image_hash = product.image_hash
+        Product.objects.filter(pk=product.pk).update(image_hash='')
+        call_command('regenerate_images', '--workers', '1', '--chunk-size', '1', stdout=io.StringIO())
+        product.refresh_from_db()
+        self.assertEqual(product.image_hash, image_hash)
+
+
+class MediaServingTests(TestCase):
+    def setUp(self):
+        import shutil
+        import tempfile
+        from django.test import RequestFactory
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=self.media, IMAGE_DERIVATIVES={'BACKGROUND': False})
+        override.enable()
+        self.addCleanup(override.disable)
+        self.factory = RequestFactory()
+
+    def _write(self, name, content=bytes(range(256)) * 4):
+        from django.core.files.base import ContentFile
+        from django.core.files.storage import default_storage
+        return default_storage.save(name, ContentFile(content))
+
+    def _get(self, name, **headers):
+        from .media import serve_media
+        return serve_media(self.factory.get(f'/media/{name}', headers=headers), name)
+
+    def test_uploads_get_content_addressed_names(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from .media import is_immutable
+        from .models import Product
+        content = b'GIF89a\x01\x00\x01\x00\x00\x00\x00;'
+        first = Product.objects.create(
+            name='Kibble', description='Tasty', price=1000, stock=5,
+            image=SimpleUploadedFile('Photo.GIF', content, content_type='image/gif'),
+        )
+        self.assertRegex(first.image.name, r'^products/[0-9a-f]{32}\.gif$')
+        self.assertTrue(is_immutable(first.image.name))
+        with first.image.open('rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_hashed_files_are_immutable_and_revalidated_by_etag(self):
+        name = self._write('products/' + 'a' * 32 + '.jpg')
+        response = self._get(name)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), bytes(range(256)) * 4)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+
+        not_modified = self._get(name, if_none_match=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertIn('immutable', not_modified['Cache-Control'])
+
+    def test_legacy_names_get_short_cache(self):
+        name = self._write('products/photo.jpg')
+        response = self._get(name)
+        self.assertIn('max-age=3600', response['Cache-Control'])
+        self.assertNotIn('immutable', response['Cache-Control'])
+
+    def test_byte_ranges(self):
+        name = self._write('products/photo.jpg')
+        response = self._get(name, range='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/1024')
+        self.assertEqual(b''.join(response.streaming_content), bytes(range(10, 20)))
+
+        response = self._get(name, range='bytes=-4')
+        self.assertEqual(b''.join(response.streaming_content), bytes(range(252, 256)))
+
+        self.assertEqual(self._get(name, range='bytes=5000-').status_code, 416)
+        # Stale If-Range: whole file
+        response = self._get(name, range='bytes=10-19', if_range='"autre"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_missing_and_outside_files(self):
+        from django.core.exceptions import SuspiciousFileOperation
+        from django.http import Http404
+        with self.assertRaises(Http404):
+            self._get('products/absent.jpg')
+        with self.assertRaises(SuspiciousFileOperation):
+            self._get('../settings.py')
+
+
+class CatalogTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        from .models import Product
+        self.products = [
+            Product.objects.create(name=f'Produit {i}', description='Tasty', price=100 + i, stock=5)
+            for i in range(7)
+        ]
+
+    def test_cursor_pagination_walks_whole_catalog(self):
+        from unittest import mock
+        from django.urls import reverse
+        seen = []
+        url = reverse('home')
+        with mock.patch('shop.catalog.PAGE_SIZE', 3):
+            while True:
+                r = self.client.get(url)
+                content = r.content.decode()
+                seen += [p.name for p in self.products if f'>{p.name}<' in content]
+                cursor = r.context['catalog']['next_cursor']
+                if not cursor:
+                    break
+                url = f"{reverse('home')}?cursor={cursor}"
+        self.assertEqual(sorted(seen), sorted(p.name for p in self.products))
+        self.assertEqual(len(seen), len(self.products))
+
+    def test_catalog_page_served_from_cache_until_product_changes(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from django.urls import reverse
+        self.client.get(reverse('home'))
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse('home'))
+        self.assertFalse([q for q in ctx.captured_queries if 'shop_product' in q['sql']])
+
+        product = self.products[0]
+        product.name = 'Nouveau nom'
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        self.assertContains(self.client.get(reverse('home')), 'Nouveau nom')
+
+    def test_invalid_cursor_falls_back_to_first_page(self):
+        from django.urls import reverse
+        r = self.client.get(reverse('home'), {'cursor': 'pas-un-curseur'})
+        self.assertEqual(r.status_code, 200)
+        self.assertContains(r, 'Produit 6')
+
+    def test_garbage_cursors_do_not_create_cache_entries(self):
+        from unittest import mock
+        from .catalog import get_catalog_page
+        get_catalog_page()
+        with mock.patch('shop.catalog.cache.set') as cache_set:
+            for cursor in ('pas-un-curseur', 'xyz', 'W10'):
+                get_catalog_page(cursor)
+        cache_set.assert_not_called()
+
+
+class QueryPlanTests(TestCase):
+    """Vérifie sur EXPLAIN que les requêtes chaudes utilisent leurs index.
+
+    Volume réglable par SHOP_EXPLAIN_ROWS (ex. 1000000 en CI nocturne) ;
+    par défaut un petit jeu de données suffit pour SQLite.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        import os
+        from datetime import timedelta
+        from django.utils import timezone
+        from .models import Conversation
+
+        rows = int(os.environ.get('SHOP_EXPLAIN_ROWS', 2000))
+        batch = 5000
+        users = User.objects.bulk_create([
+            User(username=f'seed{i}', is_staff=(i % 10 == 0)) for i in range(max(rows // 100, 10))
+        ])
+        cls.user, cls.staff = users[1], users[0]
+        loc = DeliveryLocation.objects.create(name='Seed')
+        now = timezone.now()
+        statuses = ['pending', 'confirmed', 'delivered', 'cancelled']
+        for start in range(0, rows, batch):
+            Order.objects.bulk_create([
+                Order(
+                    user=users[i % len(users)], assigned_to=users[(i % len(users)) // 10 * 10],
+                    delivery_location=loc, total_amount=100, status=statuses[i % 4],
+                )
+                for i in range(start, min(start + batch, rows))
+            ])
+            Notification.objects.bulk_create([
+                Notification(recipient=users[i % len(users)], verb='seed', unread=(i % 7 == 0))
+                for i in range(start, min(start + batch, rows))
+            ])
+        cls.conversation = Conversation.objects.create(order=Order.objects.first())
+        conversations = Conversation.objects.bulk_create([
+            Conversation(order_id=cls.conversation.order_id) for _ in range(max(rows // 50, 10))
+        ])
+        for start in range(0, rows, batch):
+            Message.objects.bulk_create([
+                Message(
+                    conversation=conversations[i % len(conversations)], sender=users[i % len(users)],
+                    content='seed', read=(i % 3 != 0), created_at=now - timedelta(seconds=i),
+                )
+                for i in range(start, min(start + batch, rows))
+            ])
+        cls.conversation = conversations[0]
+
+        from django.db import connection
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def assertUsesIndex(self, queryset, index_name):
+        from django.db import connection
+        if connection.vendor == 'postgresql':
+            # Sur une petite table Postgres préfère un seq scan : on vérifie que l'index est utilisable
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        plan = queryset.explain()
+        self.assertIn(index_name, plan, f"Plan sans {index_name} :\n{plan}")
+
+    def test_order_indexes(self):
+        self.assertUsesIndex(Order.objects.filter(user=self.user).order_by('-created_at', '-id'), 'order_user_created_idx')
+        self.assertUsesIndex(
+            Order.objects.filter(assigned_to=self.staff, status='pending').order_by('-created_at', '-id'),
+            'order_assignee_status_idx'
+        )
+        self.assertUsesIndex(Order.objects.filter(status='pending').order_by('-created_at', '-id'), 'order_status_created_idx')
+
+    def test_notification_indexes(self):
+        self.assertUsesIndex(Notification.objects.filter(recipient=self.user, unread=True).order_by().values('id'), 'notif_unread_idx')
+        self.assertUsesIndex(Notification.objects.filter(recipient=self.user).order_by('-created_at'), 'notif_recipient_created_idx')
+
+    def test_message_indexes(self):
+        self.assertUsesIndex(
+            Message.objects.filter(conversation=self.conversation, read=False).exclude(sender=self.user).order_by().values('id'),
+            'message_unread_idx'
+        )
+        self.assertUsesIndex(
+            Message.objects.filter(conversation=self.conversation, read=False).order_by().values('sender'),
+            'message_unread_idx'
+        )
+        self.assertUsesIndex(Message.objects.filter(conversation=self.conversation).order_by('created_at'), 'message_conv_created_idx')
+
+
+class AdminOrderListTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_superuser('root', 'root@example.com', 'pass')
+        self.loc = DeliveryLocation.objects.create(name='Local')
+        self.users = [User.objects.create_user(f'c{i}', f'c{i}@example.com', 'pass') for i in range(3)]
+        self.orders = [
+            Order.objects.create(user=self.users[i % 3], assigned_to=self.admin, delivery_location=self.loc,
+                                 total_amount=100, status='delivered' if i % 2 else 'pending')
+            for i in range(45)
+        ]
+        self.client.login(username='root', password='pass')
+
+    def _walk(self, **params):
+        from django.urls import reverse
+        seen, cursor, pages = [], None, 0
+        while True:
+            query = dict(params, **({'cursor': cursor} if cursor else {}))
+            r = self.client.get(reverse('admin_order_list'), query)
+            seen += [o.id for o in r.context['orders']]
+            pages += 1
+            if not r.context['orders'].has_next:
+                return seen, pages
+            cursor = r.context['orders'].next_cursor
+
+    def test_keyset_pages_cover_all_orders_in_order(self):
+        seen, pages = self._walk()
+        self.assertEqual(pages, 3)
+        self.assertEqual(seen, sorted((o.id for o in self.orders), reverse=True))
+
+    def test_status_filter_with_cursor(self):
+        seen, _ = self._walk(status='pending')
+        self.assertEqual(sorted(seen), sorted(o.id for o in self.orders if o.status == 'pending'))
+
+    def test_deep_page_costs_the_same_as_first_page(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from django.urls import reverse
+        self.client.get(reverse('admin_order_list'))  # compteurs du menu en cache
+        with CaptureQueriesContext(connection) as first:
+            r = self.client.get(reverse('admin_order_list'))
+        cursor = r.context['orders'].next_cursor
+        with CaptureQueriesContext(connection) as deep:
+            self.client.get(reverse('admin_order_list'), {'cursor': cursor})
+        self.assertEqual(len(deep.captured_queries), len(first.captured_queries))
+        self.assertFalse([q for q in deep.captured_queries if 'OFFSET' in q['sql']])
+
+
+class CustomerOrderHistoryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        from .models import Product
+        self.user = User.objects.create_user('fidele', 'fidele@example.com', 'pass')
+        self.loc = DeliveryLocation.objects.create(name='Local')
+        self.products = [Product.objects.create(name=f'P{i}', description='', price=1000, stock=10) for i in range(3)]
+        self.orders = []
+        for i in range(25):
+            order = Order.objects.create(user=self.user, delivery_location=self.loc, total_amount=1000 * (i + 1))
+            order.items.create(product=self.products[i % 3], quantity=1, price=1000)
+            self.orders.append(order)
+        self.client.login(username='fidele', password='pass')
+
+    def test_stats_follow_new_orders_and_deliveries(self):
+        from .models import UserProfile
+        profile = UserProfile.objects.get(user=self.user)
+        self.assertEqual(profile.order_count, 25)
+        self.assertEqual(profile.last_order_at, self.orders[-1].created_at)
+        self.assertEqual(profile.lifetime_spend, 0)
+
+        self.orders[0].status = 'delivered'
+        self.orders[0].save()
+        Order.objects.filter(pk__in=[self.orders[1].pk, self.orders[2].pk]).transition_status('delivered')
+        profile.refresh_from_db()
+        self.assertEqual(profile.lifetime_spend, 1000 + 2000 + 3000)
+
+        # Une commande qui sort de "livrée" n'est plus comptée
+        Order.objects.filter(pk=self.orders[2].pk).transition_status('cancelled')
+        profile.refresh_from_db()
+        self.assertEqual(profile.lifetime_spend, 3000)
+
+    def test_my_orders_paginated_with_constant_queries(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from django.urls import reverse
+        self.client.get(reverse('my_orders'))  # compteurs du menu en cache
+        with CaptureQueriesContext(connection) as first:
+            r = self.client.get(reverse('my_orders'))
+        self.assertEqual(len(r.context['orders']), 20)
+        with CaptureQueriesContext(connection) as second:
+            r2 = self.client.get(reverse('my_orders'), {'cursor': r.context['orders'].next_cursor})
+        self.assertEqual(len(r2.context['orders']), 5)
+        self.assertFalse(r2.context['orders'].has_next)
+        self.assertEqual(len(second.captured_queries), len(first.captured_queries))
+        self.assertContains(r2, 'P0')
+
+    def test_profile_reads_stats_without_scanning_orders(self):
+        from django.urls import reverse
+        r = self.client.get(reverse('profile'))
+        self.assertEqual(len(r.context['orders']), 5)
+        self.assertContains(r, 'Voir toutes mes commandes (25)')
+
+
 class AdminPagesTests(TestCase):
     def setUp(self):
+        cache.clear()
         self.client = Client()
         self.admin = User.objects.create_user('admin', 'admin@example.com', 'pass', is_staff=True)
         self.user = User.objects.create_user('u', 'u@example.com', 'pass')
@@ -97,6 +1499,7 @@ except Exception:
 @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
 class ChatConsumerTests(TestCase):
     def setUp(self):
+        cache.clear()
         self.client = Client()
         self.user = User.objects.create_user('client', 'c@example.com', 'pass')
         self.staff = User.objects.create_user('staff', 's@example.com', 'pass', is_staff=True)
@@ -128,12 +1531,83 @@ class ChatConsumerTests(TestCase):
         allowed = async_to_sync(consumer._user_can_access_order)(self.staff, self.order.id)
         self.assertTrue(allowed)
         # Create message and check it is persisted
-        msg = async_to_sync(consumer._create_message)(self.staff, self.order.id, 'Hello staff')
+        msg = async_to_sync(consumer._create_messages)(self.staff, self.order.id, ['Hello staff'])[0]
         self.assertEqual(msg.content, 'Hello staff')
         self.assertTrue(Message.objects.filter(id=msg.id).exists())
         # Notification should be created for the order owner
         self.assertTrue(Notification.objects.filter(recipient=self.user, verb__icontains=f"Nouveau message sur la commande #{self.order.id}").exists())
 
+    def test_consumer_batches_messages_and_caches_conversation(self):
+        from .consumers import OrderChatConsumer
+        from .models import Conversation
+        from asgiref.sync import async_to_sync
+
+        consumer = OrderChatConsumer()
+        consumer.scope = {'user': self.staff}
+        chat_url = f"/commande/{self.order.id}/chat/"
+        msgs = async_to_sync(consumer._create_messages)(self.staff, self.order.id, ['un', 'deux', 'trois'])
+        self.assertEqual([m.content for m in msgs], ['un', 'deux', 'trois'])
+        conv = Conversation.objects.get(order=self.order)
+        self.assertEqual(set(conv.participants.values_list('id', flat=True)), {self.user.id, self.staff.id})
+        # One notification for the whole batch, summary counts every message
+        # (creating the order in setUp already notified the client)
+        self.assertEqual(Notification.objects.filter(recipient=self.user, url=chat_url).count(), 1)
+        conv.refresh_from_db()
+        self.assertEqual(conv.last_message_id, msgs[-1].id)
+        self.assertEqual(conv.read_states.get(user=self.user).unread_count, 3)
+        # Conversation and participants are not looked up again on the same socket
+        with self.assertNumQueries(0):
+            consumer._ensure_conversation(self.staff, self.order.id)
+
+    def test_consumer_resolves_order_once(self):
+        from .consumers import OrderChatConsumer
+        from asgiref.sync import async_to_sync
+
+        # as_asgi() normally provides the scope; the constructor ignores it
+        consumer = OrderChatConsumer()
+        consumer.scope = {'user': self.user}
+        with self.assertNumQueries(1):
+            self.assertTrue(async_to_sync(consumer._user_can_access_order)(self.user, self.order.id))
+        async_to_sync(consumer._create_messages)(self.user, self.order.id, ['premier'])
+        # Established socket: no Order/Conversation/participants read per message
+        with self.assertNumQueries(0):
+            consumer._ensure_conversation(self.user, self.order.id)
+        stranger = User.objects.create_user('other', 'o@example.com', 'pass')
+        other = OrderChatConsumer()
+        other.scope = {'user': stranger}
+        self.assertFalse(async_to_sync(other._user_can_access_order)(stranger, self.order.id))
+
+    def test_reassignment_publishes_access_changed(self):
+        from unittest import mock
+        from .outbox import ChannelOutbox
+        with mock.patch.object(ChannelOutbox, 'submit') as submit:
+            with self.captureOnCommitCallbacks(execute=True):
+                Order.objects.filter(pk=self.order.pk).update(assigned_to=self.staff)
+        submit.assert_called_once_with([(f"order_{self.order.id}", {'type': 'chat.access_changed'})])
+
+        order = Order.objects.get(pk=self.order.pk)
+        order.assigned_to = None
+        with mock.patch.object(ChannelOutbox, 'submit') as submit:
+            with self.captureOnCommitCallbacks(execute=True):
+                order.save()
+        submit.assert_called_once_with([(f"order_{self.order.id}", {'type': 'chat.access_changed'})])
+
+    def test_access_changed_resyncs_participants(self):
+        from .consumers import OrderChatConsumer
+        from .models import Conversation
+        from asgiref.sync import async_to_sync
+
+        consumer = OrderChatConsumer()
+        consumer.scope = {'user': self.user}
+        consumer.order_id = str(self.order.id)
+        async_to_sync(consumer._user_can_access_order)(self.user, self.order.id)
+        async_to_sync(consumer._create_messages)(self.user, self.order.id, ['premier'])
+        Order.objects.filter(pk=self.order.pk).update(assigned_to=self.staff)
+        async_to_sync(consumer.chat_access_changed)({'type': 'chat.access_changed'})
+        async_to_sync(consumer._create_messages)(self.user, self.order.id, ['second'])
+        conv = Conversation.objects.get(order=self.order)
+        self.assertIn(self.staff.id, set(conv.participants.values_list('id', flat=True)))
+
     def test_mark_notification_read(self):
         # create notification and mark as read via AJAX
         n = Notification.objects.create(recipient=self.user, verb='Test read', url='/')
@@ -164,3 +1638,61 @@ class ChatConsumerTests(TestCase):
         self.assertTrue(Message.objects.filter(conversation=conv, content='Bonjour, en cours').exists())
         # a notification should be created for the user
         self.assertTrue(Notification.objects.filter(recipient=self.user, verb__icontains=f"Nouveau message sur la commande #{self.order.id}").exists())
+
+
+class LoadTestHelpersTests(TestCase):
+    def test_percentile(self):
+        from .loadtest import percentile
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 99), 7)
+        self.assertIsNone(percentile([], 50))
+
+    def test_compare_results_flags_regressions(self):
+        from .loadtest import compare_results
+        baseline = {'notify_p99_ms': 10.0, 'memory_per_connection': 20000}
+        ok = {'lost': 0, 'notify_p99_ms': 12.0, 'memory_per_connection': 19000}
+        self.assertEqual(compare_results(ok, baseline, 0.25), [])
+        slow = {'lost': 0, 'notify_p99_ms': 13.0, 'memory_per_connection': 19000}
+        self.assertEqual(len(compare_results(slow, baseline, 0.25)), 1)
+        lost = {'lost': 2, 'notify_p99_ms': 1.0}
+        self.assertIn('2 message(s) perdu(s)', compare_results(lost, baseline, 0.25))
+
+
+@unittest.skipUnless(HAS_CHANNELS, "channels/testing or its dependencies (daphne) are not available")
+@override_settings(CHAT_COALESCE_WINDOW=0)
+class ChannelsLoadTestTests(TransactionTestCase):
+    def test_small_run_delivers_everything_and_cleans_up(self):
+        from .loadtest import USERNAME_PREFIX, run_load_test
+        # The test database is disposable
+        results = run_load_test(users=3, messages=2, timeout=5, allow_db=True)
+        self.assertEqual(results['sockets'], 6)
+        self.assertEqual(results['messages'], 12)
+        self.assertEqual(results['lost'], 0)
+        self.assertGreater(results['memory_per_connection'], 0)
+        self.assertLessEqual(results['chat_p50_ms'], results['chat_p99_ms'])
+        self.assertFalse(User.objects.filter(username__startswith=USERNAME_PREFIX).exists())
+        self.assertFalse(Message.objects.exists())
+
+    def test_command_fails_on_regression(self):
+        import io
+        import json
+        import os
+        import tempfile
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump({'notify_p99_ms': 0.000001}, f)
+        self.addCleanup(os.remove, f.name)
+        with self.assertRaises(CommandError):
+            call_command('loadtest_channels', '--users', '2', '--messages', '1', '--baseline', f.name,
+                         '--allow-db', stdout=io.StringIO())
+
+    def test_refuses_configured_database_without_debug(self):
+        import io
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        with self.assertRaisesMessage(CommandError, 'allow_db'):
+            call_command('loadtest_channels', '--users', '1', stdout=io.StringIO())
+        self.assertFalse(User.objects.exists())
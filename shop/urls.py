@@ -36,9 +36,12 @@ urlpatterns = [
 
     # Notification AJAX endpoints
     path('notifications/mark_read/<int:notification_id>/', views.mark_notification_read, name='mark_notification_read'),
+    path('notifications/mark_read/', views.mark_notifications_read, name='mark_notifications_read'),
     path('notifications/mark_all_read/', views.mark_all_notifications_read, name='mark_all_notifications_read'),
+    path('notifications/sync/', views.notifications_sync, name='notifications_sync'),
 
     # Staff messages
     path('staff/messages/', views.admin_messages_list, name='admin_messages_list'),
     path('staff/message/<int:conv_id>/', views.admin_message_detail, name='admin_message_detail'),
+    path('staff/outbox/', views.admin_outbox_stats, name='admin_outbox_stats'),
 ]
\ No newline at end of file
@@ -4,6 +4,9 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.forms import AuthenticationForm
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 
 # Forms personnalisés
 from .forms import SignUpForm, UserProfileForm
@@ -13,26 +16,32 @@ from .models import (
     Product,
     DeliveryLocation,
     Order,
-    OrderItem,
     Subscription,
     RewardPoint,
     UserProfile,
     Notification,
     Conversation,
+    ConversationReadState,
     Message
 )
+from .chat import refresh_unread_counts
+from .notifications import mark_read, notifications_since, notify_coalesced, sync_cursor
 
-# Panier
+# Catalogue et panier
+from .catalog import get_catalog_page
 from .cart import Cart
+from .rewards import DISCOUNT_POINTS, InsufficientPointsError
+from .orders import OutOfStockError, place_order
+from .pagination import approximate_count, keyset_paginate
 
 
 # =========================
 # PAGE D'ACCUEIL
 # =========================
 def home(request):
-    """Page d'accueil avec liste des produits actifs"""
-    products = Product.objects.filter(is_active=True)
-    return render(request, 'shop/home.html', {'products': products})
+    """Page d'accueil avec liste des produits actifs (paginée par curseur, mise en cache)"""
+    catalog = get_catalog_page(request.GET.get('cursor'))
+    return render(request, 'shop/home.html', {'catalog': catalog})
 
 
 # =========================
@@ -70,11 +79,21 @@ def checkout(request):
     cart = Cart(request)
 
     # Vérifier que le panier n'est pas vide
-    if len(cart) == 0:  # ✅ CORRIGÉ : len(cart) au lieu de len(cart.cart)
+    # Panier vide, ou ne contenant que des produits retirés du catalogue
+    if len(cart) == 0 or not list(cart):
         messages.warning(request, "Votre panier est vide !")
         return redirect('home')
 
     delivery_locations = DeliveryLocation.objects.filter(is_active=True)
+    reward_points = 0
+    if request.user.is_authenticated:
+        reward_points = RewardPoint.objects.filter(user=request.user).values_list('points', flat=True).first() or 0
+    checkout_context = {
+        'cart': cart,
+        'delivery_locations': delivery_locations,
+        'reward_points': reward_points,
+        'discount_points': DISCOUNT_POINTS,
+    }
 
     if request.method == 'POST':
         delivery_location_id = request.POST.get('delivery_location')
@@ -93,33 +112,32 @@ def checkout(request):
             # Validation pour invités
             if not guest_name or not guest_email:
                 messages.error(request, "Nom et email sont obligatoires pour les invités.")
-                return render(request, 'shop/checkout.html', {
-                    'cart': cart,
-                    'delivery_locations': delivery_locations
-                })
+                return render(request, 'shop/checkout.html', checkout_context)
 
         # Création de la commande
         delivery_location = get_object_or_404(DeliveryLocation, id=delivery_location_id)
 
-        order = Order.objects.create(
-            user=user,
-            guest_name=guest_name,
-            guest_email=guest_email,
-            guest_phone=guest_phone,
-            delivery_location=delivery_location,
-            total_amount=cart.get_total_price(),
-            notes=notes,
-            status='pending'  # ✅ CORRIGÉ : 'pending' existe dans ton modèle
-        )
-
-        # Ajout des articles
-        for item in cart:
-            OrderItem.objects.create(
-                order=order,
-                product=item['product'],
-                quantity=item['quantity'],
-                price=item['price']
+        # Commande, réservation du stock et articles dans une seule transaction
+        try:
+            order = place_order(
+                cart,
+                user=user,
+                delivery_location=delivery_location,
+                guest_name=guest_name,
+                guest_email=guest_email,
+                guest_phone=guest_phone,
+                notes=notes,
+                redeem_points=bool(user and request.POST.get('use_points')),
             )
+        except OutOfStockError as e:
+            if e.product is None:
+                messages.error(request, "Un produit de votre panier n'est plus disponible.")
+            else:
+                messages.error(request, f"Stock insuffisant pour {e.product.name} (disponible : {e.product.stock}).")
+            return redirect('cart_detail')
+        except InsufficientPointsError:
+            messages.error(request, f"Il faut {DISCOUNT_POINTS} points pour cette réduction.")
+            return render(request, 'shop/checkout.html', checkout_context)
 
         # Vider le panier
         cart.clear()
@@ -127,10 +145,7 @@ def checkout(request):
         messages.success(request, f"Commande #{order.id} passée avec succès ! Paiement à la livraison.")
         return redirect('order_success', order_id=order.id)
 
-    return render(request, 'shop/checkout.html', {
-        'cart': cart,
-        'delivery_locations': delivery_locations
-    })
+    return render(request, 'shop/checkout.html', checkout_context)
 
 
 # =========================
@@ -173,44 +188,111 @@ def order_chat(request, order_id):
     })
 
 
+NOTIFICATIONS_PER_PAGE = 30
+
+
 @login_required
 def notifications(request):
-    """Page listant les notifications de l'utilisateur"""
-    notes = request.user.notifications.all().order_by('-created_at')
+    """Page listant les notifications de l'utilisateur (pagination par curseur)"""
+    # Les notifications regroupées remontent à leur dernière occurrence
+    notes = keyset_paginate(
+        request.user.notifications.all(), request.GET.get('cursor'), NOTIFICATIONS_PER_PAGE,
+        ordering=('-updated_at', '-id'),
+    )
     # Do not auto-mark here anymore; let user mark read explicitly in the UI
     return render(request, 'shop/notifications.html', {'notifications': notes})
 
 from django.http import JsonResponse
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from . import counters, outbox
+
+# Nombre max d'ids acceptés par mark_notifications_read (une page de notifications suffit)
+MARK_READ_MAX_IDS = 200
+
 
 @login_required
 def mark_notification_read(request, notification_id):
-    """Mark a single notification as read via AJAX"""
-    notif = get_object_or_404(Notification, id=notification_id, recipient=request.user)
-    notif.unread = False
-    notif.save()
-    unread = request.user.notifications.filter(unread=True).count()
-    return JsonResponse({'ok': True, 'unread': unread})
+    """Mark a single notification as read via AJAX (un UPDATE, compteur maintenu sans COUNT)"""
+    if not mark_read(request.user.id, [notification_id]):
+        # Rien de modifié : déjà lue, ou pas une notification de l'utilisateur
+        get_object_or_404(Notification, id=notification_id, recipient=request.user)
+    return JsonResponse({'ok': True, 'unread': counters.get_unread(counters.NOTIFICATIONS, request.user.id)})
+
+@login_required
+def mark_notifications_read(request):
+    """Marquer lues plusieurs notifications (paramètre `ids` répété) en un seul UPDATE"""
+    try:
+        ids = [int(i) for i in request.POST.getlist('ids')]
+    except ValueError:
+        return JsonResponse({'ok': False, 'error': 'ids invalides'}, status=400)
+    if len(ids) > MARK_READ_MAX_IDS:
+        return JsonResponse({'ok': False, 'error': 'trop de notifications'}, status=400)
+    marked = mark_read(request.user.id, ids) if ids else 0
+    return JsonResponse({
+        'ok': True,
+        'marked': marked,
+        'unread': counters.get_unread(counters.NOTIFICATIONS, request.user.id),
+    })
+
+NOTIFICATIONS_SYNC_LIMIT = 100
+
+
+@login_required
+def notifications_sync(request):
+    """JSON : notifications créées ou regroupées après `since` (curseur reçu par le client).
+
+    Utilisé par le client après une reconnexion du WebSocket, à la place d'un
+    rechargement complet de la page des notifications. Sans `since`, depuis
+    la première notification.
+    """
+    try:
+        payloads, cursor, has_more = notifications_since(
+            request.user.id, request.GET.get('since') or sync_cursor(), limit=NOTIFICATIONS_SYNC_LIMIT
+        )
+    except ValueError:
+        return JsonResponse({'ok': False, 'error': 'since invalide'}, status=400)
+    return JsonResponse({
+        'ok': True,
+        'notifications': payloads,
+        'cursor': cursor,
+        'has_more': has_more,
+        'unread': counters.get_unread(counters.NOTIFICATIONS, request.user.id),
+    })
 
 @login_required
 def mark_all_notifications_read(request):
     request.user.notifications.filter(unread=True).update(unread=False)
+    counters.set_unread(counters.NOTIFICATIONS, request.user.id, 0)
     return JsonResponse({'ok': True, 'unread': 0})
 
 @staff_member_required
 def admin_messages_list(request):
-    """List conversations relevant to staff with unread counts"""
-    qs = Conversation.objects.all().order_by('-created_at')
+    """List conversations relevant to staff with unread counts, most recent activity first"""
+    from django.core.paginator import Paginator
+
+    # Non-lus lus dans le résumé par participant (pas de COUNT par conversation)
+    unread = ConversationReadState.objects.filter(
+        conversation=OuterRef('pk'), user=request.user
+    ).values('unread_count')[:1]
+    # Superutilisateur non participant : pas de résumé, comptage direct
+    # (COALESCE n'évalue ce second argument qu'en l'absence de résumé)
+    counted = (
+        Message.objects.filter(conversation=OuterRef('pk'), read=False)
+        .exclude(sender=request.user)
+        .values('conversation')
+        .annotate(n=Count('id'))
+        .values('n')
+    )
+    qs = (
+        Conversation.objects
+        .select_related('order', 'last_message__sender')
+        .annotate(unread=Coalesce(Subquery(unread), Subquery(counted), 0))
+        .order_by(F('last_message_at').desc(nulls_last=True), '-created_at', '-id')
+    )
     if not request.user.is_superuser:
         qs = qs.filter(participants=request.user)
 
-    conversations = []
-    for c in qs:
-        unread = c.messages.filter(read=False).exclude(sender=request.user).count()
-        last = c.messages.last()
-        conversations.append({'conv': c, 'unread': unread, 'last': last})
-
+    paginator = Paginator(qs, 20)
+    conversations = paginator.get_page(request.GET.get('page'))
     return render(request, 'shop/admin_messages_list.html', {'conversations': conversations})
 
 @staff_member_required
@@ -226,39 +308,40 @@ def admin_message_detail(request, conv_id):
         content = request.POST.get('message', '').strip()
         if content:
             msg = Message.objects.create(conversation=conv, sender=request.user, content=content)
-            # Create notifications for other participants
-            for p in conv.participants.exclude(pk=request.user.pk):
-                try:
-                    Notification.objects.create(
-                        recipient=p,
-                        verb=f"Nouveau message sur la commande #{order.id}",
-                        url=f"/commande/{order.id}/chat/"
-                    )
-                except Exception:
-                    pass
-            # Broadcast to group
-            channel_layer = get_channel_layer()
-            try:
-                async_to_sync(channel_layer.group_send)(
-                    f'order_{order.id}',
-                    {
-                        'type': 'chat.message',
-                        'message': content,
-                        'sender': request.user.username,
-                        'created_at': msg.created_at.isoformat(),
-                    }
-                )
-            except Exception:
-                pass
+            # Notifier les autres participants (regroupé avec leur notification non lue de ce chat)
+            notify_coalesced(
+                conv.participants.exclude(pk=request.user.pk).values_list('id', flat=True),
+                f"Nouveau message sur la commande #{order.id}",
+                url=f"/commande/{order.id}/chat/",
+            )
+            # Broadcast to group (envoyé par l'outbox après le commit)
+            outbox.enqueue(
+                f'order_{order.id}',
+                {
+                    'type': 'chat.message',
+                    'message': content,
+                    'sender': request.user.username,
+                    'created_at': msg.created_at.isoformat(),
+                }
+            )
             messages.success(request, "Réponse envoyée.")
             return redirect('admin_message_detail', conv_id=conv.id)
 
     # Mark messages as read for this staff user
-    conv.messages.filter(read=False).exclude(sender=request.user).update(read=True)
+    marked = conv.messages.filter(read=False).exclude(sender=request.user).update(read=True)
+    if marked:
+        refresh_unread_counts(conv)
+        counters.invalidate(counters.MESSAGES, conv.participants.values_list('id', flat=True))
     messages_qs = conv.messages.all()
     return render(request, 'shop/admin_message_detail.html', {'conversation': conv, 'messages': messages_qs})
 
 
+@staff_member_required
+def admin_outbox_stats(request):
+    """Compteurs de l'outbox Channels de ce processus (envoyés, en retard, abandonnés)"""
+    return JsonResponse(outbox.get_outbox().stats())
+
+
 # =========================
 # ADMIN - INTERFACE SIMPLIFIÉE POUR STAFF
 # =========================
@@ -269,22 +352,28 @@ from .forms import OrderAdminForm, SubscriptionAdminForm
 def admin_order_list(request):
     """Liste des commandes pour les admins (staff).
     Superuser voit tout, staff voit seulement les commandes assignées à lui.
+    Pagination par curseur sur (created_at, id) : une page profonde coûte autant que la première.
     """
-    qs = Order.objects.all().order_by('-created_at')
+    qs = Order.objects.select_related('user', 'assigned_to')
     if not request.user.is_superuser:
         qs = qs.filter(assigned_to=request.user)
 
     status_filter = request.GET.get('status')
-    if status_filter:
+    if status_filter in dict(Order.STATUS_CHOICES):
         qs = qs.filter(status=status_filter)
+    else:
+        status_filter = ''
 
-    # Pagination simple
-    from django.core.paginator import Paginator
-    paginator = Paginator(qs, 20)
-    page = request.GET.get('page')
-    orders_page = paginator.get_page(page)
+    orders_page = keyset_paginate(qs, request.GET.get('cursor'), 20, ordering=('-created_at', '-id'))
+    total, total_is_approximate = approximate_count(qs)
 
-    return render(request, 'shop/admin_order_list.html', {'orders': orders_page})
+    return render(request, 'shop/admin_order_list.html', {
+        'orders': orders_page,
+        'status_filter': status_filter,
+        'status_choices': Order.STATUS_CHOICES,
+        'total': total,
+        'total_is_approximate': total_is_approximate,
+    })
 
 
 @staff_member_required
@@ -297,14 +386,16 @@ def admin_order_detail(request, order_id):
     if request.method == 'POST':
         form = OrderAdminForm(request.POST, instance=order)
         if form.is_valid():
-            old_status = order.status
             order = form.save(commit=False)
-            order.save()
-            # Historique
-            if old_status != order.status:
-                OrderStatusHistory.objects.create(order=order, old_status=old_status, new_status=order.status, changed_by=request.user)
-                if order.user:
-                    Notification.objects.create(recipient=order.user, verb=f"Le statut de votre commande #{order.id} est maintenant: {order.status}", url=f"/commande/{order.id}/")
+            # Historique et notification créés par le signal order_status_change
+            order.status_changed_by = request.user
+            try:
+                # Le stock d'une commande rétablie est réservé dans le signal : tout ou rien
+                with transaction.atomic():
+                    order.save()
+            except OutOfStockError as e:
+                messages.error(request, f"Commande non modifiée : {e}.")
+                return redirect('admin_order_detail', order_id=order.id)
             messages.success(request, "Commande mise à jour.")
             return redirect('admin_order_detail', order_id=order.id)
     else:
@@ -396,6 +487,9 @@ def user_login(request):
 def user_logout(request):
     """Déconnexion"""
     logout(request)
+    # Le panier (cookie ou cache) survit à la session : le vider pour la
+    # prochaine personne qui utilise l'appareil
+    Cart(request).clear()
     messages.info(request, "Vous avez été déconnecté avec succès.")
     return redirect('home')
 
@@ -403,20 +497,41 @@ def user_logout(request):
 # =========================
 # PROFIL UTILISATEUR
 # =========================
+PROFILE_RECENT_ORDERS = 5
+MY_ORDERS_PER_PAGE = 20
+
+
+def _customer_orders(user):
+    """Commandes d'un client avec lieu de livraison et articles préchargés"""
+    return (
+        Order.objects.filter(user=user)
+        .select_related('delivery_location')
+        .prefetch_related('items__product')
+    )
+
+
 @login_required
 def profile(request):
-    """Page de profil utilisateur"""
+    """Page de profil utilisateur
+
+    Les statistiques (nombre de commandes, total dépensé, dernière commande)
+    sont lues sur le profil, tenues à jour par shop/customers.py ; seules les
+    commandes les plus récentes sont affichées.
+    """
     # Récupérer ou créer les points de fidélité
     reward_points, created = RewardPoint.objects.get_or_create(user=request.user)
-    
-    # Récupérer les commandes (✅ CORRIGÉ : created_at au lieu de date)
-    orders = Order.objects.filter(user=request.user).order_by('-created_at')
-    
+    user_profile, created = UserProfile.objects.get_or_create(user=request.user)
+
+    orders = list(
+        _customer_orders(request.user).order_by('-created_at', '-id')[:PROFILE_RECENT_ORDERS]
+    )
+
     # Récupérer les abonnements
-    subscriptions = Subscription.objects.filter(user=request.user)
+    subscriptions = Subscription.objects.filter(user=request.user).prefetch_related('products')
 
     context = {
         'reward_points': reward_points,
+        'user_profile': user_profile,
         'orders': orders,
         'subscriptions': subscriptions,
     }
@@ -425,8 +540,8 @@ def profile(request):
 
 @login_required
 def my_orders(request):
-    """Page dédiée pour que le client consulte toutes ses commandes"""
-    orders = Order.objects.filter(user=request.user).order_by('-created_at')
+    """Page dédiée pour que le client consulte toutes ses commandes (pagination par curseur)"""
+    orders = keyset_paginate(_customer_orders(request.user), request.GET.get('cursor'), MY_ORDERS_PER_PAGE)
     return render(request, 'shop/orders_list.html', {'orders': orders})
 
 @login_required